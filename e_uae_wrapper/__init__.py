@@ -1 +1,2 @@
 WRAPPER_KEY = 'wrapper'
+__version__ = '0.2'
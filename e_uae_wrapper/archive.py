@@ -4,10 +4,15 @@ Run e-uae with archived filesystem/adf files
 It will use compressed directories, and optionally replace source archive with
 the temporary one.
 """
+import logging
 import os
-import shutil
 
 from e_uae_wrapper import base
+from e_uae_wrapper import delta
+from e_uae_wrapper import materialize
+from e_uae_wrapper import metrics
+from e_uae_wrapper import persist
+from e_uae_wrapper import sparse
 from e_uae_wrapper import utils
 
 
@@ -43,24 +48,114 @@ class Wrapper(base.ArchiveBase):
 
         return self._make_archive()
 
+    @metrics.phase('make_archive')
     def _make_archive(self):
         """
         Produce archive and save it back. Than remove old one.
         """
-        if self.config.get('wrapper_persist_data', '0') != '1':
+        persist_data = self.config.get('wrapper_persist_data', '0') == '1'
+        if not persist_data and not self._save_state():
             return True
 
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
+        if not self._is_changed():
+            logging.info("No changes were made in `%s', skipping creating "
+                         "archive.", self.arch_filepath)
+            return True
 
-        os.unlink('.uaerc')
+        if self.config.get('wrapper_sparsify', '0') == '1':
+            self._sparsify()
 
         title = self._get_title()
 
-        arch = os.path.basename(self.arch_filepath)
-        if not utils.create_archive(arch, title):
+        if not persist_data:
+            return delta.save(self.dir, self.base_manifest, self.save_filename,
+                              title, self._get_archive_options())
+
+        # save state and layers are included in the new archive
+        obsolete = list(self.layers)
+        if self._save_state():
+            obsolete.append(self.save_filename)
+
+        if self.config.get('wrapper_persist_layers', '0') == '1':
+            return self._make_layer(title, obsolete)
+
+        use_store = self.config.get('wrapper_store', '0') == '1'
+        use_index = self.config.get('wrapper_index', '1') == '1'
+
+        if self.config.get('wrapper_persist_async', '0') == '1':
+            if not persist.submit(self.dir, self.arch_filepath, title,
+                                  self._get_archive_options(), use_store,
+                                  use_index, obsolete):
+                return False
+            # temporary directory is owned by the background worker now
+            self.dir = None
+            return True
+
+        return persist.make_archive(self.dir, self.arch_filepath, title,
+                                    self._get_archive_options(), use_store,
+                                    use_index, obsolete=obsolete)
+
+    def _make_layer(self, title, obsolete):
+        """
+        Store changes made during the session in the new layer on top of the
+        archive. If layers exceed limits, they are folded back into the
+        archive by the background compaction.
+        """
+        layer = delta.get_next_layer_path(self.arch_filepath)
+        if not delta.save(self.dir, self.base_manifest, layer, title,
+                          self._get_archive_options()):
             return False
+        if self._save_state():
+            # save state is included in the layer
+            obsolete.remove(self.save_filename)
+            if os.path.exists(self.save_filename):
+                os.unlink(self.save_filename)
+        if not os.path.exists(layer):
+            # no changes against the archive and its layers
+            return True
 
-        shutil.move(arch, self.arch_filepath)
-        os.chdir(curdir)
+        logging.info("Changes stored in layer `%s'.", layer)
+        layers = self.layers + [layer]
+        # layers are removed from the oldest one, so that those left after
+        # interrupted removal still apply cleanly on the compacted archive
+        obsolete.append(layer)
+
+        if not self._needs_compaction(layers):
+            return True
+
+        logging.info("Compacting %d layers into `%s'.", len(layers),
+                     self.arch_filepath)
+        if not persist.submit(self.dir, self.arch_filepath, title,
+                              self._get_archive_options(),
+                              self.config.get('wrapper_store', '0') == '1',
+                              self.config.get('wrapper_index', '1') == '1',
+                              obsolete):
+            # layers are still valid, compaction will be retried next time
+            return True
+        # temporary directory is owned by the background worker now
+        self.dir = None
         return True
+
+    def _needs_compaction(self, layers):
+        """
+        Check if number of layers, or their size relative to the archive
+        exceed limits set by wrapper_layers_max and wrapper_layers_max_size
+        options
+        """
+        max_layers = utils.get_int_option(self.config, 'wrapper_layers_max',
+                                          8)
+        if len(layers) > max_layers:
+            return True
+
+        percent = utils.get_int_option(self.config, 'wrapper_layers_max_size',
+                                       50)
+        size = sum(os.path.getsize(x) for x in layers)
+        return size * 100 > os.path.getsize(self.arch_filepath) * percent
+
+    def _sparsify(self):
+        """Replace blocks of zeros in hard disk images with holes"""
+        for rel_path in materialize.get_mounted_paths(
+                self.config, self.dir, ['hardfile', 'hardfile2']):
+            path = os.path.join(self.dir, rel_path)
+            if os.path.isfile(path):
+                sparse.sparsify(path)
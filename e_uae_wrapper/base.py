@@ -8,9 +8,17 @@ import shutil
 import sys
 import tempfile
 
-from e_uae_wrapper import utils
-from e_uae_wrapper import path
 from e_uae_wrapper import WRAPPER_KEY
+from e_uae_wrapper import metrics
+from e_uae_wrapper import utils
+from e_uae_wrapper import template
+
+# modules dealing with archives are imported where they are used, so that
+# they are not loaded by the modules which don't need them, like plain
+
+
+# options which values are known only during the run
+RUNTIME_KEYS = ['wrapper_tmp_path']
 
 
 class Base(object):
@@ -18,8 +26,6 @@ class Base(object):
     Base class for wrapper modules
     """
 
-    CONF_RE = re.compile(r'[^{]*{{(?P<replace>[^}]+)}}')
-
     def __init__(self, conf_file, config):
         """
         Params:
@@ -31,6 +37,7 @@ class Base(object):
         self.conf_file = conf_file
         self.conf_path = os.path.dirname(os.path.abspath(conf_file))
 
+    @metrics.phase('setup')
     def run(self):
         """
         Main function which accepts config file for e-uae
@@ -42,9 +49,15 @@ class Base(object):
             - run the emulation
         """
 
-        self.config['wrapper_tmp_path'] = self.dir = tempfile.mkdtemp()
+        if not self._make_tmp_dir():
+            return False
+
+        self.config['wrapper_tmp_path'] = self.dir
         self.config['wrapper_config_path'] = self.conf_path
-        self._interpolate_options()
+        if not self._interpolate_options():
+            return False
+
+        self._set_assets_paths()
 
         if not self._validate_options():
             return False
@@ -54,33 +67,97 @@ class Base(object):
 
         return True
 
+    def compile_config(self):
+        """
+        Resolve all the templates in configuration, which doesn't depend on
+        per-run values, so that configuration can be cached. Return False if
+        templates cannot be resolved, True otherwise.
+        """
+        self.config['wrapper_config_path'] = self.conf_path
+        return self._interpolate_options(RUNTIME_KEYS)
+
+    def dry_run(self):
+        """
+        Validate options and print configuration as it would be passed to
+        the emulator, without extracting anything and running the emulator.
+        Values depending on the temporary directory are left unresolved.
+        Return True if configuration is valid, False otherwise.
+        """
+        if not self.compile_config():
+            return False
+
+        if not self._validate_options():
+            return False
+
+        self._write_conf(sys.stdout)
+        return True
+
+    def _make_tmp_dir(self):
+        """
+        Create temporary directory for the session, in the directory set by
+        wrapper_tmp_dir option if provided. Return True on success, False
+        otherwise.
+        """
+        tmp_dir = self._get_tmp_dir()
+        if tmp_dir is False:
+            return False
+        self.dir = tempfile.mkdtemp(dir=tmp_dir)
+        return True
+
+    def _get_tmp_dir(self):
+        """
+        Return directory where temporary directory should be created, None
+        for the default one, or False if there is no suitable place.
+        """
+        return self.config.get('wrapper_tmp_dir')
+
+    def _set_assets_paths(self):
+        """
+        Set full path for save state archive file, named after configuration
+        file with _save suffix, and extension of the wrapper_archiver format
+        """
+        conf_base = os.path.splitext(os.path.basename(self.conf_file))[0]
+        arch_ext = utils.get_arch_ext(self.config.get('wrapper_archiver'))
+        if arch_ext:
+            self.save_filename = os.path.join(self.conf_path,
+                                              conf_base + '_save' + arch_ext)
+
+    @metrics.phase('clean')
     def clean(self):
         """Remove temporary file"""
         if self.dir:
             shutil.rmtree(self.dir)
         return
 
+    @metrics.phase('copy_conf')
     def _copy_conf(self):
         """copy provided configuration as .uaerc"""
         curdir = os.path.abspath('.')
         os.chdir(self.dir)
 
         with open(os.path.join(self.dir, '.uaerc'), 'w') as fobj:
-            for key, val in self.config.items():
-                if isinstance(val, list):
-                    for subval in val:
-                        fobj.write('%s=%s\n' % (key, subval))
-                else:
-                    fobj.write('%s=%s\n' % (key, val))
+            self._write_conf(fobj)
 
         os.chdir(curdir)
         return True
 
+    def _write_conf(self, fobj):
+        """Write configuration in .uaerc format to the file object"""
+        for key, val in self.config.items():
+            if isinstance(val, list):
+                for subval in val:
+                    fobj.write('%s=%s\n' % (key, subval))
+            else:
+                fobj.write('%s=%s\n' % (key, val))
+
+    @metrics.phase('run_emulator')
     def _run_emulator(self):
         """execute e-uae"""
+        from e_uae_wrapper import supervisor
+
         curdir = os.path.abspath('.')
         os.chdir(self.dir)
-        utils.run_command(['e-uae'])
+        supervisor.run(['e-uae'], self.config)
         os.chdir(curdir)
         return True
 
@@ -97,77 +174,33 @@ class Base(object):
                 title = self.config['wrapper_archive']
         return title
 
-    def _calculate_path(self, value):
-        """
-        Make absoulte path by splitting the val with '{{replace}}' and by
-        adding right value for replace from config.
-        """
-        if not isinstance(value, list):
-            value = [value]
-
-        result = []
-        for val in value:
-            if '{{' not in val:
-                result.append(val)
-                continue
-
-            if 'path' not in val:
-                match = Base.CONF_RE.match(val)
-                replace = match.group('replace')
-                result.append(val.replace("{{%s}}" % replace,
-                                          self.config.get(replace, '')))
-                continue
-
-            for item in re.split('[,:]', val):
-                if '{{' in item:
-                    path = self._get_abspath(item)
-                    result.append(val.replace(item, path))
-                    break
-
-        if len(value) == 1:
-            return result[0]
-        return result
-
-    def _get_abspath(self, val):
-        path_list = [x for y in val.split('{{') for x in y.split('}}')]
-        for index, item in enumerate(path_list):
-            if item in self.config:
-                path_list[index] = self.config[item]
-
-        return os.path.abspath(os.path.join(*path_list))
-
-    def _interpolate_options(self):
+    def _get_archive_options(self):
+        """Return options for the archivers, taken from configuration"""
+        from e_uae_wrapper import file_archive
+
+        return {'backend': self.config.get('wrapper_archive_backend',
+                                           file_archive.NATIVE),
+                'threads': utils.get_int_option(self.config,
+                                                'wrapper_compress_threads',
+                                                1),
+                'level': utils.get_int_option(self.config,
+                                              'wrapper_compress_level',
+                                              None),
+                'verify': self.config.get('wrapper_verify', '1') == '1'}
+
+    def _interpolate_options(self, skip=None):
         """
         Search and replace values for options which contains {{ and  }}
-        markers for replacing them with correpsonding calculated values
+        markers for replacing them with correpsonding calculated values.
+        Values which refer to options listed in skip are left untouched.
+        Return False if templates cannot be resolved, True otherwise.
         """
-        updated_conf = {}
-        for key, val in self.config.items():
-
-            if key.startswith(WRAPPER_KEY):
-                continue
-
-            check_val = val
-            if isinstance(val, list):
-                check_val = " ".join(check_val)
-
-            if '{{' + WRAPPER_KEY in check_val:
-                match = Base.CONF_RE.match(check_val)
-                if not match:
-                    logging.warning("Possible error in configuration file on "
-                                    "key %s.", key)
-                    continue
-
-                replace = match.group('replace')
-                if 'path' in replace:
-                    updated_conf[key] = self._calculate_path(val)
-                else:
-                    updated_conf[key] = val.replace("{{%s}}" % replace,
-                                                    self.config.get(replace,
-                                                                    ''))
-
-        if updated_conf:
-            self.config.update(updated_conf)
+        try:
+            template.interpolate(self.config, skip)
+        except template.TemplateError as err:
+            logging.error("Error in configuration file: %s.", err)
+            return False
+        return True
 
     def _validate_options(self):
         """Validate mandatory options"""
@@ -175,6 +208,12 @@ class Base(object):
             logging.error("Configuration lacks of required `wrapper' option.")
             return False
 
+        from e_uae_wrapper import supervisor
+
+        # logs the reason
+        if supervisor.get_options(self.config) is None:
+            return False
+
         if self.config.get('wrapper_save_state', '0') == '0':
             return True
 
@@ -183,9 +222,19 @@ class Base(object):
                           "`wrapper_archiver' option.")
             return False
 
-        if not path.which(self.config['wrapper_archiver']):
-            logging.error("Cannot find archiver `%s'.",
-                          self.config['wrapper_archiver'])
+        from e_uae_wrapper import file_archive
+
+        arch_ext = utils.get_arch_ext(self.config['wrapper_archiver'])
+        if not arch_ext:
+            logging.error("Unknown archiver `%s', use one of: %s.",
+                          self.config['wrapper_archiver'],
+                          ", ".join(x['name'] for x
+                                    in file_archive.Archivers.archivers))
+            return False
+
+        # logs the reason, if format cannot be handled
+        if not file_archive.get_archiver('save' + arch_ext,
+                                         **self._get_archive_options()):
             return False
 
         return True
@@ -206,6 +255,22 @@ class ArchiveBase(Base):
         super(ArchiveBase, self).__init__(conf_path, config)
         self.arch_filepath = os.path.join(self.conf_path,
                                           config.get('wrapper_archive', ''))
+        self.manifest = None
+        # manifest of the tree extracted out of the archive and its layers,
+        # before save state was restored on top of it
+        self.base_manifest = None
+        self.layers = []
+        self._index = False
+
+    def run(self):
+        """
+        Finish pending background save of the archive first, so that its
+        index is not read before the archive is replaced
+        """
+        from e_uae_wrapper import persist
+
+        persist.wait(self.arch_filepath)
+        return super(ArchiveBase, self).run()
 
     def _set_assets_paths(self):
         """
@@ -222,16 +287,228 @@ class ArchiveBase(Base):
             else:
                 self.arch_filepath = os.path.join(conf_abs_dir, arch)
 
+    @metrics.phase('extract')
     def _extract(self):
+        """
+        Extract archive to temp dir, apply its layers in order, and take the
+        manifest of extracted files if data is going to be persisted. Pending
+        background save or compaction of the archive is finished first. Save
+        state, if any, is restored on top of extracted files.
+        """
+        from e_uae_wrapper import delta
+        from e_uae_wrapper import manifest
+        from e_uae_wrapper import persist
+
+        persist.wait(self.arch_filepath)
+        self.layers = delta.get_layers(self.arch_filepath)
+
+        if self._extract_used():
+            return True
+
+        if not self._extract_archive():
+            return False
+
+        digests = {}
+        checksum = self.config.get('wrapper_manifest_hash', '0') == '1'
+        take_manifest = (self.config.get('wrapper_persist_data', '0') == '1'
+                         or self._save_state())
+        if take_manifest and not self.layers:
+            self.manifest = manifest.Manifest(self.dir, checksum)
+            if self.manifest.checksum:
+                digests = dict((key, val[3]) for key, val
+                               in self.manifest.entries.items()
+                               if val[0] == 'f')
+
+        # index describes the base archive only, so it is written before
+        # layers are applied
+        if (self.config.get('wrapper_index', '1') == '1' and
+                self._get_index() is None):
+            from e_uae_wrapper import sidecar
+            sidecar.update(self.arch_filepath, self.dir, digests)
+
+        for layer in self.layers:
+            if not delta.restore(layer, self.dir,
+                                 self._get_archive_options()):
+                logging.error("Unable to apply layer `%s'.", layer)
+                return False
+        if take_manifest and self.layers:
+            self.manifest = manifest.Manifest(self.dir, checksum)
+        self.base_manifest = self.manifest
+
+        if self._save_state() and os.path.exists(self.save_filename):
+            if not delta.restore(self.save_filename, self.dir,
+                                 self._get_archive_options()):
+                logging.error("Unable to restore save state `%s'.",
+                              self.save_filename)
+                return False
+            self.manifest = manifest.Manifest(self.dir, checksum)
+        return True
+
+    def _save_state(self):
+        """Check if save state is enabled and its path is known"""
+        return (self.config.get('wrapper_save_state', '0') == '1' and
+                self.save_filename is not None)
+
+    def _extract_used(self):
+        """
+        Extract only files used by the configuration, if requested by
+        wrapper_extract_used option and index of the archive allows that.
+        Return True if files were extracted, False if whole archive should be
+        extracted instead.
+        """
+        if self.config.get('wrapper_extract_used', '0') != '1':
+            return False
+
+        if (self.config.get('wrapper_persist_data', '0') == '1' or
+                self._save_state()):
+            logging.warning("Cannot extract part of the archive, when data "
+                            "is going to be persisted. Extracting whole "
+                            "archive.")
+            return False
+
+        if self.layers:
+            logging.debug("Archive `%s' has layers, extracting whole "
+                          "archive.", self.arch_filepath)
+            return False
+
+        index = self._get_index()
+        if index is None or not index.seekable:
+            logging.debug("No index allowing selective extraction of `%s'.",
+                          self.arch_filepath)
+            return False
+
+        curdir = os.path.abspath('.')
+        os.chdir(self.dir)
+        try:
+            return index.extract(self._get_used_paths())
+        finally:
+            os.chdir(curdir)
+
+    def _get_used_paths(self):
+        """
+        Return list of paths relative to the temp dir, which are referenced
+        in configuration (i.e. by filesystem, hardfile or floppy options)
+        """
+        pattern = re.compile(re.escape(self.dir + os.sep) + '([^,:]+)')
+        result = set()
+        for key, values in self.config.items():
+            if key.startswith(WRAPPER_KEY):
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                result.update(pattern.findall(value))
+        return sorted(result)
+
+    def _get_index(self):
+        """
+        Return sidecar index of the archive, or None if it is not available,
+        or disabled by wrapper_index option
+        """
+        if self._index is False:
+            self._index = None
+            if self.config.get('wrapper_index', '1') == '1':
+                from e_uae_wrapper import sidecar
+                self._index = sidecar.load(self.arch_filepath)
+        return self._index
+
+    def _extract_archive(self):
         """Extract archive to temp dir"""
+        from e_uae_wrapper import materialize
 
         title = self._get_title()
+
+        if self.config.get('wrapper_store', '0') == '1':
+            from e_uae_wrapper import store
+            return store.Store(self._get_archive_options()).extract(
+                self.arch_filepath, self.dir, title,
+                materialize.get_readonly_paths(self.config, self.dir))
+
+        if self.config.get('wrapper_cache', '0') == '1':
+            from e_uae_wrapper import tree_cache
+            cache = tree_cache.TreeCache(
+                utils.get_int_option(self.config, 'wrapper_cache_size', 4096),
+                self.config.get('wrapper_cache_hash', '0') == '1',
+                self._get_archive_options())
+            return cache.extract(self.arch_filepath, self.dir, title,
+                                 materialize.get_readonly_paths(self.config,
+                                                                self.dir))
+
         curdir = os.path.abspath('.')
         os.chdir(self.dir)
-        result = utils.extract_archive(self.arch_filepath, title)
+        result = utils.extract_archive(self.arch_filepath, title,
+                                       **self._get_archive_options())
         os.chdir(curdir)
         return result
 
+    def _get_tmp_dir(self):
+        """
+        Return tmpfs directory if extracted archive will fit there, or disk
+        directory (set by wrapper_tmp_disk_dir option) otherwise. Directory
+        set by wrapper_tmp_dir option is used regardless of the size. With
+        the tree cache or the store, directory next to them is used.
+        """
+        if not os.path.exists(self.arch_filepath):
+            # will be reported during extraction
+            return self.config.get('wrapper_tmp_dir')
+
+        from e_uae_wrapper import delta
+        from e_uae_wrapper import staging
+
+        index = self._get_index()
+        # files replaced by the layers are staged next to the originals
+        sizes = [index.size if index else
+                 staging.estimate_size(self.arch_filepath)]
+        sizes.extend(staging.estimate_size(x)
+                     for x in delta.get_layers(self.arch_filepath))
+        size = None if None in sizes else sum(sizes)
+
+        if self.config.get('wrapper_tmp_dir'):
+            tmp_dir = self.config['wrapper_tmp_dir']
+            if size is not None and not staging.fits_disk(tmp_dir, size):
+                logging.error("There is no space in `%s' for extracting "
+                              "`%s' (%d MiB).", tmp_dir, self.arch_filepath,
+                              size // staging.MIB)
+                return False
+            return tmp_dir
+
+        if (self.config.get('wrapper_cache', '0') == '1' or
+                self.config.get('wrapper_store', '0') == '1'):
+            # files are cloned or linked out of the cache or the store, which
+            # is possible only within the same filesystem
+            tmp_dir = utils.get_cache_dir('sessions')
+            if size is not None and not staging.fits_disk(tmp_dir, size):
+                logging.error("There is no space in `%s' for extracting "
+                              "`%s' (%d MiB).", tmp_dir, self.arch_filepath,
+                              size // staging.MIB)
+                return False
+            return tmp_dir
+
+        tmp_dir = staging.select_dir(size,
+                                     self.config.get('wrapper_tmp_disk_dir'))
+        if tmp_dir is None:
+            if size is None:
+                logging.error("There is no writable directory for "
+                              "extracting `%s'.", self.arch_filepath)
+            else:
+                logging.error("There is no space for extracting `%s' (about "
+                              "%d MiB).", self.arch_filepath,
+                              size // staging.MIB)
+            return False
+        return tmp_dir
+
+    def _is_changed(self):
+        """
+        Check if the contents of temp dir differ from what was extracted out
+        of the archive.
+        """
+        from e_uae_wrapper import manifest
+
+        if self.manifest is None:
+            return True
+        return manifest.Manifest(self.dir, self.manifest.checksum) != \
+            self.manifest
+
     def _validate_options(self):
 
         validation_result = super(ArchiveBase, self)._validate_options()
@@ -241,4 +518,25 @@ class ArchiveBase(Base):
                              "`wrapper_archive' option.\n")
             validation_result = False
 
+        index = self._get_index() if self.dir else None
+        if self.save_filename and os.path.exists(self.save_filename):
+            # paths might be added by the save state
+            index = None
+        if index is not None:
+            from e_uae_wrapper import delta
+
+            if delta.get_layers(self.arch_filepath):
+                # or by the layers
+                index = None
+        if index is not None:
+            from e_uae_wrapper import materialize
+
+            for rel_path in materialize.get_mounted_paths(self.config,
+                                                          self.dir):
+                if not index.contains(rel_path):
+                    logging.error("Path `%s' used in configuration doesn't "
+                                  "exist in archive `%s'.", rel_path,
+                                  self.arch_filepath)
+                    validation_result = False
+
         return validation_result
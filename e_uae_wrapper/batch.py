@@ -0,0 +1,142 @@
+"""
+Run many configurations concurrently, i.e. for smoke testing the library of
+games with headless e-uae.
+
+Configurations are run in the pool of worker processes, each of them in its
+own temporary directory. Exit codes and timings are collected into the
+summary report.
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from e_uae_wrapper import metrics
+from e_uae_wrapper import wrapper
+
+
+def parse_args():
+    """Parse command line arguments for the batch mode"""
+    parser = argparse.ArgumentParser(description='Run many e-uae '
+                                     'configurations concurrently.')
+    parser.add_argument('configs', nargs='+', help='Configuration files, or '
+                        'directories containing them.')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Number of configurations run at the same '
+                        'time. Defaults to number of CPU cores.')
+    parser.add_argument('-p', '--pattern', default='*.uaerc',
+                        help='Pattern for configuration files searched in '
+                        'directories. Default is "%(default)s".')
+    parser.add_argument('-r', '--report', help='Write report in JSON format '
+                        'to provided file.')
+    parser.add_argument('--profile', help='Print time and resources used by '
+                        'each phase.', action='store_true')
+    parser.add_argument('--metrics', metavar='FILE', help='Append time and '
+                        'resources used by each phase to the file as JSON '
+                        'lines.')
+    parser.add_argument('-v', '--verbose', help='Be verbose. Adding more "v" '
+                        'will increase verbosity', action="count",
+                        default=None)
+    parser.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" will'
+                        ' decrease verbosity', action="count", default=None)
+
+    args = parser.parse_args()
+    wrapper.setup_logger(args)
+    return args
+
+
+def get_configs(paths, pattern):
+    """
+    Return list of configuration files out of provided files and
+    directories
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            result.append(path)
+    return [os.path.abspath(x) for x in result]
+
+
+def run_config(conf_file):
+    """
+    Run single configuration. Return dictionary with configuration path,
+    exit code and time spent.
+    """
+    start = time.time()
+    try:
+        exit_code = wrapper.run_config(conf_file)
+    except Exception:
+        logging.exception("Running `%s' failed.", conf_file)
+        exit_code = 1
+    return {'config': conf_file,
+            'exit_code': exit_code,
+            'time': round(time.time() - start, 3)}
+
+
+def run_batch(configs, jobs=0):
+    """
+    Run provided configurations in pool of processes. Return list of
+    results in the order of configs.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    results = {}
+    pool = multiprocessing.Pool(min(jobs, len(configs)))
+    try:
+        for result in pool.imap_unordered(run_config, configs):
+            logging.info("`%s' finished with exit code %d in %.3fs.",
+                         result['config'], result['exit_code'],
+                         result['time'])
+            results[result['config']] = result
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return [results[x] for x in configs]
+
+
+def print_summary(results, elapsed):
+    """Print summary of the batch run"""
+    width = max(len(x['config']) for x in results)
+    for result in results:
+        sys.stdout.write("%-*s  %3d  %8.3fs\n" % (width, result['config'],
+                                                  result['exit_code'],
+                                                  result['time']))
+    failed = len([x for x in results if x['exit_code']])
+    sys.stdout.write("%d configurations, %d failed, %.3fs total.\n" %
+                     (len(results), failed, elapsed))
+
+
+def run():
+    """Run batch of configurations"""
+    args = parse_args()
+    metrics.enable(args.metrics, args.profile)
+    configs = get_configs(args.configs, args.pattern)
+    if not configs:
+        logging.error("No configuration files found.")
+        sys.exit(2)
+
+    start = time.time()
+    results = run_batch(configs, args.jobs)
+    elapsed = time.time() - start
+    print_summary(results, elapsed)
+
+    if args.report:
+        with open(args.report, 'w') as fobj:
+            json.dump({'results': results, 'time': round(elapsed, 3)}, fobj,
+                      indent=2)
+
+    if [x for x in results if x['exit_code']]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,385 @@
+"""
+Benchmark of archivers.
+
+Builds synthetic Amiga-like tree (lots of tiny files, few large hard disk
+images, sparse images), and measures creating and extracting archives for
+every format from Archivers and for every available backend. Each operation
+is run in a separate process, so that its CPU time and peak memory can be
+measured. Results are written as JSON lines, which can be compared with
+results of the previous runs.
+
+With --startup option, startup time of the wrapper is measured instead, for
+printing version, dry run, and running plain module with dummy emulator. If
+median time of the latter exceeds the budget, benchmark fails.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from e_uae_wrapper import file_archive
+from e_uae_wrapper import wrapper
+
+
+MIB = 1024 * 1024
+WORDS = [b'LIBS:', b'SYS:', b'C:', b'Workbench', b'dos.library', b'Echo',
+         b'Assign', b'Startup-Sequence', b'ENDIF', b'IF', b'FAILAT', b'21',
+         b'\x00\x00\x03\xf3', b'\x4e\x75', b'\x4e\x71', b'Resident']
+
+
+def parse_args():
+    """Parse command line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark archivers.')
+    parser.add_argument('-f', '--formats', nargs='+', help='Archive formats '
+                        'to benchmark, by default all of them.')
+    parser.add_argument('-b', '--backends', nargs='+',
+                        default=[file_archive.NATIVE, file_archive.EXTERNAL],
+                        help='Backends to benchmark.')
+    parser.add_argument('--small-files', type=int, default=2000,
+                        help='Number of tiny files. Default %(default)s.')
+    parser.add_argument('--small-size', type=int, default=4096,
+                        help='Maximal size of tiny files in bytes. Default '
+                        '%(default)s.')
+    parser.add_argument('--large-files', type=int, default=2,
+                        help='Number of hard disk images. Default '
+                        '%(default)s.')
+    parser.add_argument('--large-size', type=int, default=32,
+                        help='Size of hard disk images in MiB. Default '
+                        '%(default)s.')
+    parser.add_argument('--sparse-files', type=int, default=1,
+                        help='Number of sparse hard disk images. Default '
+                        '%(default)s.')
+    parser.add_argument('--sparse-size', type=int, default=128,
+                        help='Size of sparse hard disk images in MiB. '
+                        'Default %(default)s.')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Compression threads. Default %(default)s.')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Repeat each measurement and take the fastest '
+                        'one. Default %(default)s.')
+    parser.add_argument('-o', '--output', help='Append results as JSON lines '
+                        'to the file.')
+    parser.add_argument('-c', '--compare', help='Compare results with the '
+                        'ones stored in provided file.')
+    parser.add_argument('-d', '--directory', help='Directory for the '
+                        'benchmark files, temporary directory by default.')
+    parser.add_argument('-s', '--startup', action='store_true',
+                        help='Measure startup time of the wrapper instead.')
+    parser.add_argument('--budget', type=float, default=150,
+                        help='Maximal median time in milliseconds of running '
+                        'plain module with --startup. Default %(default)s.')
+    parser.add_argument('-v', '--verbose', help='Be verbose. Adding more "v" '
+                        'will increase verbosity', action="count",
+                        default=None)
+    parser.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" will'
+                        ' decrease verbosity', action="count", default=None)
+
+    args = parser.parse_args()
+    wrapper.setup_logger(args)
+    return args
+
+
+def make_tree(path, shape, seed=0):
+    """
+    Create synthetic tree in path. Shape is a dictionary with numbers and
+    sizes of the files. Return total size of the files.
+    """
+    rand = random.Random(seed)
+    total = 0
+
+    for idx in range(shape['small_files']):
+        dirname = os.path.join(path, 'DH0', 'dir%02d' % (idx % 50))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        size = rand.randint(0, shape['small_size'])
+        data = b' '.join(rand.choice(WORDS)
+                         for _ in range(size // 6 + 1))[:size]
+        with open(os.path.join(dirname, 'file%05d' % idx), 'wb') as fobj:
+            fobj.write(data)
+        total += size
+
+    os.makedirs(os.path.join(path, 'HDF'))
+    for idx in range(shape['large_files']):
+        fname = os.path.join(path, 'HDF', 'disk%d.hdf' % idx)
+        with open(fname, 'wb') as fobj:
+            for block in range(shape['large_size']):
+                # mix of random and repetitive data, like on a used disk
+                if block % 3:
+                    fobj.write(os.urandom(MIB // 2) + b'\x00' * (MIB // 2))
+                else:
+                    fobj.write((rand.choice(WORDS) * MIB)[:MIB])
+        total += shape['large_size'] * MIB
+
+    for idx in range(shape['sparse_files']):
+        fname = os.path.join(path, 'HDF', 'sparse%d.hdf' % idx)
+        with open(fname, 'wb') as fobj:
+            fobj.write(os.urandom(MIB))
+            fobj.truncate(shape['sparse_size'] * MIB)
+        total += shape['sparse_size'] * MIB
+
+    return total
+
+
+def get_formats(names=None):
+    """
+    Return list of tuples with format name, extension, backend name and
+    archiver class, for all the available archivers.
+    """
+    result = []
+    for arch in file_archive.Archivers.archivers:
+        if names and arch['name'] not in names:
+            continue
+        ext = arch['ext'][0]
+        native = arch.get('native')
+        if native and native.available():
+            result.append((arch['name'], ext, file_archive.NATIVE, native))
+        if arch['arch']().archiver:
+            result.append((arch['name'], ext, file_archive.EXTERNAL,
+                           arch['arch']))
+    return result
+
+
+def _measure(queue, func, args):
+    """Run the function and put its result with resource usage to queue"""
+    start_wall = time.time()
+    start = os.times()
+    result = func(*args)
+    end = os.times()
+    data = {'result': result,
+            'wall': time.time() - start_wall,
+            'cpu': (end[0] + end[1] + end[2] + end[3]) -
+                   (start[0] + start[1] + start[2] + start[3]),
+            'max_rss_kb': None}
+    if resource:
+        data['max_rss_kb'] = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put(data)
+
+
+def measure(func, *args):
+    """Run the function in separate process and return measurements"""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(queue, func, args))
+    proc.start()
+    data = queue.get()
+    proc.join()
+    return data
+
+
+def _create(archiver, threads, arch_name, tree):
+    """Create archive out of the tree"""
+    os.chdir(tree)
+    return archiver(threads=threads).create(arch_name)
+
+
+def _extract(archiver, arch_name, dest):
+    """Extract archive into dest"""
+    os.chdir(dest)
+    return archiver().extract(arch_name)
+
+
+def run_benchmark(workdir, shape, formats, threads=1, repeat=1):
+    """Run benchmark, and return list of results"""
+    tree = os.path.join(workdir, 'tree')
+    os.mkdir(tree)
+    logging.info("Creating tree in `%s'.", tree)
+    size = make_tree(tree, shape)
+
+    results = []
+    for name, ext, backend, archiver in formats:
+        arch_name = os.path.join(workdir, 'bench.' + ext)
+        dest = os.path.join(workdir, 'out')
+        for operation in ('create', 'extract'):
+            best = None
+            for _ in range(repeat):
+                if operation == 'create':
+                    if os.path.exists(arch_name):
+                        os.unlink(arch_name)
+                    data = measure(_create, archiver, threads, arch_name,
+                                   tree)
+                else:
+                    if os.path.exists(dest):
+                        shutil.rmtree(dest)
+                    os.mkdir(dest)
+                    data = measure(_extract, archiver, arch_name, dest)
+                if best is None or data['wall'] < best['wall']:
+                    best = data
+
+            result = {'format': name,
+                      'backend': backend,
+                      'archiver': archiver.__name__,
+                      'operation': operation,
+                      'success': best['result'],
+                      'threads': threads,
+                      'shape': shape,
+                      'bytes': size,
+                      'archive_size': (os.path.getsize(arch_name)
+                                       if os.path.exists(arch_name)
+                                       else None),
+                      'wall': round(best['wall'], 6),
+                      'cpu': round(best['cpu'], 6),
+                      'max_rss_kb': best['max_rss_kb'],
+                      'throughput_mib_s': round(size / MIB / best['wall'],
+                                                3),
+                      'python': platform.python_version(),
+                      'host': platform.node(),
+                      'time': time.time()}
+            results.append(result)
+            logging.info("%s/%s %s: %.3fs", name, backend, operation,
+                         best['wall'])
+            if not best['result']:
+                break
+
+        if os.path.exists(arch_name):
+            os.unlink(arch_name)
+    return results
+
+
+def run_startup(workdir, repeat=1):
+    """
+    Measure startup time of the wrapper in separate processes. Return
+    dictionary with list of wall times in seconds for each case.
+    """
+    bin_dir = os.path.join(workdir, 'bin')
+    os.mkdir(bin_dir)
+    emulator = os.path.join(bin_dir, 'e-uae')
+    with open(emulator, 'w') as fobj:
+        fobj.write('#!/bin/sh\nexit 0\n')
+    os.chmod(emulator, 0o755)
+
+    conf = os.path.join(workdir, 'plain.uaerc')
+    with open(conf, 'w') as fobj:
+        fobj.write('wrapper=plain\n'
+                   'floppy0={{wrapper_config_path}}/disk.adf\n')
+
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    # keep caches filled by the runs away from the user ones
+    env['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    cmd = [sys.executable, '-m', 'e_uae_wrapper.wrapper']
+    cases = [('version', cmd + ['--version']),
+             ('dry_run', cmd + ['--dry-run', conf]),
+             ('plain', cmd + [conf])]
+
+    # first run fills the caches (compiled configuration, tool index)
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.call(cases[-1][1], env=env, stdout=devnull)
+        results = {}
+        for name, args in cases:
+            results[name] = []
+            for _ in range(repeat):
+                start = time.time()
+                subprocess.call(args, env=env, stdout=devnull)
+                results[name].append(time.time() - start)
+    finally:
+        devnull.close()
+    return results
+
+
+def check_startup(results, budget):
+    """Print startup times, and check if plain run fits in the budget"""
+    for name, times in results.items():
+        times = sorted(times)
+        sys.stdout.write("%-8s median: %8.1fms min: %8.1fms max: %8.1fms\n"
+                         % (name, times[len(times) // 2] * 1000,
+                            times[0] * 1000, times[-1] * 1000))
+
+    times = sorted(results['plain'])
+    median = times[len(times) // 2] * 1000
+    if median > budget:
+        logging.error("Startup of plain module took %.1fms, which exceeds "
+                      "the budget of %.1fms.", median, budget)
+        return False
+    return True
+
+
+def load_results(fname):
+    """Load results from JSON lines file, keyed by format/backend/op"""
+    results = {}
+    with open(fname) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if line:
+                result = json.loads(line)
+                results[(result['format'], result['backend'],
+                         result['operation'])] = result
+    return results
+
+
+def print_results(results, baseline=None):
+    """Print results table, optionally compared with baseline"""
+    sys.stdout.write("%-8s %-8s %-7s %9s %9s %9s %10s %12s%s\n" %
+                     ('format', 'backend', 'op', 'wall[s]', 'cpu[s]',
+                      'MiB/s', 'rss[KiB]', 'size',
+                      '  vs baseline' if baseline else ''))
+    for result in results:
+        line = "%-8s %-8s %-7s %9.3f %9.3f %9.2f %10s %12s" % (
+            result['format'], result['backend'], result['operation'],
+            result['wall'], result['cpu'], result['throughput_mib_s'],
+            result['max_rss_kb'], result['archive_size'])
+        key = (result['format'], result['backend'], result['operation'])
+        if baseline and key in baseline:
+            line += "  %+.1f%%" % ((result['wall'] / baseline[key]['wall'] -
+                                    1) * 100)
+        if not result['success']:
+            line += "  FAILED"
+        sys.stdout.write(line + "\n")
+
+
+def run():
+    """Run the benchmark"""
+    args = parse_args()
+    if args.startup:
+        workdir = tempfile.mkdtemp(dir=args.directory)
+        try:
+            results = run_startup(workdir, max(args.repeat, 5))
+        finally:
+            shutil.rmtree(workdir)
+        if not check_startup(results, args.budget):
+            sys.exit(1)
+        return
+
+    shape = {'small_files': args.small_files,
+             'small_size': args.small_size,
+             'large_files': args.large_files,
+             'large_size': args.large_size,
+             'sparse_files': args.sparse_files,
+             'sparse_size': args.sparse_size}
+    formats = [x for x in get_formats(args.formats)
+               if x[2] in args.backends]
+    if not formats:
+        logging.error("No archivers available for benchmark.")
+        sys.exit(2)
+
+    workdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        results = run_benchmark(workdir, shape, formats, args.threads,
+                                args.repeat)
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results, load_results(args.compare)
+                  if args.compare else None)
+
+    if args.output:
+        with open(args.output, 'a') as fobj:
+            for result in results:
+                fobj.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,139 @@
+"""
+Thin client for the wrapper daemon.
+
+Command line arguments, current directory and environment are sent to the
+daemon over the Unix socket, together with the standard input, output and
+error descriptors, so that the emulator and the logs use the terminal of the
+client. Signals are forwarded to the process running the configuration, and
+its exit code is returned. If the daemon is not running, configuration is
+run in-process. Before anything is sent, client checks that the daemon is
+run by the same user, as the environment and the terminal are handed over
+to it.
+
+Only the modules needed for talking to the daemon are imported here, to keep
+the startup time low.
+"""
+import array
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+
+
+def get_socket_path():
+    """Return path to the daemon socket"""
+    if os.environ.get('E_UAE_WRAPPER_SOCKET'):
+        return os.environ['E_UAE_WRAPPER_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                            'e-uae-wrapper.sock')
+    # shared directory, socket is kept in the private subdirectory
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                        'e-uae-wrapper-%d' % os.getuid(), 'daemon.sock')
+
+
+def make_socket_dir(path):
+    """
+    Create directory for the socket accessible only by the user, if it
+    doesn't exist. Return True if no one else than the user can create files
+    in the directory, False otherwise.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.lexists(dirname):
+            os.mkdir(dirname, 0o700)
+        stat_res = os.lstat(dirname)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(stat_res.st_mode) and
+            stat_res.st_uid == os.getuid() and
+            not stat_res.st_mode & 0o022)
+
+
+def connect(path=None):
+    """
+    Return socket connected to the daemon, or None if it's not running, or
+    is run by another user
+    """
+    path = path or get_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+
+    if _get_peer_uid(sock) != os.getuid():
+        sys.stderr.write("Socket `%s' is not owned by the wrapper daemon of "
+                         "the current user, ignoring it.\n" % path)
+        sock.close()
+        return None
+    return sock
+
+
+def _get_peer_uid(sock):
+    """Return uid of the process on the other end, or None if unknown"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    fmt = '3i'
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize(fmt))
+    return struct.unpack(fmt, creds)[1]
+
+
+def run_remote(sock, args):
+    """
+    Send request to the daemon, and wait for the exit code of the
+    configuration run.
+    """
+    request = {'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    # descriptors are passed along with the first byte of the request
+    sock.sendmsg([b'R'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           array.array('i', [0, 1, 2]))])
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    pid = None
+    exit_code = 1
+    for line in sock.makefile('rb'):
+        response = json.loads(line.decode('utf-8'))
+        if 'pid' in response:
+            pid = response['pid']
+            for signum in SIGNALS:
+                signal.signal(signum, _forward(pid))
+        if 'exit_code' in response:
+            exit_code = response['exit_code']
+    sock.close()
+    return exit_code
+
+
+def _forward(pid):
+    """Return signal handler forwarding signals to the process group"""
+    def handler(signum, _):
+        try:
+            os.killpg(pid, signum)
+        except OSError:
+            pass
+    return handler
+
+
+def run():
+    """Run configuration in the daemon, or in-process as a fallback"""
+    sock = connect()
+    if sock is None:
+        from e_uae_wrapper import wrapper
+        wrapper.run()
+        return
+
+    exit_code = run_remote(sock, sys.argv[1:])
+    if exit_code:
+        sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,212 @@
+"""
+Compression streams for in-process archivers.
+
+Parallel compression splits the data into blocks, which are compressed
+independently by the pool of threads, and written as concatenated
+gzip/bzip2/xz/lz4 streams. Such output is still a valid file for the format,
+readable by the standard tools. Zstandard does multithreading on its own.
+"""
+import bz2
+import collections
+import gzip
+import multiprocessing
+from multiprocessing import pool
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+BLOCK_SIZE = 4 * 1024 * 1024
+# default of the gzip tool, Python modules default to 9
+GZIP_LEVEL = 6
+
+
+def _compress_gz(data, level):
+    """Return data compressed as a single gzip member"""
+    cobj = zlib.compressobj(GZIP_LEVEL if level is None else level,
+                            zlib.DEFLATED, 31)
+    return cobj.compress(data) + cobj.flush()
+
+
+def _compress_bz2(data, level):
+    """Return data compressed as a single bzip2 stream"""
+    return bz2.compress(data, 9 if level is None else level)
+
+
+def _compress_xz(data, level):
+    """Return data compressed as a single xz stream"""
+    return lzma.compress(data, format=lzma.FORMAT_XZ,
+                         preset=6 if level is None else level)
+
+
+def _compress_lz4(data, level):
+    """Return data compressed as a single lz4 frame"""
+    return lz4.frame.compress(data, compression_level=level or 0)
+
+
+def _write_gz(fobj, threads, level):
+    return gzip.GzipFile(fileobj=fobj, mode='wb',
+                         compresslevel=GZIP_LEVEL if level is None
+                         else level)
+
+
+def _write_bz2(fobj, threads, level):
+    return bz2.BZ2File(fobj, 'wb', compresslevel=9 if level is None
+                       else level)
+
+
+def _write_xz(fobj, threads, level):
+    return lzma.LZMAFile(fobj, 'wb', preset=6 if level is None else level)
+
+
+def _write_zst(fobj, threads, level):
+    cctx = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                    threads=threads if threads > 1 else 0)
+    return cctx.stream_writer(fobj, closefd=False)
+
+
+def _write_lz4(fobj, threads, level):
+    return lz4.frame.LZ4FrameFile(fobj, 'wb', compression_level=level or 0)
+
+
+def _read_zst(fobj):
+    return zstandard.ZstdDecompressor().stream_reader(fobj,
+                                                      read_across_frames=True)
+
+
+# compressors of the single blocks for parallel compression
+COMPRESSORS = {'gz': _compress_gz, 'bz2': _compress_bz2}
+WRITERS = {'gz': _write_gz, 'bz2': _write_bz2}
+READERS = [(b'\x1f\x8b', lambda fobj: gzip.GzipFile(fileobj=fobj)),
+           (b'BZh', bz2.BZ2File)]
+
+if lzma:
+    COMPRESSORS['xz'] = _compress_xz
+    WRITERS['xz'] = _write_xz
+    READERS.append((b'\xfd7zXZ\x00', lzma.LZMAFile))
+
+if zstandard:
+    WRITERS['zst'] = _write_zst
+    READERS.append((b'\x28\xb5\x2f\xfd', _read_zst))
+
+if lz4:
+    COMPRESSORS['lz4'] = _compress_lz4
+    WRITERS['lz4'] = _write_lz4
+    READERS.append((b'\x04\x22\x4d\x18', lz4.frame.LZ4FrameFile))
+
+
+def is_supported(compression):
+    """Check if compression can be done in-process"""
+    return compression in WRITERS
+
+
+def get_threads(threads):
+    """Return number of threads to use, where 0 means all available cores"""
+    if threads > 0:
+        return threads
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def open_reader(fobj):
+    """
+    Return file object with decompressed contents of provided buffered file
+    object, recognizing compression by its magic number. Contrary to the
+    tarfile stream mode, it will also read concatenated streams, like ones
+    produced by ParallelWriter, pigz or pbzip2.
+    """
+    header = fobj.peek(6)
+    for magic, reader in READERS:
+        if header.startswith(magic):
+            return reader(fobj)
+    return fobj
+
+
+def open_writer(fobj, compression, threads=1, level=None):
+    """
+    Return file object, which compresses written data into provided file
+    object. Closing it will not close the underlying file object.
+    """
+    threads = get_threads(threads)
+    if threads > 1 and compression in COMPRESSORS:
+        return ParallelWriter(fobj, compression, threads, level)
+    return WRITERS[compression](fobj, threads, level)
+
+
+class ParallelWriter(object):
+    """
+    File-like object, which compresses written data using multiple threads
+    """
+    def __init__(self, fobj, compression, threads, level=None):
+        """
+        Params:
+            fobj:           file object to write compressed data to
+            compression:    one of the COMPRESSORS keys
+            threads:        number of compressing threads
+            level:          compression level, default for the format if
+                            None
+        """
+        self.fobj = fobj
+        self.level = level
+        self.threads = get_threads(threads)
+        self._compress = COMPRESSORS[compression]
+        self._pool = pool.ThreadPool(self.threads)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffer_size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        """Buffer the data, and compress it in blocks"""
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= BLOCK_SIZE:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        """Compress remaining data and wait for all the blocks"""
+        if self.closed:
+            return
+        try:
+            self._submit()
+            while self._pending:
+                self.fobj.write(self._pending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self.closed = True
+
+    def _submit(self):
+        """
+        Pass the buffer to the pool, and write blocks which are done, keeping
+        the number of blocks in memory limited
+        """
+        if self._buffer:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._buffer_size = 0
+            self._pending.append(self._pool.apply_async(self._compress,
+                                                        (data, self.level)))
+
+        while self._pending and (len(self._pending) > 2 * self.threads or
+                                 self._pending[0].ready()):
+            self.fobj.write(self._pending.popleft().get())
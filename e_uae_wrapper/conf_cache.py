@@ -0,0 +1,139 @@
+"""
+Cache of compiled configuration.
+
+Merged global and local configuration is stored with all the templates
+already resolved, except those which depend on per-run values (like
+wrapper_tmp_path). Since relative paths are resolved against current
+directory, entries are kept per config file and current directory. Cached
+entry is invalidated whenever any of the input files is changed, and entries
+for removed or changed files are pruned, when new one is stored.
+"""
+import collections
+import json
+import logging
+import os
+import time
+
+from e_uae_wrapper import utils
+
+
+CACHE_VERSION = 3
+# leftovers of interrupted writes older than that are removed
+TMP_MAX_AGE = 3600
+
+
+def load(conf_file):
+    """
+    Return compiled configuration for provided config file, or None if it's
+    not cached or cache is outdated.
+    """
+    try:
+        with open(_get_cache_file(conf_file)) as fobj:
+            data = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if data.get('key') != _get_key(conf_file):
+        logging.debug("Cached configuration for `%s' is outdated.",
+                      conf_file)
+        return None
+
+    logging.debug("Using cached configuration for `%s'.", conf_file)
+    return collections.OrderedDict(data['config'])
+
+
+def save(conf_file, config):
+    """Store compiled configuration for provided config file"""
+    cache_file = _get_cache_file(conf_file)
+    tmp_file = cache_file + '.%d' % os.getpid()
+    try:
+        with open(tmp_file, 'w') as fobj:
+            json.dump({'key': _get_key(conf_file),
+                       'config': list(config.items())}, fobj)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as err:
+        logging.debug("Cannot store compiled configuration: %s.", err)
+        return
+    _prune(cache_file)
+
+
+def _prune(current):
+    """Remove cache files, which are outdated, except the current one"""
+    cache_dir = os.path.dirname(current)
+    try:
+        fnames = os.listdir(cache_dir)
+    except OSError:
+        return
+    for fname in fnames:
+        fname = os.path.join(cache_dir, fname)
+        if fname == current:
+            continue
+        if not fname.endswith('.json'):
+            try:
+                if time.time() - os.path.getmtime(fname) > TMP_MAX_AGE:
+                    os.unlink(fname)
+            except OSError:
+                pass
+            continue
+
+        try:
+            with open(fname) as fobj:
+                key = json.load(fobj).get('key')
+        except (IOError, OSError, ValueError, AttributeError):
+            key = None
+        if key and key[0] == CACHE_VERSION and _is_current(key):
+            continue
+
+        logging.debug("Removing outdated cached configuration `%s'.", fname)
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
+
+
+def _get_key(conf_file):
+    """
+    Return list of values, which identifies the state of configuration files
+    and current directory, against which relative paths were resolved
+    """
+    key = [CACHE_VERSION, os.getcwd()]
+    for fname in (os.path.abspath(conf_file),
+                  utils.get_common_config_path()):
+        key.append(_get_file_state(fname))
+    return key
+
+
+def _get_file_state(fname):
+    """Return list of file name, size and mtime, latter are None if missing"""
+    try:
+        stat = os.stat(fname)
+        return [fname, stat.st_size, repr(stat.st_mtime)]
+    except OSError:
+        return [fname, None, None]
+
+
+def _is_current(key):
+    """
+    Return True if stored key matches the current state of its files, and
+    config file still exists
+    """
+    try:
+        files = key[2:]
+        if files[0][1] is None or not os.path.isdir(key[1]):
+            return False
+        return all(_get_file_state(x[0]) == x for x in files)
+    except (IndexError, TypeError):
+        return False
+
+
+def _get_cache_file(conf_file):
+    """
+    Return path to the cache file for provided config file and current
+    directory
+    """
+    digest = utils.new_hash()
+    digest.update(os.path.abspath(conf_file).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(os.getcwd().encode('utf-8'))
+    return os.path.join(utils.get_cache_dir('conf'),
+                        digest.hexdigest() + '.json')
@@ -0,0 +1,164 @@
+"""
+Long running wrapper daemon.
+
+Daemon keeps warm state - imported modules, parsed global configuration and
+the tool index - and accepts launch requests from the client over the Unix
+socket. Every request is handled in the forked child, which inherits that
+state, takes over the standard descriptors of the client, and runs the
+configuration just like the wrapper would. Access to the shared caches is
+serialized with the locks, as in the standalone wrapper.
+"""
+import argparse
+import array
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from e_uae_wrapper import client
+from e_uae_wrapper import metrics
+from e_uae_wrapper import path
+from e_uae_wrapper import utils
+from e_uae_wrapper import wrapper
+
+
+# modules imported upfront, so that children don't have to
+MODULES = ['archive', 'plain', 'file_archive', 'manifest', 'materialize',
+           'delta', 'persist', 'sidecar', 'staging', 'store', 'supervisor',
+           'tree_cache']
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server forking for every request"""
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Run configuration requested by the client"""
+
+    def handle(self):
+        fds = _receive_fds(self.connection)
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+
+        # become process group leader, so that client can signal the
+        # whole group, including the emulator
+        os.setpgid(0, 0)
+        self._send({'pid': os.getpid()})
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, fd in enumerate(fds[:3]):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        signal.signal(signal.SIGTERM, _terminate)
+        signal.signal(signal.SIGHUP, _terminate)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        self._send({'exit_code': self._run(request['args'])})
+
+    def _run(self, args):
+        """Run configuration with provided command line arguments"""
+        logging.root.handlers = []
+        try:
+            args = wrapper.parse_args(args)
+            metrics.enable(args.metrics, args.profile)
+            return wrapper.run_config(args.config, args.dry_run)
+        except SystemExit as exc:
+            # i.e. wrong arguments
+            return exc.code if isinstance(exc.code, int) else 1
+        except KeyboardInterrupt:
+            return 130
+        except Exception:
+            logging.exception("Running configuration failed.")
+            return 1
+
+    def _send(self, message):
+        """Send message to the client"""
+        try:
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except (IOError, OSError):
+            logging.debug("Client has gone away.")
+
+
+def _receive_fds(sock):
+    """Receive descriptors sent along with the first byte of the request"""
+    fds = array.array('i')
+    _, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
+def _terminate(signum, _):
+    """Exit on signal, so that temporary files are cleaned up"""
+    sys.exit(128 + signum)
+
+
+def parse_args():
+    """Parse command line arguments for the daemon"""
+    parser = argparse.ArgumentParser(description='Run wrapper daemon.')
+    parser.add_argument('-s', '--socket', help='Path to the socket. Default '
+                        'is %(default)s.', default=client.get_socket_path())
+    parser.add_argument('-v', '--verbose', help='Be verbose. Adding more "v" '
+                        'will increase verbosity', action="count",
+                        default=None)
+    parser.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" will'
+                        ' decrease verbosity', action="count", default=None)
+
+    args = parser.parse_args()
+    wrapper.setup_logger(args)
+    return args
+
+
+def warm_up():
+    """Load everything what can be shared by the requests"""
+    for name in MODULES:
+        importlib.import_module('e_uae_wrapper.' + name)
+    utils.get_common_config()
+    path.get_index()
+
+
+def run():
+    """Run the daemon"""
+    args = parse_args()
+
+    if not client.make_socket_dir(args.socket):
+        logging.error("Directory of the socket `%s' can be written by other "
+                      "users, or cannot be created.", args.socket)
+        sys.exit(1)
+    if client.connect(args.socket):
+        logging.error("Daemon is already running on `%s'.", args.socket)
+        sys.exit(1)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    warm_up()
+
+    umask = os.umask(0o077)
+    server = Server(args.socket, Handler)
+    os.umask(umask)
+    signal.signal(signal.SIGTERM, _terminate)
+    logging.info("Listening on `%s'.", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    run()
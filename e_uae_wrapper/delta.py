@@ -0,0 +1,260 @@
+"""
+Save state of the session, as the difference against the base archive.
+
+Instead of compressing whole tree again, only files added or changed during
+the session (i.e. emulator state files, saved games, changed hard disk
+images) are stored in the small, separate archive, together with the list
+of removed paths (the whiteout file) and modes of directories (the modes
+file). On the next run, it is restored on top
+of the tree extracted out of the base archive. Difference is always taken
+against the base archive, so that save state archive is replaced as a whole,
+and never depends on the previous one.
+
+The same way, persisted data can be stored as the layers next to the base
+archive (<name>.layer-001.<ext>, <name>.layer-002.<ext> and so on), each of
+them holding the difference against the base archive with previous layers
+applied. Layers are applied in order after extracting the base archive, and
+are folded back into it by compaction.
+"""
+import glob
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from e_uae_wrapper import file_archive
+from e_uae_wrapper import manifest
+from e_uae_wrapper import persist
+from e_uae_wrapper import utils
+
+
+WHITEOUT = '.wrapper_whiteout'
+MODES = '.wrapper_modes'
+LAYER_RE = re.compile(r'\.layer-(\d+)\.')
+
+
+def get_changes(base, current):
+    """
+    Compare manifests of the base tree and the current one. Return tuple of
+    sorted lists of paths to be stored, paths to be removed, and tuples of
+    added or changed directories and their modes.
+    """
+    added, modified, deleted = base.diff(current)
+    parents = set(os.path.dirname(x) for x in current.entries)
+
+    stored = []
+    modes = []
+    for rel_path in added + modified:
+        entry = current.entries[rel_path]
+        if entry[0] != 'd':
+            stored.append(rel_path)
+            continue
+        # directories are created along with their contents, only empty ones
+        # need to be stored; modes are set for all of them afterwards
+        if rel_path not in parents:
+            stored.append(rel_path)
+        modes.append((rel_path, entry[1]))
+
+    deleted_set = set(deleted)
+    removed = [x for x in deleted
+               if not any(y in deleted_set for y in _get_parents(x))]
+    return sorted(stored), sorted(removed), sorted(modes)
+
+
+def save(tree, base, save_path, title='', archive_options=None):
+    """
+    Store the difference between base manifest and the tree in the save
+    state archive. Archive is removed, if there is no difference. Return
+    True on success, False otherwise.
+    """
+    current = manifest.Manifest(tree, base.checksum)
+    stored, removed, modes = get_changes(base, current)
+
+    if not stored and not removed and not modes:
+        if os.path.exists(save_path):
+            logging.info("No changes against the base archive, removing "
+                         "`%s'.", save_path)
+            os.unlink(save_path)
+        return True
+
+    logging.debug("Saving %d changed and %d removed paths.", len(stored),
+                  len(removed))
+    whiteout = os.path.join(tree, WHITEOUT)
+    if removed:
+        with open(whiteout, 'w') as fobj:
+            fobj.write(''.join(x + '\n' for x in removed))
+        stored.append(WHITEOUT)
+    modes_file = os.path.join(tree, MODES)
+    if modes:
+        with open(modes_file, 'w') as fobj:
+            fobj.write(''.join('%o %s\n' % (mode, rel_path)
+                               for rel_path, mode in modes))
+        stored.append(MODES)
+
+    try:
+        return persist.make_archive(tree, save_path, title, archive_options,
+                                    use_index=False, files=stored)
+    finally:
+        for fname in (whiteout, modes_file):
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
+def restore(save_path, tree, archive_options=None):
+    """
+    Extract save state archive on top of the tree, remove paths listed in
+    its whiteout file, and set modes of directories listed in its modes
+    file. Files are renamed into place, so that files linked from the cache
+    or the store are replaced, not overwritten. Paths pointing outside of
+    the tree are skipped. Return True on success, False otherwise.
+    """
+    logging.debug("Restoring `%s'.", save_path)
+    staging = tempfile.mkdtemp(prefix='.delta-', dir=tree)
+    try:
+        curdir = os.path.abspath('.')
+        os.chdir(staging)
+        try:
+            if not utils.extract_archive(save_path, **(archive_options or {})):
+                return False
+        finally:
+            os.chdir(curdir)
+
+        whiteout = os.path.join(staging, WHITEOUT)
+        if os.path.exists(whiteout):
+            for path in _read_list(whiteout, tree):
+                _remove(path)
+            os.unlink(whiteout)
+
+        modes = []
+        modes_file = os.path.join(staging, MODES)
+        if os.path.exists(modes_file):
+            modes = _read_list(modes_file, tree, with_mode=True)
+            os.unlink(modes_file)
+
+        _move_tree(staging, tree)
+        for path, mode in modes:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.chmod(path, mode)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return True
+
+
+def get_layers(arch_path):
+    """Return sorted list of paths of the layers of the archive"""
+    stem, ext = _split_ext(arch_path)
+    layers = glob.glob(glob.escape(stem) + '.layer-[0-9][0-9][0-9].' + ext)
+    return sorted(layers, key=_get_layer_number)
+
+
+def get_layer_path(arch_path, number):
+    """Return path of the layer with provided number"""
+    stem, ext = _split_ext(arch_path)
+    return '%s.layer-%03d.%s' % (stem, number, ext)
+
+
+def get_next_layer_path(arch_path):
+    """Return path for the new layer, on top of existing ones"""
+    layers = get_layers(arch_path)
+    number = _get_layer_number(layers[-1]) + 1 if layers else 1
+    return get_layer_path(arch_path, number)
+
+
+def _read_list(fname, tree, with_mode=False):
+    """
+    Return list of absolute paths out of the whiteout file, or tuples of
+    paths and modes out of the modes file, skipping paths which point
+    outside of the tree
+    """
+    result = []
+    with open(fname) as fobj:
+        for line in fobj:
+            line = line.rstrip('\n')
+            mode = None
+            if with_mode:
+                mode, _, line = line.partition(' ')
+                try:
+                    mode = int(mode, 8)
+                except ValueError:
+                    line = ''
+            path = _get_safe_path(tree, line)
+            if path is None:
+                logging.warning("Skipping wrong path `%s' in `%s'.", line,
+                                os.path.basename(fname))
+                continue
+            result.append((path, mode) if with_mode else path)
+    return result
+
+
+def _get_safe_path(tree, rel_path):
+    """
+    Return absolute path for the path relative to the tree, or None if it
+    is empty or points outside of the tree, also through the symlinks
+    """
+    rel_path = os.path.normpath(rel_path)
+    if (not rel_path or rel_path == '.' or os.path.isabs(rel_path) or
+            rel_path == '..' or rel_path.startswith('..' + os.sep)):
+        return None
+    root = os.path.realpath(tree)
+    parent = os.path.realpath(os.path.join(tree, os.path.dirname(rel_path)))
+    if parent != root and not parent.startswith(root + os.sep):
+        return None
+    return os.path.join(parent, os.path.basename(rel_path))
+
+
+def _get_parents(rel_path):
+    """Yield parent directories of the relative path"""
+    rel_path = os.path.dirname(rel_path)
+    while rel_path:
+        yield rel_path
+        rel_path = os.path.dirname(rel_path)
+
+
+def _split_ext(arch_path):
+    """Return the archive path without extension, and the extension"""
+    ext = file_archive.get_extension(arch_path)
+    return arch_path[:len(arch_path) - len(ext)].rstrip('.'), ext
+
+
+def _get_layer_number(layer_path):
+    """Return number of the layer out of its path"""
+    return int(LAYER_RE.search(os.path.basename(layer_path)).group(1))
+
+
+def _move_tree(src, dst):
+    """Move contents of src directory into dst, replacing existing paths"""
+    directories = []
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        for name in list(dirs):
+            path = os.path.join(root, name)
+            target = os.path.normpath(os.path.join(dst, rel_root, name))
+            if os.path.islink(path):
+                # not followed by walk, moved as a file
+                files.append(name)
+                continue
+            if not os.path.isdir(target) or os.path.islink(target):
+                _remove(target)
+                os.mkdir(target)
+                # attributes of existing directories are set by the modes
+                # file, as directories are created along with their
+                # contents during extraction
+                directories.append((path, target))
+
+        for name in files:
+            target = os.path.normpath(os.path.join(dst, rel_root, name))
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.rename(os.path.join(root, name), target)
+
+    for path, target in reversed(directories):
+        shutil.copystat(path, target)
+
+
+def _remove(path):
+    """Remove file, symlink or directory, if it exists"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
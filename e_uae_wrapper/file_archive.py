@@ -1,21 +1,51 @@
 """
 File archive classes
 """
+import io
 import os
 import subprocess
 import re
 import logging
-
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+
+from e_uae_wrapper import compress
+from e_uae_wrapper import metrics
 from e_uae_wrapper import path
+from e_uae_wrapper import sparse
+from e_uae_wrapper import utils
+
+
+BUFSIZE = 1024 * 1024
+NATIVE = 'native'
+EXTERNAL = 'external'
 
 
 class Archive(object):
     """Base class for archive support"""
     ADD = ['a']
     EXTRACT = ['x']
+    TEST = None
     ARCH = 'false'
 
-    def __init__(self):
+    def __init__(self, threads=1, level=None, verify=False):
+        """
+        Params:
+            threads:    number of threads used for compression, 0 means all
+                        available cores
+            level:      compression level, None for the format default
+            verify:     verify archive while it's being created, if
+                        supported
+        """
+        self.threads = compress.get_threads(threads)
+        self.level = level
+        self.verify = verify
+        # result of verification and hash of the created archive, if known
+        self.verified = None
+        self.digest = None
         self.archiver = path.which(self.ARCH)
         self._compress = self.archiver
         self._decompress = self.archiver
@@ -27,8 +57,7 @@ class Archive(object):
         files = files if files else ['.']
         logging.debug("Calling `%s %s %s %s'.", self._compress,
                       " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress] + self.ADD + [arch_name]
-                                 + files)
+        result = _call([self._compress] + self.ADD + [arch_name] + files)
         if result != 0:
             logging.error("Unable to create archive `%s'.", arch_name)
             return False
@@ -42,46 +71,126 @@ class Archive(object):
             logging.error("Archive `%s' doesn't exists.", arch_name)
             return False
 
-        logging.debug("Calling `%s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name)
-        result = subprocess.call([self._decompress] + self.EXTRACT +
-                                 [arch_name])
+        logging.debug("Calling `%s %s %s'.", self._decompress,
+                      " ".join(self.EXTRACT), arch_name)
+        result = _call([self._decompress] + self.EXTRACT + [arch_name])
         if result != 0:
             logging.error("Unable to extract archive `%s'.", arch_name)
             return False
         return True
 
+    def check(self, arch_name):
+        """
+        Test integrity of the archive. Return True if archive is correct or
+        it cannot be tested, False otherwise.
+        """
+        if not self.TEST:
+            logging.debug("Cannot test `%s', format has no test command.",
+                          arch_name)
+            return True
+
+        logging.debug("Calling `%s %s %s'.", self._decompress,
+                      " ".join(self.TEST), arch_name)
+        return _call([self._decompress] + self.TEST + [arch_name],
+                     quiet=True) == 0
+
 
 class TarArchive(Archive):
     ADD = ['cf']
     EXTRACT = ['xf']
+    TEST = ['tf']
     ARCH = 'tar'
+    # compressor program, and its parallel variant with argument for number
+    # of threads
+    COMPRESSOR = None
+    PARALLEL = None
+
+    def __init__(self, threads=1, level=None, verify=False):
+        super(TarArchive, self).__init__(threads, level, verify)
+        if not self.COMPRESSOR:
+            return
+
+        if not path.which(self.COMPRESSOR):
+            self.archiver = None
+            return
+
+        program = self.COMPRESSOR
+        if self.threads > 1 and self.PARALLEL:
+            if path.has_capability(self.PARALLEL.split()[0], 'threads'):
+                program = self.PARALLEL % self.threads
+            else:
+                logging.debug("Cannot find `%s', using single threaded "
+                              "compression.", self.PARALLEL.split()[0])
+
+        if self.level is not None:
+            program += ' -%d' % self.level
+
+        if program != self.COMPRESSOR:
+            self.ADD = ['-I', program, '-cf']
 
     def create(self, arch_name, files=None):
         files = files if files else sorted(os.listdir('.'))
-        logging.debug("Calling `%s %s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress] + self.ADD + [arch_name] +
-                                 files)
+        # keep holes of hard disk images, if supported
+        options = ['--sparse'] if path.has_capability('tar', 'sparse') else []
+        logging.debug("Calling `%s %s %s %s %s'.", self._compress,
+                      " ".join(self.ADD), arch_name, " ".join(options),
+                      " ".join(files))
+        result = _call([self._compress] + self.ADD + [arch_name] + options +
+                       files)
         if result != 0:
             logging.error("Unable to create archive `%s'.", arch_name)
             return False
         return True
 
+    def check(self, arch_name):
+        """
+        Read the archive back, decompressing it in-process if possible, or
+        with tar otherwise
+        """
+        try:
+            self.digest, _ = _read_tar(arch_name)
+            return True
+        except ValueError:
+            # compression not supported in-process
+            return super(TarArchive, self).check(arch_name)
+        except (IOError, OSError, EOFError) as err:
+            logging.error("Archive `%s' is broken: %s.", arch_name, err)
+            return False
+
 
 class TarGzipArchive(TarArchive):
     ADD = ['zcf']
+    COMPRESSOR = 'gzip'
+    PARALLEL = 'pigz -p %d'
 
 
 class TarBzip2Archive(TarArchive):
     ADD = ['jcf']
+    COMPRESSOR = 'bzip2'
+    PARALLEL = 'pbzip2 -p%d'
 
 
 class TarXzArchive(TarArchive):
     ADD = ['Jcf']
+    COMPRESSOR = 'xz'
+    PARALLEL = 'xz -T %d'
+
+
+class TarZstdArchive(TarArchive):
+    ADD = ['-I', 'zstd', '-cf']
+    EXTRACT = ['-I', 'zstd', '-xf']
+    COMPRESSOR = 'zstd'
+    PARALLEL = 'zstd -T%d'
+
+
+class TarLz4Archive(TarArchive):
+    ADD = ['-I', 'lz4', '-cf']
+    EXTRACT = ['-I', 'lz4', '-xf']
+    COMPRESSOR = 'lz4'
 
 
 class LhaArchive(Archive):
+    TEST = ['t']
     ARCH = 'lha'
 
 
@@ -89,15 +198,19 @@ class ZipArchive(Archive):
     ADD = ['a', '-tzip']
     ARCH = ['7z', 'zip']
 
-    def __init__(self):
-        super(ZipArchive, self).__init__()
-        if self.archiver == 'zip':
+    def __init__(self, threads=1, level=None, verify=False):
+        super(ZipArchive, self).__init__(threads, level, verify)
+        if os.path.basename(self.archiver or '') == 'zip':
             self._decompress = path.which('unzip')
             ZipArchive.ADD = ['-r']
             ZipArchive.EXTRACT = []
 
+    def check(self, arch_name):
+        return _check_zip(arch_name)
+
 
 class SevenZArchive(Archive):
+    TEST = ['t']
     ARCH = '7z'
 
 
@@ -113,49 +226,423 @@ class LzxArchive(Archive):
 
 
 class RarArchive(Archive):
+    TEST = ['t']
     ARCH = ['rar', 'unrar']
 
     def create(self, arch_name, files=None):
         files = files if files else sorted(os.listdir('.'))
-        if self.archiver == 'unrar':
+        if not path.has_capability(os.path.basename(self.archiver or ''),
+                                   'create'):
             logging.error('Cannot create RAR archive. Only extracting is'
                           'supported by unrar.')
             return False
 
         logging.debug("Calling `%s %s %s %s'.", self._compress,
                       " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress] + self.ADD + [arch_name] +
-                                 files)
+        result = _call([self._compress] + self.ADD + [arch_name] + files)
         if result != 0:
             logging.error("Unable to create archive `%s'.", arch_name)
             return False
         return True
 
 
+class _TarFile(tarfile.TarFile):
+    """TarFile, which leaves holes in place of blocks of zeros"""
+
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None:
+            return super(_TarFile, self).makefile(tarinfo, targetpath)
+
+        self.fileobj.seek(tarinfo.offset_data)
+        with open(targetpath, 'wb', BUFSIZE) as target:
+            try:
+                sparse.copy(self.fileobj, target, tarinfo.size)
+            except IOError as err:
+                raise tarfile.ReadError(str(err))
+
+
+class NativeTarArchive(Archive):
+    """
+    In-process tar support. Members are streamed one by one, without keeping
+    the listing of the whole archive in memory. Sparse files are stored in
+    GNU sparse format, and holes are preserved during extraction.
+
+    When verification is requested, tar stream is hashed while it's written,
+    and the archive is read back, decompressed and hashed again by the
+    separate thread, following the file as it grows.
+    """
+    ARCH = 'tarfile'
+    MODE = ''
+
+    def __init__(self, threads=1, level=None, verify=False):
+        self.threads = compress.get_threads(threads)
+        self.level = level
+        self.verify = verify
+        self.verified = None
+        self.digest = None
+        self.archiver = self.ARCH
+        self._compress = self.archiver
+        self._decompress = self.archiver
+
+    def create(self, arch_name, files=None):
+        files = files if files else sorted(os.listdir('.'))
+        logging.debug("Creating `%s' with %s out of %s.", arch_name,
+                      self.ARCH, " ".join(files))
+        verifier = None
+        try:
+            with open(arch_name, 'wb', BUFSIZE) as fobj:
+                if self.verify:
+                    verifier = _Verifier(arch_name)
+                if not self.MODE:
+                    self._create(_HashingWriter(fobj), files, verifier)
+                else:
+                    logging.debug("Compressing with %d threads.",
+                                  self.threads)
+                    with compress.open_writer(fobj, self.MODE, self.threads,
+                                              self.level) as stream:
+                        self._create(_HashingWriter(stream), files,
+                                     verifier)
+        except (IOError, OSError, tarfile.TarError) as err:
+            logging.error("Unable to create archive `%s': %s.", arch_name,
+                          err)
+            if verifier:
+                verifier.finish()
+            return False
+
+        if verifier:
+            self.verified = verifier.finish()
+            self.digest = verifier.digest
+        return True
+
+    def extract(self, arch_name):
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return False
+
+        logging.debug("Extracting `%s' with %s.", arch_name, self.ARCH)
+        directories = []
+        try:
+            with open(arch_name, 'rb', BUFSIZE) as fobj:
+                with _TarFile.open(fileobj=compress.open_reader(fobj),
+                                   mode='r|', bufsize=BUFSIZE) as tar:
+                    for member in tar:
+                        if member.isdir():
+                            directories.append((member.name, member.mode,
+                                                member.mtime))
+                        self._extract_member(tar, member)
+                        # don't collect listing of the archive
+                        tar.members = []
+            _set_dir_attrs(directories)
+        except (IOError, OSError, tarfile.TarError) as err:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          err)
+            return False
+        return True
+
+    def extract_members(self, arch_name, offsets):
+        """
+        Extract only members starting at provided offsets of uncompressed
+        tar archive. Return True on success, False otherwise.
+        """
+        logging.debug("Extracting %d members of `%s' with %s.", len(offsets),
+                      arch_name, self.ARCH)
+        directories = []
+        try:
+            with _TarFile.open(arch_name, mode='r:') as tar:
+                for offset in offsets:
+                    tar.fileobj.seek(offset)
+                    member = tarfile.TarInfo.fromtarfile(tar)
+                    if member.isdir():
+                        directories.append((member.name, member.mode,
+                                            member.mtime))
+                    self._extract_member(tar, member)
+            _set_dir_attrs(directories)
+        except (IOError, OSError, tarfile.TarError) as err:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          err)
+            return False
+        return True
+
+    def check(self, arch_name):
+        """
+        Return result of the verification done during creating the archive,
+        or read the archive back
+        """
+        if self.verified is not None:
+            return self.verified
+        try:
+            self.digest, _ = _read_tar(arch_name)
+        except (IOError, OSError, EOFError, ValueError) as err:
+            logging.error("Archive `%s' is broken: %s.", arch_name, err)
+            return False
+        return True
+
+    @classmethod
+    def available(cls):
+        """Check if compression is supported in-process"""
+        return not cls.MODE or compress.is_supported(cls.MODE)
+
+    def _create(self, fobj, files, verifier=None):
+        """
+        Write tar stream with provided files to the hashing file object, and
+        pass its hash to the verifier
+        """
+        with tarfile.open(fileobj=fobj, mode='w|', bufsize=BUFSIZE,
+                          format=tarfile.PAX_FORMAT) as tar:
+            for fname in files:
+                self._add(tar, fname)
+        if verifier:
+            verifier.expected = fobj.hexdigest()
+
+    def _add(self, tar, fname):
+        """Add file or directory recursively to the archive"""
+        tarinfo = tar.gettarinfo(fname)
+        if tarinfo is None:
+            logging.warning("Skipping unsupported file `%s'.", fname)
+            return
+
+        if tarinfo.isreg():
+            with open(fname, 'rb', BUFSIZE) as fobj:
+                if sparse.is_sparse(fname):
+                    fobj = sparse.get_sparse_tarinfo(tarinfo, fobj)
+                tar.addfile(tarinfo, fobj)
+        else:
+            tar.addfile(tarinfo)
+        tar.members = []
+
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(fname)):
+                self._add(tar, os.path.join(fname, name))
+
+    def _extract_member(self, tar, member):
+        """Extract single member, leaving directory attributes for later"""
+        kwargs = {'set_attrs': not member.isdir()}
+        if hasattr(tarfile, 'tar_filter'):
+            kwargs['filter'] = 'tar'
+        tar.extract(member, **kwargs)
+
+
+class NativeTarGzipArchive(NativeTarArchive):
+    MODE = 'gz'
+
+
+class NativeTarBzip2Archive(NativeTarArchive):
+    MODE = 'bz2'
+
+
+class NativeTarXzArchive(NativeTarArchive):
+    MODE = 'xz'
+
+
+class NativeTarZstdArchive(NativeTarArchive):
+    MODE = 'zst'
+
+
+class NativeTarLz4Archive(NativeTarArchive):
+    MODE = 'lz4'
+
+
+class NativeZipArchive(Archive):
+    """In-process zip support"""
+    ARCH = 'zipfile'
+
+    def __init__(self, threads=1, level=None, verify=False):
+        self.threads = compress.get_threads(threads)
+        self.level = level
+        self.verify = verify
+        self.verified = None
+        self.digest = None
+        self.archiver = self.ARCH
+        self._compress = self.archiver
+        self._decompress = self.archiver
+
+    def create(self, arch_name, files=None):
+        files = files if files else sorted(os.listdir('.'))
+        logging.debug("Creating `%s' with %s out of %s.", arch_name,
+                      self.ARCH, " ".join(files))
+        kwargs = {}
+        if self.level is not None:
+            kwargs['compresslevel'] = self.level
+        try:
+            with zipfile.ZipFile(arch_name, 'w', zipfile.ZIP_DEFLATED,
+                                 allowZip64=True, **kwargs) as zobj:
+                for fname in files:
+                    self._add(zobj, fname)
+        except (IOError, OSError, zipfile.BadZipfile) as err:
+            logging.error("Unable to create archive `%s': %s.", arch_name,
+                          err)
+            return False
+        return True
+
+    def extract(self, arch_name):
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return False
+
+        logging.debug("Extracting `%s' with %s.", arch_name, self.ARCH)
+        directories = []
+        try:
+            with zipfile.ZipFile(arch_name) as zobj:
+                for info in zobj.infolist():
+                    self._extract_member(zobj, info, directories)
+            _set_dir_attrs(directories)
+        except (IOError, OSError, zipfile.BadZipfile) as err:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          err)
+            return False
+        return True
+
+    def extract_members(self, arch_name, names):
+        """
+        Extract only members with provided names (paths relative to the
+        archive root). Return True on success, False otherwise.
+        """
+        logging.debug("Extracting %d members of `%s' with %s.", len(names),
+                      arch_name, self.ARCH)
+        directories = []
+        try:
+            with zipfile.ZipFile(arch_name) as zobj:
+                members = set(zobj.namelist())
+                for name in names:
+                    if name not in members:
+                        name += '/'
+                        if name not in members:
+                            # directory without its own member
+                            continue
+                    self._extract_member(zobj, zobj.getinfo(name),
+                                         directories)
+            _set_dir_attrs(directories)
+        except (IOError, OSError, zipfile.BadZipfile) as err:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          err)
+            return False
+        return True
+
+    def check(self, arch_name):
+        return _check_zip(arch_name)
+
+    @classmethod
+    def available(cls):
+        """Zip is always supported"""
+        return True
+
+    def _add(self, zobj, fname):
+        """Add file or directory recursively to the archive"""
+        if os.path.islink(fname):
+            # stored as the link, not as the file it points to
+            stat_res = os.lstat(fname)
+            info = zipfile.ZipInfo(fname,
+                                   time.localtime(stat_res.st_mtime)[:6])
+            info.create_system = 3
+            info.external_attr = stat_res.st_mode << 16
+            zobj.writestr(info, os.readlink(fname))
+            return
+
+        zobj.write(fname)
+        if os.path.isdir(fname):
+            for name in sorted(os.listdir(fname)):
+                self._add(zobj, os.path.join(fname, name))
+
+    def _extract_member(self, zobj, info, directories):
+        """
+        Extract single member preserving its mode, modification time and
+        symlinks.
+        """
+        name = _safe_path(info.filename)
+        if name is None or not _is_inside(os.path.dirname(name) or '.'):
+            logging.warning("Skipping member with unsafe path `%s'.",
+                            info.filename)
+            return
+
+        mode = info.external_attr >> 16
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+
+        if info.filename.endswith('/'):
+            if not _is_inside(name):
+                logging.warning("Skipping member with unsafe path `%s'.",
+                                info.filename)
+                return
+            if not os.path.isdir(name):
+                os.makedirs(name)
+            directories.append((name, stat.S_IMODE(mode) if mode else 0o755,
+                                mtime))
+            return
+
+        dirname = os.path.dirname(name)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        if os.path.islink(name):
+            # never write through the symlink extracted before
+            os.unlink(name)
+
+        if stat.S_ISLNK(mode):
+            target = zobj.read(info).decode('utf-8')
+            if os.path.isabs(target) or _safe_path(
+                    os.path.join(os.path.dirname(name), target)) is None:
+                logging.warning("Skipping symlink `%s' pointing outside of "
+                                "the archive (`%s').", info.filename, target)
+                return
+            os.symlink(target, name)
+            return
+
+        with zobj.open(info) as src, open(name, 'wb', BUFSIZE) as dst:
+            sparse.copy(src, dst)
+
+        if mode:
+            os.chmod(name, stat.S_IMODE(mode))
+        os.utime(name, (mtime, mtime))
+
+
 class Archivers(object):
-    """Archivers class"""
-    archivers = [{'arch': TarArchive, 'name': 'tar', 'ext': ['tar']},
-                 {'arch': TarGzipArchive, 'name': 'tgz',
-                  'ext': ['tar.gz', 'tgz']},
-                 {'arch': TarBzip2Archive, 'name': 'tar.bz2',
-                  'ext': ['tar.bz2']},
-                 {'arch': TarXzArchive, 'name': 'tar.xz', 'ext': ['tar.xz']},
+    """
+    Archivers class. Formats which can be handled in-process have also
+    defined native archiver class, which is used by default.
+    """
+    archivers = [{'arch': TarArchive, 'native': NativeTarArchive,
+                  'name': 'tar', 'ext': ['tar']},
+                 {'arch': TarGzipArchive, 'native': NativeTarGzipArchive,
+                  'name': 'tgz', 'ext': ['tar.gz', 'tgz']},
+                 {'arch': TarBzip2Archive, 'native': NativeTarBzip2Archive,
+                  'name': 'tar.bz2', 'ext': ['tar.bz2']},
+                 {'arch': TarXzArchive, 'native': NativeTarXzArchive,
+                  'name': 'tar.xz', 'ext': ['tar.xz']},
+                 {'arch': TarZstdArchive, 'native': NativeTarZstdArchive,
+                  'name': 'tar.zst', 'ext': ['tar.zst', 'tzst']},
+                 {'arch': TarLz4Archive, 'native': NativeTarLz4Archive,
+                  'name': 'tar.lz4', 'ext': ['tar.lz4']},
                  {'arch': RarArchive, 'name': 'rar', 'ext': ['rar']},
                  {'arch': SevenZArchive, 'name': '7z', 'ext': ['7z']},
-                 {'arch': ZipArchive, 'name': 'zip', 'ext': ['zip']},
+                 {'arch': ZipArchive, 'native': NativeZipArchive,
+                  'name': 'zip', 'ext': ['zip']},
                  {'arch': LhaArchive, 'name': 'lha', 'ext': ['lha', 'lzh']},
                  {'arch': LzxArchive, 'name': 'lzx', 'ext': ['lzx']}]
 
     @classmethod
-    def get(cls, extension):
+    def get(cls, extension, backend=NATIVE):
         """
-        Get the archive class or None
+        Get the archive class or None. For native backend, in-process
+        archiver is returned if available for the format, external one
+        otherwise.
         """
         for arch in cls.archivers:
             if extension in arch['ext']:
+                native = arch.get('native')
+                if backend == NATIVE and native and native.available():
+                    return native
                 return arch['arch']
         return None
 
+    @classmethod
+    def get_name(cls, extension):
+        """
+        Get the name of the archive format for provided extension, or None
+        """
+        for arch in cls.archivers:
+            if extension in arch['ext']:
+                return arch['name']
+        return None
+
     @classmethod
     def get_extension_by_name(cls, name):
         """
@@ -167,28 +654,259 @@ class Archivers(object):
         return None
 
 
-def get_archiver(arch_name):
-    """Return right class for provided archive file name"""
+def get_archiver(arch_name, backend=NATIVE, **options):
+    """
+    Return right class for provided archive file name. Backend can be either
+    `native' for using in-process archivers where possible, or `external'
+    for always using external programs. Rest of the options are passed to
+    the archiver class.
+    """
 
-    _, ext = os.path.splitext(arch_name)
-    re_tar = re.compile('.*(.[tT][aA][rR].[^.]+$)')
-    result = re_tar.match(arch_name)
-
-    if result:
-        ext = result.groups()[0]
-
-    if ext:
-        ext = ext[1:]
-
-    archiver = Archivers.get(ext)
+    ext = get_extension(arch_name)
+    archiver = Archivers.get(ext, backend)
     if not archiver:
         logging.error("Unable find archive type for `%s'.", arch_name)
         return None
 
-    archobj = archiver()
+    archobj = archiver(**options)
     if archobj.archiver is None:
         logging.error("Unable find executable for operating on files `*%s'.",
                       ext)
         return None
 
     return archobj
+
+
+def get_extension(arch_name):
+    """
+    Return extension of the archive file name, without leading dot,
+    including .tar part for compressed tar archives (i.e. tar.bz2)
+    """
+    _, ext = os.path.splitext(arch_name)
+    re_tar = re.compile('.*(.[tT][aA][rR].[^.]+$)')
+    result = re_tar.match(arch_name)
+
+    if result:
+        ext = result.groups()[0]
+
+    return ext[1:] if ext else ext
+
+
+def _call(cmd, quiet=False):
+    """
+    Run the archiver program and return its exit code. If quiet is set, its
+    output is discarded. Peak RSS and CPU times of the program itself are
+    added to its metrics record.
+    """
+    with metrics.measure('archiver', command=cmd[0]) as info:
+        devnull = open(os.devnull, 'w') if quiet else None
+        try:
+            proc = subprocess.Popen(cmd, stdout=devnull)
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            if devnull:
+                devnull.close()
+
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        info.update({'peak_rss_kb': usage.ru_maxrss,
+                     'cpu_user': round(usage.ru_utime, 6),
+                     'cpu_system': round(usage.ru_stime, 6)})
+        return proc.returncode
+
+
+class _HashingWriter(object):
+    """File-like object, which hashes the data written to it"""
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self._hash = utils.new_hash()
+
+    def write(self, data):
+        self._hash.update(data)
+        return self.fobj.write(data)
+
+    def hexdigest(self):
+        """Return hash of the data written so far"""
+        return self._hash.hexdigest()
+
+
+class _FollowReader(io.RawIOBase):
+    """
+    Raw reader of the file, which is still being written. Reading waits for
+    more data, until writer is done. Read data is hashed.
+    """
+    def __init__(self, fname, done):
+        """
+        Params:
+            fname:  path to the file
+            done:   event set, when file is completely written
+        """
+        super(_FollowReader, self).__init__()
+        self.fobj = open(fname, 'rb', 0)
+        self.done = done
+        self.hash = utils.new_hash()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            finished = self.done.is_set()
+            size = self.fobj.readinto(buf)
+            if size:
+                self.hash.update(memoryview(buf)[:size])
+                return size
+            if finished:
+                return 0
+            self.done.wait(0.01)
+
+    def close(self):
+        self.fobj.close()
+        super(_FollowReader, self).close()
+
+
+class _Verifier(threading.Thread):
+    """
+    Thread reading back the tar archive while it's being created, and
+    comparing hash of its decompressed contents with the hash of the written
+    tar stream
+    """
+    def __init__(self, fname):
+        super(_Verifier, self).__init__()
+        self.daemon = True
+        self.fname = fname
+        self.done = threading.Event()
+        # hash of the written tar stream, set by the writer
+        self.expected = None
+        self.digest = None
+        self.error = None
+        self.result = None
+        self.start()
+
+    def run(self):
+        raw = _FollowReader(self.fname, self.done)
+        try:
+            self.result = _read_back(raw)
+            self.digest = raw.hash.hexdigest()
+        except Exception as err:
+            self.error = err
+        finally:
+            raw.close()
+
+    def finish(self):
+        """
+        Wait for the verification, after file was closed by the writer.
+        Return True if archive contents matches written data.
+        """
+        self.done.set()
+        self.join()
+        if self.error is not None:
+            logging.error("Archive `%s' cannot be read back: %s.",
+                          self.fname, self.error)
+            return False
+        if self.result != self.expected:
+            logging.error("Contents of archive `%s' doesn't match written "
+                          "data.", self.fname)
+            return False
+        logging.debug("Archive `%s' verified.", self.fname)
+        return True
+
+
+def _read_back(raw):
+    """
+    Decompress tar archive read from the raw reader till its end. Return
+    hash of the tar stream. Raise ValueError if compression is not supported
+    in-process.
+    """
+    buffered = io.BufferedReader(raw, BUFSIZE)
+    stream = compress.open_reader(buffered)
+    header = b''
+    while len(header) < tarfile.BLOCKSIZE:
+        data = stream.read(tarfile.BLOCKSIZE - len(header))
+        if not data:
+            break
+        header += data
+    # archive of the empty tree has only the end-of-archive blocks
+    if (header[257:262] != b'ustar' and
+            header != b'\0' * tarfile.BLOCKSIZE):
+        raise ValueError("not a tar stream")
+
+    digest = utils.new_hash()
+    digest.update(header)
+    while True:
+        data = stream.read(BUFSIZE)
+        if not data:
+            break
+        digest.update(data)
+    # whatever is left after the compressed stream, so that whole file is
+    # hashed
+    while buffered.read(BUFSIZE):
+        pass
+    return digest.hexdigest()
+
+
+def _read_tar(arch_name):
+    """
+    Read the tar archive and decompress its contents. Return tuple of hashes
+    of the archive file and the tar stream. Raise ValueError if compression
+    is not supported in-process.
+    """
+    done = threading.Event()
+    done.set()
+    raw = _FollowReader(arch_name, done)
+    try:
+        stream_digest = _read_back(raw)
+    finally:
+        raw.close()
+    return raw.hash.hexdigest(), stream_digest
+
+
+def _check_zip(arch_name):
+    """Test CRC of all the members of zip archive"""
+    try:
+        with zipfile.ZipFile(arch_name) as zobj:
+            bad = zobj.testzip()
+    except (IOError, OSError, zipfile.BadZipfile) as err:
+        logging.error("Archive `%s' is broken: %s.", arch_name, err)
+        return False
+    if bad is not None:
+        logging.error("Member `%s' of archive `%s' is broken.", bad,
+                      arch_name)
+        return False
+    return True
+
+
+def _safe_path(name):
+    """
+    Return normalized relative path for the archive member, or None if it
+    points outside of the current directory.
+    """
+    name = os.path.normpath(name.lstrip('/'))
+    if name == '..' or name.startswith('..' + os.sep) or os.path.isabs(name):
+        return None
+    return name
+
+
+def _is_inside(path, root='.'):
+    """Check if path, with all symlinks resolved, is inside of the root"""
+    root = os.path.realpath(root)
+    path = os.path.realpath(path)
+    return path == root or path.startswith(root + os.sep)
+
+
+def _set_dir_attrs(directories):
+    """
+    Set modes and modification times of the extracted directories, after
+    their contents was extracted. Directories are the list of tuples with
+    name, mode and modification time.
+    """
+    for name, mode, mtime in sorted(directories, reverse=True):
+        name = os.path.normpath(name.lstrip('/'))
+        try:
+            os.chmod(name, mode)
+            os.utime(name, (mtime, mtime))
+        except OSError as err:
+            logging.warning("Cannot set attributes of `%s': %s.", name, err)
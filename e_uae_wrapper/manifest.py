@@ -0,0 +1,79 @@
+"""
+Manifest of the directory tree, used for detecting changes made during
+emulator session
+"""
+import os
+import stat
+
+from e_uae_wrapper import utils
+
+
+EXCLUDE = ['.uaerc']
+
+
+class Manifest(object):
+    """
+    Snapshot of the directory tree - its paths, sizes and modification times
+    of the files, and optionally content hashes. If hashes are enabled, they
+    are used instead of the modification times for detecting changed files.
+    """
+    def __init__(self, path, checksum=False, exclude=None):
+        """
+        Params:
+            path:       root of the tree
+            checksum:   compute hashes of file contents
+            exclude:    list of paths, relative to the root, to be skipped
+        """
+        self.path = path
+        self.checksum = checksum
+        self.exclude = EXCLUDE if exclude is None else exclude
+        self.entries = {}
+        self._scan()
+
+    def __eq__(self, other):
+        return self.entries == other.entries
+
+    def __ne__(self, other):
+        return not self == other
+
+    def diff(self, other):
+        """
+        Compare with other (newer) manifest. Return tuple of sorted lists of
+        added, modified and deleted paths.
+        """
+        added = [x for x in other.entries if x not in self.entries]
+        deleted = [x for x in self.entries if x not in other.entries]
+        modified = [x for x in other.entries if x in self.entries and
+                    other.entries[x] != self.entries[x]]
+        return sorted(added), sorted(modified), sorted(deleted)
+
+    def _scan(self):
+        """Gather information about all the items in the tree"""
+        for root, dirs, files in os.walk(self.path):
+            rel_root = os.path.relpath(root, self.path)
+            if rel_root == '.':
+                rel_root = ''
+
+            for name in dirs + files:
+                rel_path = os.path.join(rel_root, name)
+                if rel_path in self.exclude:
+                    continue
+                self.entries[rel_path] = self._get_entry(os.path.join(root,
+                                                                      name))
+
+    def _get_entry(self, path):
+        """Return comparable description of the tree item"""
+        stat_res = os.lstat(path)
+
+        if stat.S_ISLNK(stat_res.st_mode):
+            return ('l', os.readlink(path))
+
+        if stat.S_ISDIR(stat_res.st_mode):
+            return ('d', stat.S_IMODE(stat_res.st_mode))
+
+        if self.checksum:
+            return ('f', stat.S_IMODE(stat_res.st_mode), stat_res.st_size,
+                    utils.file_digest(path))
+
+        return ('f', stat.S_IMODE(stat_res.st_mode), stat_res.st_size,
+                stat_res.st_mtime)
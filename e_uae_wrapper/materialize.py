@@ -0,0 +1,173 @@
+"""
+Populate session directory out of the pristine tree without copying data
+where possible.
+
+Files are cloned with copy-on-write reflinks (FICLONE ioctl) on filesystems
+which support it (btrfs, xfs, ...). Otherwise files which are mounted by the
+emulator as read only are hardlinked, and only the rest is copied, keeping
+holes of sparse files.
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+
+from e_uae_wrapper import sparse
+from e_uae_wrapper import utils
+
+
+FICLONE = 0x40049409
+NO_REFLINK_ERRNOS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                     errno.ENOTTY, errno.EPERM)
+
+
+class Materializer(object):
+    """Populate directory with the contents of the source tree"""
+
+    def __init__(self, readonly=None):
+        """
+        Params:
+            readonly:   list of paths relative to the tree root, which will
+                        not be written to, and can be hardlinked
+        """
+        self.readonly = [os.path.normpath(x) for x in readonly or []]
+        self.reflink = True
+        self.hardlink = True
+
+    def populate(self, src, dst):
+        """Populate existing dst directory with contents of src directory"""
+        directories = []
+        for root, dirs, files in os.walk(src):
+            rel_root = os.path.relpath(root, src)
+            target = os.path.normpath(os.path.join(dst, rel_root))
+
+            for dname in dirs:
+                src_path = os.path.join(root, dname)
+                dst_path = os.path.join(target, dname)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), dst_path)
+                else:
+                    os.mkdir(dst_path)
+                    directories.append((src_path, dst_path))
+
+            for fname in files:
+                src_path = os.path.join(root, fname)
+                dst_path = os.path.join(target, fname)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), dst_path)
+                else:
+                    self.copy(src_path, dst_path,
+                              os.path.normpath(os.path.join(rel_root,
+                                                            fname)))
+
+        # set attributes once directories are filled, they might be read only
+        for src_path, dst_path in reversed(directories):
+            shutil.copystat(src_path, dst_path)
+
+    def copy(self, src, dst, rel_path):
+        """Materialize single file, using the cheapest available method"""
+        if self.reflink and self._clone(src, dst):
+            return
+
+        if self._is_readonly(rel_path) and self._link(src, dst):
+            return
+
+        sparse.copy_file(src, dst)
+
+    def copy_object(self, src, dst, rel_path, mode, mtime):
+        """
+        Materialize single file out of the stored object, setting its mode
+        and modification time (in nanoseconds). Object is hardlinked only if
+        it already has the same attributes.
+        """
+        if not (self.reflink and self._clone(src, dst)):
+            stat_res = os.stat(src)
+            if (self._is_readonly(rel_path) and
+                    stat.S_IMODE(stat_res.st_mode) == mode and
+                    stat_res.st_mtime_ns == mtime and self._link(src, dst)):
+                return
+            sparse.copy_file(src, dst)
+
+        os.chmod(dst, mode)
+        os.utime(dst, ns=(mtime, mtime))
+
+    def _link(self, src, dst):
+        """Try to hardlink the src file. Return True on success."""
+        if not self.hardlink:
+            return False
+        try:
+            os.link(src, dst)
+        except OSError as err:
+            logging.debug("Cannot hardlink `%s': %s, copying files "
+                          "instead.", src, err)
+            self.hardlink = False
+        return self.hardlink
+
+    def _clone(self, src, dst):
+        """Try to make a reflink of the src file. Return True on success."""
+        with open(src, 'rb') as src_obj, open(dst, 'wb') as dst_obj:
+            try:
+                fcntl.ioctl(dst_obj.fileno(), FICLONE, src_obj.fileno())
+            except (IOError, OSError) as err:
+                if err.errno not in NO_REFLINK_ERRNOS:
+                    raise
+                logging.debug("Reflinks are not supported: %s.", err)
+                self.reflink = False
+
+        if not self.reflink:
+            os.unlink(dst)
+            return False
+
+        shutil.copystat(src, dst)
+        return True
+
+    def _is_readonly(self, rel_path):
+        """Check if file lies in one of the read only paths"""
+        for path in self.readonly:
+            if rel_path == path or rel_path.startswith(path + os.sep) or \
+                    path == '.':
+                return True
+        return False
+
+
+def get_readonly_paths(config, root):
+    """
+    Return list of paths relative to the root, which are mounted read only
+    by the emulator according to filesystem and hardfile options.
+    """
+    return get_mounted_paths(config, root, readonly=True)
+
+
+def get_mounted_paths(config, root, keys=None, readonly=False):
+    """
+    Return list of paths relative to the root, which are mounted by the
+    emulator according to options listed in keys (filesystem and hardfile
+    options by default). If readonly is set to True, only read only paths are
+    returned.
+    """
+    result = []
+    for key in keys or utils.DUP_KEYS:
+        values = config.get(key, [])
+        if not isinstance(values, list):
+            values = [values]
+
+        for value in values:
+            fields = value.split(',')
+            if len(fields) < 2 or (readonly and fields[0] != 'ro'):
+                continue
+
+            if key == 'filesystem':
+                path = fields[1].split(':', 1)[-1]
+            elif key == 'filesystem2':
+                path = fields[1].split(':', 2)[-1]
+            elif key == 'hardfile':
+                path = fields[-1]
+            else:
+                path = fields[1].split(':', 1)[-1]
+
+            rel_path = os.path.relpath(os.path.abspath(path), root)
+            if rel_path != '..' and not rel_path.startswith('..' + os.sep):
+                result.append(rel_path)
+    return result
@@ -0,0 +1,134 @@
+"""
+Timing and resource usage instrumentation.
+
+For every measured phase, wall time, CPU time (of the process and its
+finished children), and bytes read and written are recorded, together with
+the high-water mark of RSS of the process (and the biggest of its finished
+children) so far. Kernel reports only the peak over the whole lifetime of
+the process, so it's not the memory used by in-process phase itself. Phases
+running a single program (archiver, emulator) add its own peak RSS as
+peak_rss_kb.
+Records are written as JSON lines, one record per phase, and/or logged in
+human readable form.
+"""
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_STATE = {'output': None, 'profile': False, 'context': {}}
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def enable(metrics_file=None, profile=False):
+    """
+    Enable collecting metrics. Records will be appended to metrics_file if
+    provided, and printed to stderr if profile is set to True.
+    """
+    if metrics_file:
+        _STATE['output'] = open(metrics_file, 'a')
+    _STATE['profile'] = profile
+
+
+def is_enabled():
+    """Check if metrics are collected"""
+    return bool(_STATE['output'] or _STATE['profile'])
+
+
+def set_context(**context):
+    """Set additional information added to every record, like config path"""
+    _STATE['context'] = context
+
+
+@contextlib.contextmanager
+def measure(name, **info):
+    """
+    Measure the resources used by the code in the with block. Info
+    dictionary is returned, so that the block can add its own details to the
+    record.
+    """
+    if not is_enabled():
+        yield info
+        return
+
+    start = _snapshot()
+    try:
+        yield info
+    finally:
+        _record(name, start, _snapshot(), info)
+
+
+def phase(name):
+    """Decorator for measuring the resources used by the function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _snapshot():
+    """Return current values of the counters"""
+    data = {'time': time.time(), 'wall': _clock(), 'cpu_self': 0.0,
+            'cpu_children': 0.0, 'lifetime_max_rss_kb': 0}
+
+    if resource:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        data['cpu_self'] = own.ru_utime + own.ru_stime
+        data['cpu_children'] = children.ru_utime + children.ru_stime
+        data['lifetime_max_rss_kb'] = max(own.ru_maxrss, children.ru_maxrss)
+
+    # I/O of finished children is accounted to the parent as well
+    try:
+        with open('/proc/self/io') as fobj:
+            for line in fobj:
+                key, val = line.split(':')
+                if key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+                    data[key] = int(val)
+    except (IOError, OSError):
+        pass
+
+    return data
+
+
+def _record(name, start, end, info):
+    """Write the record for the measured phase"""
+    record = {'phase': name,
+              'pid': os.getpid(),
+              'time': start['time'],
+              'wall': round(end['wall'] - start['wall'], 6),
+              'cpu_self': round(end['cpu_self'] - start['cpu_self'], 6),
+              'cpu_children': round(end['cpu_children'] -
+                                    start['cpu_children'], 6),
+              'lifetime_max_rss_kb': end['lifetime_max_rss_kb']}
+    record['cpu'] = round(record['cpu_self'] + record['cpu_children'], 6)
+    for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+        if key in start and key in end:
+            record[key] = end[key] - start[key]
+    record.update(_STATE['context'])
+    record.update(info)
+
+    if _STATE['output']:
+        _STATE['output'].write(json.dumps(record, sort_keys=True) + '\n')
+        _STATE['output'].flush()
+
+    if _STATE['profile']:
+        own_rss = ''
+        if 'peak_rss_kb' in record:
+            own_rss = ' (own %dKiB)' % record['peak_rss_kb']
+        sys.stderr.write("%-16s wall: %9.3fs cpu: %9.3fs read: %12s "
+                         "written: %12s lifetime max rss: %8dKiB%s\n" %
+                         (name, record['wall'], record['cpu'],
+                          record.get('read_bytes', '-'),
+                          record.get('write_bytes', '-'),
+                          record['lifetime_max_rss_kb'], own_rss))
@@ -1,22 +1,214 @@
 """
 Misc utilities
+
+Executables are looked up in the index of resolved tools, instead of scanning
+all the $PATH entries every time. Index contains absolute paths of the known
+archivers, their versions and capabilities, and is stored in the user cache
+directory. It is rebuilt whenever $PATH or any of its directories changes.
 """
+import json
+import logging
 import os
+import re
+import subprocess
+
+
+INDEX_VERSION = 2
+VERSION_RE = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+
+# known tools with the arguments for getting their version and the
+# capabilities they always have
+TOOLS = {'tar': (['--version'], ['create', 'extract']),
+         'gzip': (['--version'], ['create', 'extract']),
+         'pigz': (['--version'], ['create', 'extract', 'threads']),
+         'bzip2': (['--help'], ['create', 'extract']),
+         'pbzip2': (['-V'], ['create', 'extract', 'threads']),
+         'xz': (['--version'], ['create', 'extract']),
+         'zstd': (['--version'], ['create', 'extract', 'threads']),
+         'lz4': (['--version'], ['create', 'extract']),
+         '7z': ([], ['create', 'extract', 'threads']),
+         'zip': (['-v'], ['create']),
+         'unzip': (['-v'], ['extract']),
+         'rar': ([], ['create', 'extract']),
+         'unrar': ([], ['extract']),
+         'lha': (['--version'], ['create', 'extract']),
+         'unlzx': ([], ['extract'])}
+
+# capabilities available since given version
+VERSIONED_CAPABILITIES = {'xz': [((5, 2), 'threads')],
+                          'tar': [((1, 31), 'zstd')]}
+# capabilities available if version output contains given text
+MARKER_CAPABILITIES = {'tar': [('GNU tar', 'sparse')]}
+
+_INDEX = {}
+
+
+class ToolIndex(object):
+    """Index of resolved executables"""
+    def __init__(self, path_env=None):
+        """
+        Params:
+            path_env:   value of $PATH, current environment is used if not
+                        provided
+        """
+        if path_env is None:
+            path_env = os.environ.get('PATH', os.defpath)
+        self.dirs = [x.strip('"') for x in path_env.split(os.pathsep) if x]
+        self.key = self._get_key()
+        self.tools = {}
+        if not self._load():
+            self.build()
+            self._save()
+
+    def get(self, name):
+        """
+        Return dictionary with path, version and capabilities of the tool,
+        or None if it is not available.
+        """
+        if name not in self.tools:
+            # tool not known upfront, just find it and remember
+            fname = self._find(name)
+            self.tools[name] = ({'path': fname, 'version': None,
+                                 'capabilities': []} if fname else None)
+            self._save()
+        return self.tools[name]
+
+    def build(self):
+        """Find all the known tools and check their versions"""
+        logging.debug("Building index of tools.")
+        self.tools = {}
+        for name, (version_args, capabilities) in TOOLS.items():
+            fname = self._find(name)
+            if not fname:
+                self.tools[name] = None
+                continue
+
+            output = _get_version_output(fname, version_args)
+            version = _get_version(output)
+            capabilities = list(capabilities)
+            for marker, capability in MARKER_CAPABILITIES.get(name, []):
+                if marker in output:
+                    capabilities.append(capability)
+            for min_version, capability in VERSIONED_CAPABILITIES.get(name,
+                                                                      []):
+                if version and _parse_version(version) >= min_version:
+                    capabilities.append(capability)
+
+            self.tools[name] = {'path': fname, 'version': version,
+                                'capabilities': sorted(capabilities)}
+
+    def _find(self, name):
+        """Scan $PATH for executable name. Return absolute path or None"""
+        for dirname in self.dirs:
+            fname = os.path.join(dirname, name)
+            if os.path.isfile(fname) and os.access(fname, os.X_OK):
+                return os.path.abspath(fname)
+        return None
+
+    def _get_key(self):
+        """Return hash of $PATH directories and their modification times"""
+        from e_uae_wrapper import utils
+
+        digest = utils.new_hash()
+        digest.update(str(INDEX_VERSION).encode('utf-8'))
+        for dirname in self.dirs:
+            try:
+                mtime = repr(os.stat(dirname).st_mtime)
+            except OSError:
+                mtime = '-'
+            digest.update(('%s\0%s\0' % (dirname, mtime)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _get_index_file(self):
+        """Return path to the index file"""
+        from e_uae_wrapper import utils
+
+        return os.path.join(utils.get_cache_dir('tools'), self.key + '.json')
+
+    def _load(self):
+        """Load index from the cache. Return True on success"""
+        try:
+            with open(self._get_index_file()) as fobj:
+                self.tools = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return False
+        return True
+
+    def _save(self):
+        """Store index in the cache, and remove outdated ones"""
+        try:
+            index_file = self._get_index_file()
+            tmp_file = index_file + '.%d' % os.getpid()
+            with open(tmp_file, 'w') as fobj:
+                json.dump(self.tools, fobj)
+            os.rename(tmp_file, index_file)
+
+            dirname = os.path.dirname(index_file)
+            for fname in os.listdir(dirname):
+                if fname.endswith('.json') and fname != self.key + '.json':
+                    os.unlink(os.path.join(dirname, fname))
+        except (IOError, OSError) as err:
+            logging.debug("Cannot store index of tools: %s.", err)
+
+
+def _get_version_output(fname, args):
+    """Run the tool to get its version. Return its output"""
+    try:
+        proc = subprocess.Popen([fname] + args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate(b'')[0]
+    except OSError:
+        return ''
+    return out.decode('utf-8', 'replace')
+
+
+def _get_version(output):
+    """Return version string found in the output or None"""
+    match = VERSION_RE.search(output)
+    return match.group(0) if match else None
+
+
+def _parse_version(version):
+    """Return version string as tuple of integers"""
+    match = VERSION_RE.search(version)
+    if not match:
+        return ()
+    return tuple(int(x) for x in match.groups() if x is not None)
+
+
+def get_index():
+    """Return tool index for current $PATH, loaded once per process"""
+    path_env = os.environ.get('PATH', os.defpath)
+    if path_env not in _INDEX:
+        _INDEX.clear()
+        _INDEX[path_env] = ToolIndex(path_env)
+    return _INDEX[path_env]
+
+
+def get_tool(name):
+    """Return information about tool (see ToolIndex.get) or None"""
+    return get_index().get(name)
+
+
+def has_capability(name, capability):
+    """Check if tool is available, and have provided capability"""
+    tool = get_tool(name)
+    return bool(tool and capability in tool['capabilities'])
 
 
 def which(executables):
     """
-    Check if there selected archiver is available in the system and place it
-    to the archiver attribute
+    Return absolute path of the first of provided executables available in
+    the system, or None if there is none of them.
     """
 
     if not isinstance(executables, list):
         executables = [executables]
 
     for fname in executables:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = os.path.join(path.strip('"'), fname)
-            if os.path.isfile(path) and os.access(path, os.X_OK):
-                return fname
+        tool = get_tool(fname)
+        if tool:
+            return tool['path']
 
     return None
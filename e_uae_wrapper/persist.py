@@ -0,0 +1,330 @@
+"""
+Persisting changed data back into the archive.
+
+Archive can be created right away, or by detached worker process, so that
+the wrapper can exit just after the emulator. In the latter case job is
+described by the journal file in $XDG_CACHE_HOME/e-uae-wrapper/persist, and
+guarded by the lock held by whoever processes it. Journal records the state
+of the job:
+
+    pending     - tree is waiting for compression, archive is untouched
+    archived    - new archive is complete, and waits for replacing the
+                  original one
+
+Interrupted job is resumed from the recorded state by the next worker or the
+next run of the same archive, or rolled back if its tree is gone, leaving
+the original archive untouched.
+
+New archive is always written into temporary directory next to the
+original one, so that it can be atomically renamed over it, without copying
+it between filesystems.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from e_uae_wrapper import file_archive
+from e_uae_wrapper import metrics
+from e_uae_wrapper import sidecar
+from e_uae_wrapper import store
+from e_uae_wrapper import utils
+
+
+PENDING = 'pending'
+ARCHIVED = 'archived'
+
+
+def make_archive(tree, arch_filepath, title='', archive_options=None,
+                 use_store=False, use_index=True, files=None, obsolete=None):
+    """
+    Create archive out of the tree, and replace arch_filepath with it.
+    Return True on success, False otherwise.
+
+    Params:
+        tree:               directory with the files to archive
+        arch_filepath:      absolute path to the archive to replace
+        title:              title for the GUI message
+        archive_options:    dictionary with backend, threads and level for
+                            the archiver
+        use_store:          add contents of the tree to the content
+                            addressed store
+        use_index:          write sidecar index of the new archive
+        files:              paths relative to the tree to be archived,
+                            whole tree by default
+        obsolete:           files to be removed, once archive is replaced
+    """
+    tmp_archive = _get_tmp_archive(arch_filepath)
+    try:
+        archiver = _create(tree, tmp_archive, title, archive_options or {},
+                           files)
+        if archiver is None or not _replace(tmp_archive, arch_filepath):
+            return False
+    finally:
+        # nothing to retry without the journal, don't leave it behind
+        _discard(tmp_archive)
+    _remove_obsolete(obsolete)
+    if use_index:
+        _write_index(tree, arch_filepath, archiver.digest)
+    if use_store:
+        _add_to_store(tree, arch_filepath)
+    return True
+
+
+def submit(tree, arch_filepath, title='', archive_options=None,
+           use_store=False, use_index=True, obsolete=None):
+    """
+    Record the job in the journal, and start detached worker for it. Tree is
+    owned by the worker afterwards, and will be removed when job is done.
+    Return True on success, False otherwise.
+    """
+    job_file = get_job_file(arch_filepath)
+    job = {'state': PENDING,
+           'tree': tree,
+           'archive': arch_filepath,
+           'tmp_archive': None,
+           'title': title,
+           'options': archive_options or {},
+           'store': use_store,
+           'index': use_index,
+           'obsolete': obsolete or []}
+
+    with utils.lock_file(job_file + '.lock'):
+        if not _save_job(job_file, job):
+            return False
+
+    devnull = open(os.devnull, 'r+')
+    try:
+        subprocess.Popen([sys.executable, '-m', 'e_uae_wrapper.persist',
+                          job_file], stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid)
+    except OSError as err:
+        logging.warning("Cannot start background worker (%s), archive "
+                        "will be created on the next run.", err)
+    finally:
+        devnull.close()
+
+    logging.info("Archive `%s' will be created in the background.",
+                 arch_filepath)
+    return True
+
+
+def wait(arch_filepath):
+    """
+    Wait for the pending background job for the archive, or process it if
+    it was interrupted. Either way, archive is in consistent state
+    afterwards.
+    """
+    job_file = get_job_file(arch_filepath)
+    if os.path.exists(job_file):
+        logging.info("Waiting for pending save of `%s'.", arch_filepath)
+        run_job(job_file)
+
+
+def run_job(job_file):
+    """Process the job described by the journal file"""
+    with utils.lock_file(job_file + '.lock'):
+        try:
+            with open(job_file) as fobj:
+                job = json.load(fobj)
+        except (IOError, OSError):
+            # already done
+            return True
+        except ValueError:
+            logging.error("Journal `%s' is broken, removing.", job_file)
+            os.unlink(job_file)
+            return False
+
+        if job['state'] == PENDING:
+            if not os.path.isdir(job['tree']):
+                logging.warning("Files for `%s' are gone, leaving archive "
+                                "untouched.", job['archive'])
+                os.unlink(job_file)
+                return False
+
+            if job['tmp_archive']:
+                # leftover of interrupted compression
+                _discard(job['tmp_archive'])
+
+            job['tmp_archive'] = _get_tmp_archive(job['archive'])
+            if not _save_job(job_file, job):
+                _discard(job['tmp_archive'])
+                return False
+
+            archiver = _create(job['tree'], job['tmp_archive'],
+                               job['title'], job['options'])
+            if archiver is None:
+                logging.error("Unable to create archive `%s', leaving it "
+                              "untouched. Changed files are kept in `%s'.",
+                              job['archive'], job['tree'])
+                _discard(job['tmp_archive'])
+                os.unlink(job_file)
+                return False
+
+            job['state'] = ARCHIVED
+            job['digest'] = archiver.digest
+            if not _save_job(job_file, job):
+                return False
+
+        if job['state'] == ARCHIVED:
+            # archive might be already renamed, if job was interrupted after
+            # that
+            if not os.path.exists(job['tmp_archive']):
+                _discard(job['tmp_archive'])
+            elif not _replace(job['tmp_archive'], job['archive']):
+                return False
+            _remove_obsolete(job.get('obsolete'))
+            if job.get('index', True) and os.path.isdir(job['tree']):
+                _write_index(job['tree'], job['archive'], job.get('digest'))
+            if job.get('store') and os.path.isdir(job['tree']):
+                _add_to_store(job['tree'], job['archive'])
+            shutil.rmtree(job['tree'], ignore_errors=True)
+
+        os.unlink(job_file)
+    return True
+
+
+def get_job_file(arch_filepath):
+    """Return path to the journal file for provided archive"""
+    digest = utils.new_hash()
+    digest.update(os.path.abspath(arch_filepath).encode('utf-8'))
+    return os.path.join(utils.get_cache_dir('persist'),
+                        digest.hexdigest() + '.json')
+
+
+def _get_tmp_archive(arch_filepath):
+    """
+    Create temporary directory next to the archive, and return path for the
+    new archive in it, before it replaces the original
+    """
+    dirname, basename = os.path.split(arch_filepath)
+    tmp_dir = tempfile.mkdtemp(prefix='.%s.' % basename, dir=dirname)
+    return os.path.join(tmp_dir, basename)
+
+
+def _replace(tmp_archive, arch_filepath):
+    """
+    Make sure new archive is on the disk, and atomically rename it over the
+    original one. Return True on success, False otherwise.
+    """
+    try:
+        with open(tmp_archive, 'rb') as fobj:
+            os.fsync(fobj.fileno())
+        os.rename(tmp_archive, arch_filepath)
+        _fsync_dir(os.path.dirname(arch_filepath))
+    except (IOError, OSError) as err:
+        logging.error("Cannot replace archive `%s': %s.", arch_filepath, err)
+        return False
+
+    _discard(tmp_archive)
+    return True
+
+
+def _discard(tmp_archive):
+    """Remove temporary directory with the new archive"""
+    shutil.rmtree(os.path.dirname(tmp_archive), ignore_errors=True)
+
+
+def _fsync_dir(dirname):
+    """Flush directory entries to the disk"""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _create(tree, arch_name, title, archive_options, files=None):
+    """
+    Create archive out of the tree contents (or provided files relative to
+    the tree), and verify it, if requested by verify archive option. Return
+    the archiver on success, None otherwise.
+    """
+    archiver = file_archive.get_archiver(arch_name, **archive_options)
+    if archiver is None:
+        return None
+
+    if title:
+        logging.info("Creating archive for `%s'. Please be patient.", title)
+    curdir = os.path.abspath('.')
+    os.chdir(tree)
+    try:
+        if os.path.exists('.uaerc'):
+            os.unlink('.uaerc')
+        with metrics.measure('archive_create', archive=arch_name,
+                             archiver=type(archiver).__name__):
+            if not archiver.create(arch_name, files):
+                return None
+    finally:
+        os.chdir(curdir)
+
+    if archiver.verify:
+        with metrics.measure('archive_verify', archive=arch_name,
+                             archiver=type(archiver).__name__):
+            if not archiver.check(arch_name):
+                logging.error("Verification of the new archive `%s' "
+                              "failed.", arch_name)
+                return None
+    return archiver
+
+
+def _remove_obsolete(paths):
+    """Remove files made obsolete by the new archive"""
+    for path in paths or []:
+        if os.path.exists(path):
+            logging.debug("Removing obsolete `%s'.", path)
+            os.unlink(path)
+
+
+def _add_to_store(tree, arch_filepath):
+    """Add contents of the tree to the store, as the new archive contents"""
+    try:
+        store.Store().add_tree(tree, arch_filepath)
+    except (IOError, OSError) as err:
+        logging.warning("Cannot add `%s' to the store: %s.", arch_filepath,
+                        err)
+
+
+def _write_index(tree, arch_filepath, digest=None):
+    """
+    Write sidecar index of the new archive out of the tree, with the hash of
+    the archive, if it was verified
+    """
+    try:
+        index = sidecar.build(arch_filepath, tree)
+        index.digest = digest
+        index.save()
+    except (IOError, OSError) as err:
+        logging.warning("Cannot index `%s': %s.", arch_filepath, err)
+
+
+def _save_job(job_file, job):
+    """Write the journal atomically"""
+    tmp_file = job_file + '.%d' % os.getpid()
+    try:
+        with open(tmp_file, 'w') as fobj:
+            json.dump(job, fobj)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.rename(tmp_file, job_file)
+    except (IOError, OSError) as err:
+        logging.error("Cannot write journal `%s': %s.", job_file, err)
+        return False
+    return True
+
+
+def run():
+    """Run background worker for the journal file passed as argument"""
+    job_file = sys.argv[1]
+    logging.basicConfig(filename=os.path.splitext(job_file)[0] + '.log',
+                        level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+    sys.exit(0 if run_job(job_file) else 1)
+
+
+if __name__ == "__main__":
+    run()
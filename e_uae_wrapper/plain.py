@@ -11,7 +11,7 @@ Unlike other modules, there is no path changing during running e-uae.
 import os
 
 from e_uae_wrapper import base
-from e_uae_wrapper import utils
+from e_uae_wrapper import metrics
 
 
 class Wrapper(base.Base):
@@ -24,12 +24,20 @@ class Wrapper(base.Base):
         if not super(Wrapper, self).run():
             return False
 
-        self._run_emulator()
+        return self._run_emulator()
 
     def _validate_options(self):
-        """No options needed for this module"""
-        return True
+        """Only scheduling options of the emulator are validated"""
+        from e_uae_wrapper import supervisor
+
+        # logs the reason
+        return supervisor.get_options(self.config) is not None
 
+    @metrics.phase('run_emulator')
     def _run_emulator(self):
         """execute e-uae"""
-        utils.run_command(['e-uae', '-f', os.path.join(self.dir, '.uaerc')])
+        from e_uae_wrapper import supervisor
+
+        supervisor.run(['e-uae', '-f', os.path.join(self.dir, '.uaerc')],
+                       self.config)
+        return True
@@ -0,0 +1,353 @@
+"""
+Recompress archives of the whole library into one format.
+
+Archives referenced by wrapper_archive option of the configurations are
+converted in the pool of worker processes into the target format (i.e. one
+which is fast to extract, or one which can be persisted back, unlike lzx).
+Every archive is extracted, packed into the new format next to the original
+one, and the new archive is extracted again and compared with the original
+contents, file by file, including their hashes. Only if they are the same,
+configurations are pointed to the new archive, by atomically replacing
+their files. Original archives are left in place, unless requested
+otherwise.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from e_uae_wrapper import batch
+from e_uae_wrapper import delta
+from e_uae_wrapper import file_archive
+from e_uae_wrapper import manifest
+from e_uae_wrapper import persist
+from e_uae_wrapper import sidecar
+from e_uae_wrapper import staging
+from e_uae_wrapper import utils
+from e_uae_wrapper import wrapper
+
+
+ARCHIVE_KEY = 'wrapper_archive'
+
+
+def parse_args():
+    """Parse command line arguments for the recompression"""
+    parser = argparse.ArgumentParser(description='Recompress archives used '
+                                     'by e-uae configurations.')
+    parser.add_argument('configs', nargs='+', help='Configuration files, or '
+                        'directories containing them.')
+    parser.add_argument('-f', '--format', default='tar.zst',
+                        help='Target archive format. Default is '
+                        '"%(default)s".')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Number of archives recompressed at the same '
+                        'time. Defaults to number of CPU cores.')
+    parser.add_argument('-p', '--pattern', default='*.uaerc',
+                        help='Pattern for configuration files searched in '
+                        'directories. Default is "%(default)s".')
+    parser.add_argument('-b', '--backend', default=file_archive.NATIVE,
+                        choices=[file_archive.NATIVE, file_archive.EXTERNAL],
+                        help='Archivers backend. Default is "%(default)s".')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Compression threads for each archive. Default '
+                        '%(default)s.')
+    parser.add_argument('-l', '--level', type=int, help='Compression level, '
+                        'default for the format if not set.')
+    parser.add_argument('--remove', action='store_true', help='Remove '
+                        'original archives, after configurations are '
+                        'updated.')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only '
+                        'show what would be recompressed.')
+    parser.add_argument('-r', '--report', help='Write report in JSON format '
+                        'to provided file.')
+    parser.add_argument('-v', '--verbose', help='Be verbose. Adding more "v" '
+                        'will increase verbosity', action="count",
+                        default=None)
+    parser.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" will'
+                        ' decrease verbosity', action="count", default=None)
+
+    args = parser.parse_args()
+    wrapper.setup_logger(args)
+    return args
+
+
+def get_archives(configs):
+    """
+    Return dictionary of absolute archive paths and lists of configuration
+    files referencing them
+    """
+    result = {}
+    for conf_file in configs:
+        try:
+            value = _get_archive_value(conf_file)
+        except (IOError, OSError, ValueError) as err:
+            logging.warning("Cannot read `%s': %s.", conf_file, err)
+            continue
+
+        if value is None:
+            continue
+        if '{{' in value:
+            logging.warning("Skipping `%s', archive path `%s' contains "
+                            "templates.", conf_file, value)
+            continue
+
+        arch_path = os.path.join(os.path.dirname(conf_file), value)
+        result.setdefault(os.path.normpath(arch_path), []).append(conf_file)
+    return result
+
+
+def get_target(arch_path, fmt):
+    """
+    Return path of the archive in the target format, or None if archive is
+    in that format already
+    """
+    ext = file_archive.get_extension(arch_path)
+    if file_archive.Archivers.get_name(ext) == fmt:
+        return None
+    return (arch_path[:len(arch_path) - len(ext)].rstrip('.') +
+            file_archive.Archivers.get_extension_by_name(fmt))
+
+
+def recompress(job):
+    """
+    Recompress single archive into the target one, and verify its contents.
+    Return dictionary with the archive paths, sizes, time spent and the
+    error, if any.
+    """
+    arch_path, target, options = job
+    start = time.time()
+    result = {'archive': arch_path, 'target': target, 'error': None,
+              'size': None, 'target_size': None}
+    if os.path.exists(target):
+        result['error'] = "target already exists"
+        result['time'] = 0
+        return result
+
+    try:
+        result['size'] = os.path.getsize(arch_path)
+        result['error'] = _recompress(arch_path, target, options)
+    except Exception as err:
+        logging.exception("Recompressing `%s' failed.", arch_path)
+        result['error'] = str(err)
+
+    if result['error'] is None:
+        result['target_size'] = os.path.getsize(target)
+    else:
+        _remove(target)
+    result['time'] = round(time.time() - start, 3)
+    return result
+
+
+def _recompress(arch_path, target, options):
+    """
+    Convert the archive and compare contents of both. Return None on
+    success, or the error message.
+    """
+    tmp_dir = _make_tmp_dir(arch_path)
+    if tmp_dir is None:
+        return "no space for extracting archive"
+    try:
+        tree = os.path.join(tmp_dir, 'src')
+        os.mkdir(tree)
+        if not _extract(arch_path, tree, options):
+            return "cannot extract archive"
+        original = manifest.Manifest(tree, checksum=True)
+
+        if not persist.make_archive(tree, target, '', options):
+            return "cannot create archive"
+
+        check_tree = os.path.join(tmp_dir, 'check')
+        os.mkdir(check_tree)
+        if not _extract(target, check_tree, options):
+            return "cannot extract new archive"
+        converted = manifest.Manifest(check_tree, checksum=True)
+        if converted != original:
+            added, modified, deleted = original.diff(converted)
+            logging.error("Contents of `%s' differ from `%s': added %s, "
+                          "modified %s, deleted %s.", target, arch_path,
+                          added, modified, deleted)
+            return "contents differ"
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return None
+
+
+def _make_tmp_dir(arch_path):
+    """Create temporary directory for both extracted archives"""
+    size = staging.estimate_size(arch_path)
+    if size is not None:
+        size *= 2
+    tmp_dir = staging.select_dir(size)
+    if tmp_dir is None:
+        return None
+    return tempfile.mkdtemp(prefix='recompress-', dir=tmp_dir)
+
+
+def _extract(arch_path, tree, options):
+    """Extract archive into the tree"""
+    curdir = os.path.abspath('.')
+    os.chdir(tree)
+    try:
+        return utils.extract_archive(arch_path, **options)
+    finally:
+        os.chdir(curdir)
+
+
+def _remove(arch_path):
+    """Remove archive and its index, if they exist"""
+    for fname in (arch_path, sidecar.get_index_file(arch_path)):
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+
+def run_pool(jobs, processes=0):
+    """Recompress archives in the pool of processes. Return the results"""
+    processes = processes or multiprocessing.cpu_count()
+    results = []
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        for result in pool.imap_unordered(recompress, jobs):
+            if result['error']:
+                logging.error("Cannot recompress `%s': %s.",
+                              result['archive'], result['error'])
+            else:
+                logging.info("`%s' recompressed into `%s' in %.3fs.",
+                             result['archive'], result['target'],
+                             result['time'])
+            results.append(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return sorted(results, key=lambda x: x['archive'])
+
+
+def update_config(conf_file, target):
+    """
+    Point wrapper_archive option of the configuration to the target
+    archive, replacing the file atomically. Return True on success.
+    """
+    value = _get_archive_value(conf_file)
+    new_value = os.path.join(os.path.dirname(value),
+                             os.path.basename(target))
+    dirname = os.path.dirname(conf_file)
+
+    fd, tmp_file = tempfile.mkstemp(prefix='.%s.' %
+                                    os.path.basename(conf_file), dir=dirname)
+    try:
+        with open(conf_file) as src, os.fdopen(fd, 'w') as dst:
+            for line in src:
+                if line.split('=', 1)[0].strip() == ARCHIVE_KEY:
+                    line = '%s=%s\n' % (ARCHIVE_KEY, new_value)
+                dst.write(line)
+            dst.flush()
+            os.fsync(dst.fileno())
+        shutil.copymode(conf_file, tmp_file)
+        os.rename(tmp_file, conf_file)
+    except (IOError, OSError) as err:
+        logging.error("Cannot update `%s': %s.", conf_file, err)
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        return False
+    logging.debug("`%s' points to `%s' now.", conf_file, new_value)
+    return True
+
+
+def _get_archive_value(conf_file):
+    """Return value of wrapper_archive option of the configuration file"""
+    with open(conf_file) as fobj:
+        for line in fobj:
+            key, _, val = line.strip().partition('=')
+            if key == ARCHIVE_KEY:
+                return val
+    return None
+
+
+def print_summary(results):
+    """Print summary of the recompression"""
+    width = max(len(x['archive']) for x in results)
+    for result in results:
+        if result['error']:
+            status = 'failed: %s' % result['error']
+        else:
+            status = '%d -> %d bytes' % (result['size'],
+                                         result['target_size'])
+        sys.stdout.write("%-*s  %8.3fs  %s\n" % (width, result['archive'],
+                                                 result['time'], status))
+    failed = len([x for x in results if x['error']])
+    sys.stdout.write("%d archives, %d failed.\n" % (len(results), failed))
+
+
+def run():
+    """Recompress archives of provided configurations"""
+    args = parse_args()
+    if not file_archive.Archivers.get_extension_by_name(args.format):
+        logging.error("Unknown archive format `%s'.", args.format)
+        sys.exit(2)
+
+    archives = get_archives(batch.get_configs(args.configs, args.pattern))
+    options = {'backend': args.backend, 'threads': args.threads,
+               'level': args.level}
+    targets = {}
+    for arch_path in sorted(archives):
+        target = get_target(arch_path, args.format)
+        if target is None:
+            logging.debug("`%s' is in %s format already.", arch_path,
+                          args.format)
+        elif not os.path.exists(arch_path):
+            logging.warning("Archive `%s' doesn't exists.", arch_path)
+        elif delta.get_layers(arch_path):
+            # layers have to be in the same format as the archive
+            logging.warning("Skipping `%s', it has layers which are not "
+                            "compacted yet.", arch_path)
+        else:
+            targets.setdefault(target, []).append(arch_path)
+
+    jobs = []
+    for target, arch_paths in sorted(targets.items()):
+        if len(arch_paths) > 1:
+            # i.e. game.lha and game.zip
+            logging.error("Skipping %s, all of them would be recompressed "
+                          "into `%s'.", ", ".join(arch_paths), target)
+            continue
+        jobs.append((arch_paths[0], target, options))
+
+    if not jobs:
+        logging.info("Nothing to recompress.")
+        return
+
+    if args.dry_run:
+        for arch_path, target, _ in jobs:
+            sys.stdout.write("%s -> %s (%s)\n" %
+                             (arch_path, target,
+                              ", ".join(archives[arch_path])))
+        return
+
+    results = run_pool(jobs, args.jobs)
+    for result in results:
+        if result['error']:
+            continue
+        configs = archives[result['archive']]
+        updated = [update_config(x, result['target']) for x in configs]
+        if args.remove and all(updated):
+            _remove(result['archive'])
+            logging.info("Removed `%s'.", result['archive'])
+    print_summary(results)
+
+    if args.report:
+        with open(args.report, 'w') as fobj:
+            json.dump({'results': results}, fobj, indent=2)
+
+    if [x for x in results if x['error']]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,250 @@
+"""
+Sidecar index of the archive.
+
+Index is kept next to the archive, in the hidden file named after it (i.e.
+.game.tar.bz2.index for game.tar.bz2), and describes archive contents -
+directories, symlinks, and files with their modes, sizes and content hashes
+(only if they were computed anyway, files are not read just for the index).
+For uncompressed tar and zip archives, offsets of the members are recorded
+as well, so that part of the archive can be extracted without reading all
+of it. Index is valid as long as size and modification time of the archive
+are the same as recorded.
+
+Index is written when archive is extracted for the first time, and every
+time the archive is created out of the session directory. It is used for
+estimating space needed for extraction, for checking if paths used in the
+configuration exist in the archive before anything is extracted, and for
+selective extraction.
+"""
+import json
+import logging
+import os
+import stat
+import tarfile
+import zipfile
+
+
+INDEX_VERSION = 1
+EXCLUDE = ['.uaerc']
+# formats with random access to the members
+TAR = 'tar'
+ZIP = 'zip'
+
+
+class ArchiveIndex(object):
+    """Listing of the archive contents"""
+
+    def __init__(self, arch_path, entries, fmt=None, archive_stat=None,
+                 digest=None):
+        """
+        Params:
+            arch_path:      path to the archive
+            entries:        dictionary of paths relative to the archive root
+                            and lists describing them: ['d', mode, offset],
+                            ['l', target, offset] or ['f', mode, size,
+                            digest, offset], where digest might be None
+            fmt:            format of the archive, if members can be
+                            accessed directly (tar or zip), None otherwise
+            archive_stat:   size and modification time of the archive
+            digest:         hash of the archive file, if it was verified
+                            after creation
+        """
+        self.arch_path = os.path.abspath(arch_path)
+        self.entries = entries
+        self.format = fmt
+        self.archive_stat = archive_stat or _get_stat(arch_path)
+        self.digest = digest
+
+    @property
+    def size(self):
+        """Total size of the files in the archive"""
+        return sum(x[2] for x in self.entries.values() if x[0] == 'f')
+
+    @property
+    def seekable(self):
+        """Check if members can be extracted without reading all of them"""
+        if self.format == ZIP:
+            # members are found by name in the central directory
+            return True
+        return self.format == TAR and all(x[-1] is not None
+                                          for x in self.entries.values())
+
+    def contains(self, rel_path):
+        """Check if the path exists in the archive"""
+        rel_path = os.path.normpath(rel_path)
+        if rel_path in self.entries or rel_path == '.':
+            return True
+        # directories might not have their own members
+        prefix = rel_path + os.sep
+        return any(x.startswith(prefix) for x in self.entries)
+
+    def select(self, paths):
+        """
+        Return sorted list of entry paths with provided paths, their
+        contents and their parent directories.
+        """
+        paths = [os.path.normpath(x) for x in paths]
+        selected = set()
+        for rel_path in self.entries:
+            for path in paths:
+                if (path == '.' or rel_path == path or
+                        rel_path.startswith(path + os.sep) or
+                        path.startswith(rel_path + os.sep)):
+                    selected.add(rel_path)
+                    break
+        return sorted(selected)
+
+    def extract(self, paths):
+        """
+        Extract provided paths out of the archive into current directory,
+        reading only their members. Return True on success, False otherwise.
+        """
+        from e_uae_wrapper import file_archive
+
+        if not self.seekable:
+            logging.error("Archive `%s' doesn't support selective "
+                          "extraction.", self.arch_path)
+            return False
+
+        selected = self.select(paths)
+        logging.debug("Extracting %d out of %d members of `%s'.",
+                      len(selected), len(self.entries), self.arch_path)
+        if self.format == ZIP:
+            return file_archive.NativeZipArchive().extract_members(
+                self.arch_path, selected)
+        return file_archive.NativeTarArchive().extract_members(
+            self.arch_path, sorted(self.entries[x][-1] for x in selected))
+
+    def save(self):
+        """Write the index next to the archive. Return True on success"""
+        index_file = get_index_file(self.arch_path)
+        tmp_file = index_file + '.%d' % os.getpid()
+        data = {'version': INDEX_VERSION,
+                'archive_stat': self.archive_stat,
+                'format': self.format,
+                'digest': self.digest,
+                'entries': self.entries}
+        try:
+            with open(tmp_file, 'w') as fobj:
+                json.dump(data, fobj)
+            os.rename(tmp_file, index_file)
+        except (IOError, OSError) as err:
+            logging.debug("Cannot write index `%s': %s.", index_file, err)
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            return False
+        return True
+
+
+def get_index_file(arch_path):
+    """Return path to the index file of the archive"""
+    dirname, basename = os.path.split(os.path.abspath(arch_path))
+    return os.path.join(dirname, '.%s.index' % basename)
+
+
+def load(arch_path):
+    """
+    Return index of the archive, or None if there is no index, or archive
+    was changed since it was written.
+    """
+    try:
+        with open(get_index_file(arch_path)) as fobj:
+            data = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if (data.get('version') != INDEX_VERSION or
+            data['archive_stat'] != _get_stat(arch_path)):
+        logging.debug("Index of `%s' is outdated.", arch_path)
+        return None
+    return ArchiveIndex(arch_path, data['entries'], data['format'],
+                        data['archive_stat'], data.get('digest'))
+
+
+def build(arch_path, tree, digests=None):
+    """
+    Create index of the archive out of the tree with its contents, i.e. just
+    extracted or just archived. Offsets of the members are read from the
+    archive, if format supports it. Digests is the optional dictionary of
+    already known file hashes, by the path relative to the tree; files are
+    not hashed otherwise, to avoid reading the whole tree again.
+    """
+    digests = digests or {}
+    entries = {}
+    for root, dirs, files in os.walk(tree):
+        rel_root = os.path.relpath(root, tree)
+        if rel_root == '.':
+            rel_root = ''
+
+        for name in dirs + files:
+            rel_path = os.path.join(rel_root, name)
+            if rel_path in EXCLUDE:
+                continue
+            path = os.path.join(root, name)
+            stat_res = os.lstat(path)
+            mode = stat.S_IMODE(stat_res.st_mode)
+
+            if stat.S_ISLNK(stat_res.st_mode):
+                entries[rel_path] = ['l', os.readlink(path), None]
+            elif stat.S_ISDIR(stat_res.st_mode):
+                entries[rel_path] = ['d', mode, None]
+            else:
+                entries[rel_path] = ['f', mode, stat_res.st_size,
+                                     digests.get(rel_path), None]
+
+    fmt = _read_offsets(arch_path, entries)
+    return ArchiveIndex(arch_path, entries, fmt)
+
+
+def update(arch_path, tree, digests=None):
+    """Write index of the archive, unless there is a valid one already"""
+    if load(arch_path) is not None:
+        return
+    logging.debug("Writing index of `%s'.", arch_path)
+    try:
+        build(arch_path, tree, digests).save()
+    except (IOError, OSError) as err:
+        logging.debug("Cannot index `%s': %s.", arch_path, err)
+
+
+def _read_offsets(arch_path, entries):
+    """
+    Fill offsets of the members in the entries, if archive is uncompressed
+    tar or zip file. Return the format, or None if offsets are not
+    available.
+    """
+    if zipfile.is_zipfile(arch_path):
+        with zipfile.ZipFile(arch_path) as zobj:
+            for info in zobj.infolist():
+                _set_offset(entries, info.filename, info.header_offset)
+        return ZIP
+
+    with open(arch_path, 'rb') as fobj:
+        if fobj.read(512)[257:262] != b'ustar':
+            return None
+
+    try:
+        with tarfile.open(arch_path, 'r:') as tar:
+            for member in tar:
+                _set_offset(entries, member.name, member.offset)
+                tar.members = []
+    except tarfile.TarError as err:
+        logging.debug("Cannot read members of `%s': %s.", arch_path, err)
+        return None
+    return TAR
+
+
+def _set_offset(entries, name, offset):
+    """Set offset of the member in its entry"""
+    entry = entries.get(os.path.normpath(name.lstrip('/')))
+    if entry is not None:
+        entry[-1] = offset
+
+
+def _get_stat(arch_path):
+    """Return size and modification time of the archive"""
+    try:
+        stat_res = os.stat(arch_path)
+    except OSError:
+        return None
+    return [stat_res.st_size, stat_res.st_mtime_ns]
@@ -0,0 +1,208 @@
+"""
+Sparse files support.
+
+Hard disk images are usually mostly empty, so that instead of writing and
+reading zeros, holes are preserved. When copying, blocks of zeros are not
+written, but skipped, leaving holes in the target file, and when reading,
+only data segments reported by SEEK_DATA/SEEK_HOLE are read. Sparse files
+are stored in tar archives using GNU sparse format 1.0, which is understood
+by both GNU tar and tarfile module.
+"""
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+
+BUFSIZE = 1024 * 1024
+# granularity of detecting blocks of zeros
+BLOCKSIZE = 64 * 1024
+ZEROS = b'\x00' * BLOCKSIZE
+# files smaller than that are not worth sparsifying
+SPARSIFY_MIN = 1024 * 1024
+
+
+def copy(src, dst, length=None):
+    """
+    Copy length bytes (or everything, if length is None) from src file
+    object to dst file object, skipping blocks of zeros, so that holes are
+    made in the dst file. Raise IOError if src ends prematurely.
+    """
+    remaining = length
+    hole = False
+    while remaining is None or remaining > 0:
+        data = src.read(BUFSIZE if remaining is None
+                        else min(BUFSIZE, remaining))
+        if not data:
+            if remaining is not None:
+                raise IOError("unexpected end of data")
+            break
+        if remaining is not None:
+            remaining -= len(data)
+
+        view = memoryview(data)
+        for offset in range(0, len(data), BLOCKSIZE):
+            block = view[offset:offset + BLOCKSIZE]
+            if block == ZEROS[:len(block)]:
+                dst.seek(len(block), os.SEEK_CUR)
+                hole = True
+            else:
+                dst.write(block)
+                hole = False
+
+    if hole:
+        # file ending with the hole needs to be extended to its size
+        dst.truncate()
+
+
+def is_sparse(path):
+    """Check if file occupies less space on the disk than its size"""
+    stat = os.lstat(path)
+    return hasattr(stat, 'st_blocks') and stat.st_blocks * 512 < stat.st_size
+
+
+def get_data_segments(fobj, size):
+    """
+    Return list of (offset, length) tuples with data segments of the file.
+    If file ends with a hole, last segment will have zero length and offset
+    equal to the file size. Whole file is treated as data, if there is no
+    support for SEEK_DATA/SEEK_HOLE.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+
+    fd = fobj.fileno()
+    segments = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno != errno.ENXIO:
+                    raise
+                # nothing but the hole till the end of file
+                break
+            offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            segments.append((start, offset - start))
+    except OSError as err:
+        logging.debug("Cannot find holes in `%s': %s.", fobj.name, err)
+        return [(0, size)]
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    if offset < size or not segments:
+        segments.append((size, 0))
+    return segments
+
+
+def copy_file(src, dst):
+    """
+    Copy file with its metadata, reading only its data segments and leaving
+    holes in dst file
+    """
+    size = os.path.getsize(src)
+    with open(src, 'rb') as src_obj, open(dst, 'wb') as dst_obj:
+        for offset, length in get_data_segments(src_obj, size):
+            src_obj.seek(offset)
+            dst_obj.seek(offset)
+            copy(src_obj, dst_obj, length)
+        dst_obj.truncate(size)
+    shutil.copystat(src, dst)
+
+
+def sparsify(path):
+    """
+    Replace blocks of zeros in the file with holes. Return True if file was
+    rewritten.
+    """
+    stat = os.stat(path)
+    if stat.st_size < SPARSIFY_MIN:
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.sparse-',
+                                    dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        copy_file(path, tmp_path)
+        if os.stat(tmp_path).st_blocks >= stat.st_blocks:
+            os.unlink(tmp_path)
+            return False
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        logging.warning("Cannot sparsify `%s': %s.", path, err)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+
+    logging.debug("Sparsified `%s'.", path)
+    return True
+
+
+class SparseReader(object):
+    """
+    File like object producing member data in GNU sparse format 1.0, that is
+    sparse map followed by data segments
+    """
+    def __init__(self, fobj, segments):
+        """
+        Params:
+            fobj:       file object of the sparse file
+            segments:   list of (offset, length) of data segments
+        """
+        self.fobj = fobj
+        self.segments = segments
+        lines = [str(len(segments))]
+        for offset, length in segments:
+            lines.extend([str(offset), str(length)])
+        header = ('\n'.join(lines) + '\n').encode('ascii')
+        self.header = header + b'\x00' * (-len(header) % 512)
+        self.size = len(self.header) + sum(x[1] for x in segments)
+        self._chunks = self._read_chunks()
+        self._buf = b''
+
+    def read(self, size=-1):
+        result = []
+        remaining = size
+        while remaining != 0:
+            if not self._buf:
+                self._buf = next(self._chunks, b'')
+                if not self._buf:
+                    break
+            if remaining < 0:
+                chunk, self._buf = self._buf, b''
+            else:
+                chunk, self._buf = (self._buf[:remaining],
+                                    self._buf[remaining:])
+                remaining -= len(chunk)
+            result.append(chunk)
+        return b''.join(result)
+
+    def _read_chunks(self):
+        """Yield sparse map, and then data segments in chunks"""
+        yield self.header
+        for offset, length in self.segments:
+            self.fobj.seek(offset)
+            while length:
+                data = self.fobj.read(min(length, BUFSIZE))
+                if not data:
+                    raise IOError("file `%s' has shrunk" % self.fobj.name)
+                length -= len(data)
+                yield data
+
+
+def get_sparse_tarinfo(tarinfo, fobj):
+    """
+    Turn tarinfo of the sparse file into GNU sparse 1.0 member. Return
+    SparseReader for the member data.
+    """
+    reader = SparseReader(fobj, get_data_segments(fobj, tarinfo.size))
+    dirname, basename = os.path.split(tarinfo.name)
+    tarinfo.pax_headers = {'GNU.sparse.major': '1',
+                           'GNU.sparse.minor': '0',
+                           'GNU.sparse.name': tarinfo.name,
+                           'GNU.sparse.realsize': str(tarinfo.size)}
+    tarinfo.name = os.path.join(dirname, 'GNUSparseFile.0', basename)
+    tarinfo.size = reader.size
+    return reader
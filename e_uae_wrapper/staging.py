@@ -0,0 +1,129 @@
+"""
+Selecting the place for the temporary directory of the session.
+
+Uncompressed size of the archive is estimated without extracting it (out of
+zip central directory, gzip trailer, zstd frame header or the tree cache),
+and the session is placed on tmpfs if it fits there, with some memory left
+for the emulator, or on the disk otherwise. If the size cannot be known
+upfront (i.e. for bzip2 or xz compressed archives without the index), the
+disk is used, as guessing could exhaust the memory.
+"""
+import logging
+import os
+import struct
+import tempfile
+import zipfile
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from e_uae_wrapper import tree_cache
+
+
+MIB = 1024 * 1024
+# memory which should be left free for the emulator, when using tmpfs
+RAM_RESERVE = 512 * MIB
+TMPFS_DIRS = [os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm']
+
+
+def estimate_size(arch_path):
+    """
+    Return estimated size in bytes of the extracted archive, or None if it
+    cannot be known without decompressing the archive
+    """
+    arch_path = os.path.abspath(arch_path)
+    size = tree_cache.get_cached_size(arch_path)
+    if size is not None:
+        return size
+
+    arch_size = os.path.getsize(arch_path)
+
+    if zipfile.is_zipfile(arch_path):
+        with zipfile.ZipFile(arch_path) as zfile:
+            return sum(x.file_size for x in zfile.infolist())
+
+    with open(arch_path, 'rb') as fobj:
+        header = fobj.read(512)
+
+        if header.startswith(b'\x1f\x8b') and arch_size > 18:
+            # ISIZE from the trailer of the last gzip member; if it's smaller
+            # than the archive itself, there are multiple members or size
+            # exceeds 4GiB
+            fobj.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', fobj.read(4))[0]
+            if size >= arch_size:
+                return size
+
+        if zstandard and header.startswith(b'\x28\xb5\x2f\xfd'):
+            size = zstandard.frame_content_size(header)
+            if size > 0:
+                return size
+
+    if header[257:262] == b'ustar':
+        # uncompressed tar
+        return arch_size
+
+    return None
+
+
+def get_mem_available():
+    """Return available memory in bytes, or None if it's unknown"""
+    try:
+        with open('/proc/meminfo') as fobj:
+            for line in fobj:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_free_space(path):
+    """Return free space in bytes on filesystem with provided path"""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def fits_tmpfs(path, size):
+    """Check if data of provided size fit on the tmpfs directory"""
+    if not path or not os.path.isdir(path) or not os.access(path, os.W_OK):
+        return False
+
+    available = get_mem_available()
+    if available is None or available - RAM_RESERVE < size:
+        return False
+    return get_free_space(path) >= size
+
+
+def fits_disk(path, size):
+    """Check if data of provided size fit on the disk directory"""
+    if not path or not os.path.isdir(path) or not os.access(path, os.W_OK):
+        return False
+    return get_free_space(path) >= size
+
+
+def select_dir(size, disk_dir=None):
+    """
+    Return directory for the temporary files of provided size, tmpfs if
+    possible, disk_dir (or system temporary directory) otherwise, or None if
+    data will not fit anywhere. If size is None (unknown), disk_dir is used
+    if it is writable.
+    """
+    disk_dir = disk_dir or tempfile.gettempdir()
+    if size is None:
+        if fits_disk(disk_dir, 0):
+            logging.debug("Size is unknown, using `%s'.", disk_dir)
+            return disk_dir
+        return None
+
+    for path in TMPFS_DIRS:
+        if fits_tmpfs(path, size):
+            logging.debug("Using tmpfs `%s' for %d bytes.", path, size)
+            return path
+
+    if fits_disk(disk_dir, size):
+        logging.debug("Using `%s' for %d bytes.", disk_dir, size)
+        return disk_dir
+
+    return None
@@ -0,0 +1,272 @@
+"""
+Content addressed store of files, shared by all the archives.
+
+Every distinct file content is kept once, as an object named after its hash,
+in $XDG_CACHE_HOME/e-uae-wrapper/store/objects. For every archive there is
+a record describing its tree - directories, symlinks, and files with their
+modes, modification times and hashes. Session directory is populated out of
+the record, so that files common to many archives (like Workbench, libs or
+fonts) are extracted only once, and persisting changed tree adds only the new
+content to the store.
+
+Store is a cache in front of the archives, not a replacement for them, and
+only deduplicates the extracted data. The archive is still written on every
+persist, as it is the portable copy of the data, so the store costs the disk
+space of all the distinct contents it holds, in exchange for skipping
+decompression. Objects no longer referenced by any record are removed
+periodically (at most once per GC_INTERVAL), not on every persist, as that
+needs to go through all the records and objects.
+"""
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from e_uae_wrapper import materialize
+from e_uae_wrapper import sparse
+from e_uae_wrapper import utils
+
+
+OBJECTS = 'objects'
+RECORDS = 'records'
+EXCLUDE = ['.uaerc']
+GC_STAMP = '.gc'
+GC_INTERVAL = 7 * 24 * 3600
+
+
+class Store(object):
+    """Content addressed store of files"""
+
+    def __init__(self, archive_options=None):
+        """
+        Params:
+            archive_options:    dict of options passed to the archiver
+        """
+        self.archive_options = archive_options or {}
+        self.store_dir = utils.get_cache_dir('store')
+        self.objects_dir = utils.get_cache_dir('store', OBJECTS)
+        self.records_dir = utils.get_cache_dir('store', RECORDS)
+        self.lock = os.path.join(self.store_dir, '.lock')
+
+    def extract(self, arch_path, dest, title='', readonly=None):
+        """
+        Populate dest directory with the contents of the archive, adding it
+        to the store first if needed. Return True on success, False
+        otherwise.
+        """
+        with utils.lock_file(self.lock):
+            record = self.get_record(arch_path)
+            if record is None:
+                record = self.add_archive(arch_path, title)
+                if record is None:
+                    return False
+
+            logging.debug("Populating `%s' out of the store.", dest)
+            self.populate(record, dest, readonly)
+        return True
+
+    def get_record(self, arch_path):
+        """
+        Return record for the archive, or None if there is no record, or the
+        archive was changed since then.
+        """
+        try:
+            with open(self._get_record_file(arch_path)) as fobj:
+                record = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if record['archive_stat'] != _get_stat(arch_path):
+            logging.debug("Record for `%s' is outdated.", arch_path)
+            return None
+        return record
+
+    def add_archive(self, arch_path, title=''):
+        """
+        Extract archive and add its contents to the store. Return the record
+        or None in case of failure.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.store_dir)
+        try:
+            curdir = os.path.abspath('.')
+            os.chdir(tmp_dir)
+            result = utils.extract_archive(arch_path, title,
+                                           **self.archive_options)
+            os.chdir(curdir)
+            if not result:
+                return None
+
+            # files extracted on the same filesystem are moved into the store
+            return self._add_tree(tmp_dir, arch_path, {}, move=True)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def add_tree(self, tree, arch_path):
+        """
+        Add contents of the tree (i.e. persisted session directory) to the
+        store as the record for the archive. Files, which are not changed
+        according to the previous record, are not hashed again.
+        """
+        with utils.lock_file(self.lock):
+            try:
+                with open(self._get_record_file(arch_path)) as fobj:
+                    old_entries = json.load(fobj)['entries']
+            except (IOError, OSError, ValueError):
+                old_entries = {}
+            self._add_tree(tree, arch_path, old_entries, move=False)
+
+    def populate(self, record, dest, readonly=None):
+        """Populate existing dest directory out of the record"""
+        materializer = materialize.Materializer(readonly)
+        directories = []
+        for rel_path, entry in sorted(record['entries'].items()):
+            path = os.path.join(dest, rel_path)
+            if entry[0] == 'd':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, entry[1], entry[2]))
+                continue
+
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            if entry[0] == 'l':
+                os.symlink(entry[1], path)
+            else:
+                materializer.copy_object(self._get_object(entry[4]), path,
+                                         rel_path, entry[1], entry[3])
+
+        for path, mode, mtime in reversed(directories):
+            os.chmod(path, mode)
+            os.utime(path, ns=(mtime, mtime))
+
+    def maybe_gc(self):
+        """
+        Run gc, if it wasn't run for GC_INTERVAL seconds. Store has to be
+        locked.
+        """
+        stamp = os.path.join(self.store_dir, GC_STAMP)
+        try:
+            if time.time() - os.path.getmtime(stamp) < GC_INTERVAL:
+                return False
+        except OSError:
+            pass
+
+        self.gc()
+        with open(stamp, 'w'):
+            pass
+        return True
+
+    def gc(self):
+        """Remove objects, which are not referenced by any record"""
+        used = set()
+        for name in os.listdir(self.records_dir):
+            try:
+                with open(os.path.join(self.records_dir, name)) as fobj:
+                    entries = json.load(fobj)['entries']
+            except (IOError, OSError, ValueError):
+                continue
+            used.update(x[4] for x in entries.values() if x[0] == 'f')
+
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                if prefix + name not in used:
+                    os.unlink(os.path.join(prefix_dir, name))
+
+    def _add_tree(self, tree, arch_path, old_entries, move):
+        """Add files from the tree to the store, and write the record"""
+        entries = {}
+        added = 0
+        for root, dirs, files in os.walk(tree):
+            rel_root = os.path.relpath(root, tree)
+            if rel_root == '.':
+                rel_root = ''
+
+            for name in dirs + files:
+                rel_path = os.path.join(rel_root, name)
+                if rel_path in EXCLUDE:
+                    continue
+                path = os.path.join(root, name)
+                stat_res = os.lstat(path)
+                mode = stat.S_IMODE(stat_res.st_mode)
+
+                if stat.S_ISLNK(stat_res.st_mode):
+                    entries[rel_path] = ['l', os.readlink(path)]
+                elif stat.S_ISDIR(stat_res.st_mode):
+                    entries[rel_path] = ['d', mode, stat_res.st_mtime_ns]
+                else:
+                    old = old_entries.get(rel_path)
+                    if (old and old[0] == 'f' and
+                            old[2] == stat_res.st_size and
+                            old[3] == stat_res.st_mtime_ns and
+                            os.path.exists(self._get_object(old[4]))):
+                        digest = old[4]
+                    else:
+                        digest = utils.file_digest(path)
+                        added += self._add_object(path, digest, move)
+                    entries[rel_path] = ['f', mode, stat_res.st_size,
+                                         stat_res.st_mtime_ns, digest]
+
+        record = {'archive': os.path.abspath(arch_path),
+                  'archive_stat': _get_stat(arch_path),
+                  'entries': entries}
+        record_file = self._get_record_file(arch_path)
+        replaced = os.path.exists(record_file)
+        with open(record_file + '.tmp', 'w') as fobj:
+            json.dump(record, fobj)
+        os.rename(record_file + '.tmp', record_file)
+        logging.debug("Added %d new objects for %d entries to the store.",
+                      added, len(entries))
+
+        if replaced:
+            self.maybe_gc()
+        return record
+
+    def _add_object(self, path, digest, move):
+        """
+        Put file into the store, unless it's already there. Return 1 if file
+        was added, 0 otherwise.
+        """
+        obj = self._get_object(digest)
+        if os.path.exists(obj):
+            return 0
+
+        dirname = os.path.dirname(obj)
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+
+        tmp_obj = obj + '.tmp'
+        try:
+            if move:
+                os.rename(path, tmp_obj)
+            else:
+                os.link(path, tmp_obj)
+        except OSError:
+            # different filesystem
+            sparse.copy_file(path, tmp_obj)
+        os.rename(tmp_obj, obj)
+        return 1
+
+    def _get_object(self, digest):
+        """Return path to the object with provided digest"""
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def _get_record_file(self, arch_path):
+        """Return path to the record file for the archive"""
+        digest = utils.new_hash()
+        digest.update(os.path.abspath(arch_path).encode('utf-8'))
+        return os.path.join(self.records_dir, digest.hexdigest() + '.json')
+
+
+def _get_stat(arch_path):
+    """Return size and modification time of the archive"""
+    try:
+        stat_res = os.stat(arch_path)
+    except OSError:
+        return None
+    return [stat_res.st_size, stat_res.st_mtime_ns]
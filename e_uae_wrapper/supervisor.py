@@ -0,0 +1,302 @@
+"""
+Supervised emulator process.
+
+Emulator is started with requested CPU affinity, niceness and I/O
+scheduling class, which are inherited by all of its threads. While it runs,
+its CPU time, resident memory and I/O are sampled from /proc, and reported
+when it exits. Termination signals sent to the wrapper are forwarded to the
+emulator, so that it can exit cleanly, and the wrapper can persist the data
+afterwards. Interrupt signal is only ignored by the wrapper, as terminal (or
+the client of the daemon) delivers it to the emulator as well.
+"""
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from e_uae_wrapper import metrics
+from e_uae_wrapper import path
+
+
+INTERVAL = 1.0
+FORWARDED = (signal.SIGTERM, signal.SIGHUP)
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+MIB = 1024 * 1024
+
+
+class Supervisor(object):
+    """Run the emulator process, and collect its resource usage"""
+
+    def __init__(self, cmd, affinity=None, nice=None, ionice_class=None,
+                 ionice_level=None, interval=INTERVAL):
+        """
+        Params:
+            cmd:            command to run, as a list
+            affinity:       set of CPU numbers the process is allowed to run
+                            on, or None for no restriction
+            nice:           niceness of the process, or None for inherited
+            ionice_class:   I/O scheduling class name (see IONICE_CLASSES),
+                            or None for the default
+            ionice_level:   priority within the I/O scheduling class, 0-7
+            interval:       seconds between samples of the process stats
+        """
+        self.cmd = cmd
+        self.affinity = affinity
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.interval = interval
+        self.stats = {}
+        self._proc = None
+        self._exited = threading.Event()
+        self._samples = []
+        self._signals = []
+
+    def run(self):
+        """Run the command and wait for it. Return its exit code"""
+        cmd = self._get_command()
+        logging.debug("Executing `%s'.", " ".join(cmd))
+
+        start = time.time()
+        preexec_fn = None
+        if self.affinity or self.nice is not None:
+            preexec_fn = self._setup_child
+        self._proc = subprocess.Popen(cmd, preexec_fn=preexec_fn)
+
+        handlers = self._set_handlers()
+        try:
+            waiter = threading.Thread(target=self._wait_exit)
+            waiter.daemon = True
+            waiter.start()
+            while not self._exited.wait(self.interval):
+                self._sample()
+            # process is not reaped yet, its final counters are still there
+            self._sample()
+            code = self._proc.wait()
+        finally:
+            self._restore_handlers(handlers)
+
+        self._summarize(time.time() - start, code)
+        return code
+
+    def _get_command(self):
+        """Return command, prefixed with ionice if I/O class was requested"""
+        cmd = [path.which(self.cmd[0]) or self.cmd[0]] + self.cmd[1:]
+        if self.ionice_class is None:
+            return cmd
+
+        ionice = path.which('ionice')
+        if not ionice:
+            logging.warning("Cannot find `ionice', I/O scheduling class of "
+                            "the emulator will not be set.")
+            return cmd
+
+        prefix = [ionice, '-c', str(IONICE_CLASSES[self.ionice_class])]
+        if self.ionice_class != 'idle' and self.ionice_level is not None:
+            prefix += ['-n', str(self.ionice_level)]
+        # don't fail, if class cannot be set, i.e. realtime for the user
+        return prefix + ['-t', '--'] + cmd
+
+    def _setup_child(self):
+        """Set CPU affinity and niceness in the child, before exec"""
+        try:
+            if self.affinity:
+                os.sched_setaffinity(0, self.affinity)
+            if self.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        except OSError as err:
+            # logging is not safe in here
+            os.write(2, ("Cannot set scheduling of the emulator: %s\n" %
+                         err).encode('utf-8'))
+
+    def _wait_exit(self):
+        """Wait for the process to exit, leaving it for reaping"""
+        try:
+            os.waitid(os.P_PID, self._proc.pid, os.WEXITED | os.WNOWAIT)
+        except OSError:
+            pass
+        self._exited.set()
+
+    def _set_handlers(self):
+        """Install signal handlers. Return previous ones"""
+        handlers = {}
+        if threading.current_thread() is not threading.main_thread():
+            return handlers
+        for signum in FORWARDED + (signal.SIGINT,):
+            handlers[signum] = signal.signal(signum, self._handle_signal)
+        return handlers
+
+    def _restore_handlers(self, handlers):
+        """Restore previous signal handlers"""
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    def _handle_signal(self, signum, _):
+        """Forward termination signals to the process"""
+        self._signals.append(signum)
+        if signum not in FORWARDED:
+            return
+        try:
+            os.kill(self._proc.pid, signum)
+        except OSError:
+            pass
+
+    def _sample(self):
+        """Read current counters of the process from /proc"""
+        sample = read_stats(self._proc.pid)
+        if sample:
+            self._samples.append(sample)
+
+    def _summarize(self, wall, code):
+        """Compute stats out of the samples, and log them"""
+        # keys differ from the ones of the metrics records, which measure
+        # the wrapper together with its children
+        self.stats = {'exit_code': code,
+                      'samples': len(self._samples)}
+        if self._signals:
+            self.stats['signals'] = self._signals
+        if self._samples:
+            last = self._samples[-1]
+            cpu = last['cpu_user'] + last['cpu_system']
+            self.stats.update({
+                'cpu_user': round(last['cpu_user'], 3),
+                'cpu_system': round(last['cpu_system'], 3),
+                'cpu_percent': round(cpu * 100 / wall, 1) if wall else 0,
+                'max_threads': max(x['threads'] for x in self._samples)})
+
+            rss = [x['rss_kb'] for x in self._samples if 'rss_kb' in x]
+            if rss:
+                self.stats['avg_rss_kb'] = sum(rss) // len(rss)
+            peak = [x['hwm_kb'] for x in self._samples if 'hwm_kb' in x]
+            if peak:
+                self.stats['peak_rss_kb'] = max(peak)
+            for key in ('read_bytes', 'write_bytes'):
+                values = [x[key] for x in self._samples if key in x]
+                if values:
+                    self.stats['io_' + key] = max(values)
+
+        logging.info("Emulator ran for %.3fs, CPU %.3fs (%s%%), max RSS %d "
+                     "MiB, read %d MiB, written %d MiB.", wall,
+                     self.stats.get('cpu_user', 0) +
+                     self.stats.get('cpu_system', 0),
+                     self.stats.get('cpu_percent', '-'),
+                     self.stats.get('peak_rss_kb', 0) // 1024,
+                     self.stats.get('io_read_bytes', 0) // MIB,
+                     self.stats.get('io_write_bytes', 0) // MIB)
+
+
+def read_stats(pid):
+    """
+    Return dictionary with CPU times in seconds, number of threads, current
+    and peak resident memory in KiB, and bytes read and written by the
+    process, or None if process is gone. Keys not available (i.e. memory of
+    the exited process) are left out.
+    """
+    proc_dir = '/proc/%d' % pid
+    try:
+        with open(os.path.join(proc_dir, 'stat')) as fobj:
+            # process name might contain spaces and parentheses
+            fields = fobj.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    result = {'cpu_user': int(fields[11]) / ticks,
+              'cpu_system': int(fields[12]) / ticks,
+              'threads': int(fields[17])}
+
+    for fname, keys in (('status', {'VmRSS': 'rss_kb', 'VmHWM': 'hwm_kb'}),
+                        ('io', {'read_bytes': 'read_bytes',
+                                'write_bytes': 'write_bytes'})):
+        try:
+            with open(os.path.join(proc_dir, fname)) as fobj:
+                for line in fobj:
+                    key, _, val = line.partition(':')
+                    if key in keys:
+                        result[keys[key]] = int(val.split()[0])
+        except (IOError, OSError, ValueError):
+            pass
+    return result
+
+
+def parse_cpus(value):
+    """
+    Return set of CPU numbers out of the list like "1,3" or "2-3". Raise
+    ValueError if value is not valid.
+    """
+    cpus = set()
+    for part in value.split(','):
+        start, _, end = part.strip().partition('-')
+        start = int(start)
+        end = int(end) if end else start
+        if start < 0 or end < start:
+            raise ValueError("wrong range `%s'" % part)
+        cpus.update(range(start, end + 1))
+    return cpus
+
+
+def get_options(config):
+    """
+    Return dictionary of the Supervisor scheduling arguments out of the
+    configuration, or None if options are not valid
+    """
+    options = {}
+    if config.get('wrapper_cpu_affinity'):
+        try:
+            options['affinity'] = parse_cpus(config['wrapper_cpu_affinity'])
+        except ValueError:
+            logging.error("Option `wrapper_cpu_affinity' should be a list "
+                          "of CPUs like `1,3' or `2-3', got `%s'.",
+                          config['wrapper_cpu_affinity'])
+            return None
+        available = os.sched_getaffinity(0)
+        if not options['affinity'] & available:
+            logging.error("None of CPUs `%s' set in `wrapper_cpu_affinity' "
+                          "are available, use some of: %s.",
+                          config['wrapper_cpu_affinity'],
+                          ",".join(str(x) for x in sorted(available)))
+            return None
+
+    for key, name, low, high in (('wrapper_nice', 'nice', -20, 19),
+                                 ('wrapper_ionice_level', 'ionice_level', 0,
+                                  7)):
+        if not config.get(key):
+            continue
+        try:
+            options[name] = int(config[key])
+        except ValueError:
+            options[name] = None
+        if options[name] is None or not low <= options[name] <= high:
+            logging.error("Option `%s' should be an integer from %d to %d, "
+                          "got `%s'.", key, low, high, config[key])
+            return None
+
+    if config.get('wrapper_ionice_class'):
+        if config['wrapper_ionice_class'] not in IONICE_CLASSES:
+            logging.error("Option `wrapper_ionice_class' should be one of: "
+                          "%s.", ", ".join(sorted(IONICE_CLASSES)))
+            return None
+        options['ionice_class'] = config['wrapper_ionice_class']
+    return options
+
+
+def run(cmd, config):
+    """
+    Run the emulator command with scheduling options from the configuration,
+    and record its stats. Return True if it exits with zero exit code, False
+    otherwise.
+    """
+    options = get_options(config)
+    if options is None:
+        return False
+
+    supervisor = Supervisor(cmd, **options)
+    with metrics.measure('emulator', command=cmd[0]) as info:
+        code = supervisor.run()
+        info.update(supervisor.stats)
+    if code != 0:
+        logging.error('Command `%s` returned non 0 exit code.', cmd[0])
+        return False
+    return True
@@ -0,0 +1,189 @@
+"""
+Template engine for configuration values.
+
+Every value is compiled once into the list of literal and placeholder
+segments. Placeholders ({{name}}) may appear several times in the value and
+can be nested, i.e. {{wrapper_{{wrapper_model}}_rom_path}}. Placeholders can
+refer to the other options, which are resolved on demand, so that all the
+options are resolved in dependency order, each of them only once.
+
+If placeholder name contains `path' word, the comma/colon separated field of
+the value containing it will be treated as a path, joined with the rest of
+the field, and made absolute.
+"""
+import logging
+import os
+import re
+
+
+TOKEN_RE = re.compile(r'({{|}})')
+SEPARATOR_RE = re.compile(r'([,:])')
+
+
+class TemplateError(Exception):
+    """Error during resolving templates"""
+
+
+class TemplateSyntaxError(TemplateError):
+    """Malformed template"""
+
+
+class _Deferred(Exception):
+    """Raised when value depends on the option which is not known yet"""
+
+
+class Placeholder(object):
+    """Placeholder, which name itself is the list of segments"""
+    def __init__(self, segments):
+        self.segments = segments
+
+    def get_name(self, resolver):
+        """Return name of the option placeholder refers to"""
+        return ''.join(x if not isinstance(x, Placeholder)
+                       else resolver.lookup(x.get_name(resolver))
+                       for x in self.segments).strip()
+
+
+class Template(object):
+    """Compiled template"""
+    def __init__(self, text):
+        self.text = text
+        self.fields = self._compile(text)
+
+    def render(self, resolver):
+        """Return value with all the placeholders replaced"""
+        result = []
+        for separator, segments in self.fields:
+            result.append(separator)
+            values = []
+            is_path = False
+            for segment in segments:
+                if isinstance(segment, Placeholder):
+                    name = segment.get_name(resolver)
+                    is_path = is_path or 'path' in name
+                    values.append(resolver.lookup(name))
+                else:
+                    values.append(segment)
+
+            if is_path:
+                result.append(os.path.abspath(os.path.join(*values)))
+            else:
+                result.append(''.join(values))
+        return ''.join(result)
+
+    def _compile(self, text):
+        """
+        Tokenize the text, and return list of fields separated by commas and
+        colons, as pairs of separator and list of segments.
+        """
+        stack = [[]]
+        for token in TOKEN_RE.split(text):
+            if token == '{{':
+                stack.append([])
+            elif token == '}}' and len(stack) > 1:
+                segments = stack.pop()
+                stack[-1].append(Placeholder(segments))
+            elif token:
+                stack[-1].append(token)
+
+        if len(stack) > 1:
+            raise TemplateSyntaxError("unclosed placeholder in `%s'" % text)
+
+        fields = [('', [])]
+        for segment in stack[0]:
+            if isinstance(segment, Placeholder):
+                fields[-1][1].append(segment)
+                continue
+
+            parts = SEPARATOR_RE.split(segment)
+            fields[-1][1].append(parts[0])
+            for separator, part in zip(parts[1::2], parts[2::2]):
+                fields.append((separator, [part]))
+        return fields
+
+
+class Resolver(object):
+    """Resolve templates in configuration dictionary"""
+    def __init__(self, config, runtime=None):
+        """
+        Params:
+            config:     configuration dictionary
+            runtime:    list of option names, which are not known yet.
+                        Options depending on them are left untouched.
+        """
+        self.config = config
+        self.runtime = runtime or []
+        self.resolved = {}
+        self.deferred = set()
+        self._visiting = []
+
+    def lookup(self, name):
+        """Return resolved value of the option used in placeholder"""
+        if name not in self.config:
+            if name in self.runtime:
+                raise _Deferred(name)
+            return ''
+
+        value = self.resolve(name)
+        if isinstance(value, list):
+            return ','.join(value)
+        return value
+
+    def resolve(self, name):
+        """Return resolved value of the option"""
+        if name in self.resolved:
+            return self.resolved[name]
+        if name in self.deferred:
+            raise _Deferred(name)
+        if name in self._visiting:
+            cycle = self._visiting[self._visiting.index(name):] + [name]
+            raise TemplateError("circular reference: %s" %
+                                " -> ".join(cycle))
+
+        self._visiting.append(name)
+        try:
+            value = self.config[name]
+            if isinstance(value, list):
+                value = [self._render(name, x) for x in value]
+            else:
+                value = self._render(name, value)
+        except _Deferred:
+            self.deferred.add(name)
+            raise
+        finally:
+            self._visiting.pop()
+
+        self.resolved[name] = value
+        return value
+
+    def _render(self, name, text):
+        """Render single value of the option"""
+        if '{{' not in text:
+            return text
+
+        try:
+            return Template(text).render(self)
+        except TemplateSyntaxError:
+            logging.warning("Possible error in configuration file on key "
+                            "%s.", name)
+            return text
+
+
+def interpolate(config, runtime=None):
+    """
+    Replace all the templates in configuration values. Values depending on
+    the options listed in runtime, which are not present in config, are left
+    as is. May raise TemplateError.
+    """
+    resolver = Resolver(config, runtime)
+    updated = {}
+    for key in config:
+        try:
+            updated[key] = resolver.resolve(key)
+        except _Deferred:
+            continue
+        except RuntimeError:
+            # maximum recursion depth exceeded
+            raise TemplateError("references on key %s are nested too deep" %
+                                key)
+    config.update(updated)
@@ -0,0 +1,195 @@
+"""
+Persistent cache of extracted archives.
+
+Archives are extracted once into the cache directory, and subsequent runs
+populate the temporary directory out of the cached tree, instead of
+decompressing the archive again.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from e_uae_wrapper import materialize
+from e_uae_wrapper import sidecar
+from e_uae_wrapper import utils
+
+
+META = 'meta.json'
+TREE = 'tree'
+
+
+class TreeCache(object):
+    """
+    Cache of extracted trees. Entries are keyed by archive path, size and
+    modification time (and optionally its content hash). When size of the
+    cache exceed the limit, least recently used entries are removed.
+    """
+    def __init__(self, max_size=4096, use_hash=False, archive_options=None):
+        """
+        Params:
+            max_size:           maximal size of the cache in MiB
+            use_hash:           if set to True, content hash of the archive
+                                will be part of the key
+            archive_options:    dict of options passed to the archiver
+        """
+        self.max_size = max_size * 1024 * 1024
+        self.use_hash = use_hash
+        self.archive_options = archive_options or {}
+        self.cache_dir = utils.get_cache_dir('trees')
+        self.lock = os.path.join(self.cache_dir, '.lock')
+
+    def extract(self, arch_path, dest, title='', readonly=None):
+        """
+        Populate dest directory with the contents of the archive, extracting
+        it to the cache first if needed. Files are reflinked if possible,
+        otherwise files from readonly paths (relative to dest) are hardlinked
+        and the rest is copied. Return True on success, False otherwise.
+        """
+        with utils.lock_file(self.lock):
+            entry = self.get(arch_path)
+            if entry is None:
+                entry = self.add(arch_path, title)
+                if entry is None:
+                    return False
+
+            logging.debug("Populating `%s' with cached tree `%s'.", dest,
+                          entry)
+            materialize.Materializer(readonly).populate(
+                os.path.join(entry, TREE), dest)
+            self.evict()
+        return True
+
+    def key(self, arch_path):
+        """Return cache key for the archive"""
+        arch_path = os.path.abspath(arch_path)
+        stat = os.stat(arch_path)
+        data = [arch_path, stat.st_size, repr(stat.st_mtime)]
+        if self.use_hash:
+            # archive verified after creation doesn't need to be read again
+            index = sidecar.load(arch_path)
+            data.append(index.digest if index and index.digest
+                        else utils.file_digest(arch_path))
+
+        digest = utils.new_hash()
+        digest.update(json.dumps(data).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, arch_path):
+        """
+        Return path to the cache entry for provided archive or None, if there
+        is no such entry.
+        """
+        entry = os.path.join(self.cache_dir, self.key(arch_path))
+        if not os.path.exists(os.path.join(entry, META)):
+            return None
+
+        logging.debug("Found cached tree for `%s'.", arch_path)
+        os.utime(entry, None)
+        return entry
+
+    def add(self, arch_path, title=''):
+        """
+        Extract archive into the cache. Return path to the new entry or None
+        in case of failure.
+        """
+        entry = os.path.join(self.cache_dir, self.key(arch_path))
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        tree = os.path.join(tmp_entry, TREE)
+        os.mkdir(tree)
+
+        curdir = os.path.abspath('.')
+        os.chdir(tree)
+        result = utils.extract_archive(arch_path, title,
+                                       **self.archive_options)
+        os.chdir(curdir)
+
+        if not result:
+            shutil.rmtree(tmp_entry)
+            return None
+
+        self._remove_stale(arch_path)
+
+        with open(os.path.join(tmp_entry, META), 'w') as fobj:
+            json.dump({'archive': os.path.abspath(arch_path),
+                       'size': _get_tree_size(tree)}, fobj)
+
+        os.rename(tmp_entry, entry)
+        return entry
+
+    def evict(self):
+        """Remove least recently used entries exceeding cache size"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            meta = self._get_meta(name)
+            if meta is None:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            entries.append((os.stat(path).st_mtime, meta['size'], path))
+
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.debug("Removing cached tree `%s'.", path)
+            shutil.rmtree(path)
+            total -= size
+
+    def _get_meta(self, name):
+        """Return metadata for the entry or None"""
+        try:
+            with open(os.path.join(self.cache_dir, name, META)) as fobj:
+                return json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _remove_stale(self, arch_path):
+        """
+        Remove entries for the archive, which doesn't match its current
+        state, i.e. after archive was replaced with persisted data.
+        """
+        arch_path = os.path.abspath(arch_path)
+        for name in os.listdir(self.cache_dir):
+            meta = self._get_meta(name)
+            if meta and meta['archive'] == arch_path:
+                logging.debug("Removing stale cached tree for `%s'.",
+                              arch_path)
+                shutil.rmtree(os.path.join(self.cache_dir, name))
+
+
+def get_cached_size(arch_path):
+    """
+    Return size of the most recently used cached tree for the archive, or None
+    if it was never cached
+    """
+    # only looking, don't create cache, which might be not used at all
+    cache_dir = utils.get_cache_path('trees')
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return None
+
+    result = None
+    for name in names:
+        try:
+            path = os.path.join(cache_dir, name)
+            with open(os.path.join(path, META)) as fobj:
+                meta = json.load(fobj)
+            if meta['archive'] != arch_path:
+                continue
+            mtime = os.stat(path).st_mtime
+        except (IOError, OSError, ValueError):
+            continue
+        if result is None or mtime > result[0]:
+            result = (mtime, meta['size'])
+    return result and result[1]
+
+
+def _get_tree_size(path):
+    """Return size of all the files in the tree"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            size += os.lstat(os.path.join(root, fname)).st_size
+    return size
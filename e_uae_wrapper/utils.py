@@ -2,25 +2,25 @@
 Misc utilities
 """
 import collections
+import contextlib
+import fcntl
+import hashlib
 import logging
 import os
-import subprocess
-try:
-    import configparser
-except ImportError:
-    import ConfigParser as configparser
 
-from e_uae_wrapper import file_archive
+from e_uae_wrapper import metrics
 
 
 DUP_KEYS = ['filesystem', 'filesystem2', 'hardfile', 'hardfile2']
+BUFSIZE = 1024 * 1024
+_COMMON_CONFIG = {}
 
 
 def load_conf(conf_file):
     """
     Read global config and provided config file and return dict with combined
     options."""
-    conf = _get_common_config()
+    conf = get_common_config()
     local_conf = collections.OrderedDict()
 
     with open(conf_file) as fobj:
@@ -40,64 +40,72 @@ def load_conf(conf_file):
     return conf
 
 
-def operate_archive(arch_name, operation, text, params):
+def operate_archive(arch_name, operation, text, params, **options):
     """
     Create archive from contents of current directory
     """
+    from e_uae_wrapper import file_archive
 
-    archiver = file_archive.get_archiver(arch_name)
+    archiver = file_archive.get_archiver(arch_name, **options)
 
     if archiver is None:
         return False
 
     res = False
 
-    if operation == 'extract':
-        res = archiver.extract(arch_name)
+    with metrics.measure('archive_' + operation, archive=arch_name,
+                         archiver=type(archiver).__name__):
+        if operation == 'extract':
+            res = archiver.extract(arch_name)
 
-    if operation == 'create':
-        res = archiver.create(arch_name, params)
+        if operation == 'create':
+            res = archiver.create(arch_name, params)
 
     return res
 
 
-def create_archive(arch_name, title='', params=None):
+def create_archive(arch_name, title='', params=None, **options):
     """
     Create archive from contents of current directory
     """
     msg = ''
     if title:
         msg = "Creating archive for `%s'. Please be patient" % title
-    return operate_archive(arch_name, 'create', msg, params)
+    return operate_archive(arch_name, 'create', msg, params, **options)
 
 
-def extract_archive(arch_name, title='', params=None):
+def extract_archive(arch_name, title='', params=None, **options):
     """
     Extract provided archive to current directory
     """
     msg = ''
     if title:
         msg = "Extracting files for `%s'. Please be patient" % title
-    return operate_archive(arch_name, 'extract', msg, params)
+    return operate_archive(arch_name, 'extract', msg, params, **options)
 
 
-def run_command(cmd):
+def get_common_config_path():
+    """Return path to the common configuration file"""
+    xdg_conf = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+    return os.path.join(xdg_conf, 'e-uae.ini')
+
+
+def get_common_config():
     """
-    Run provided command. Return true if command execution returns zero exit
-    code, false otherwise. If cmd is not a list, there would be an attempt to
-    split it up for subprocess call method. May throw exception if cmd is not
-    a list neither a string.
+    Return common configuration. It is parsed only once, as long as the file
+    doesn't change.
     """
+    conf_path = get_common_config_path()
+    try:
+        stat = os.stat(conf_path)
+        key = (conf_path, stat.st_size, stat.st_mtime)
+    except OSError:
+        key = (conf_path, None, None)
 
-    if not isinstance(cmd, list):
-        cmd = cmd.split()
-
-    logging.debug("Executing `%s'.", " ".join(cmd))
-    code = subprocess.call(cmd)
-    if code != 0:
-        logging.error('Command `%s` returned non 0 exit code.', cmd[0])
-        return False
-    return True
+    if key not in _COMMON_CONFIG:
+        _COMMON_CONFIG.clear()
+        _COMMON_CONFIG[key] = _get_common_config()
+    return collections.OrderedDict(_COMMON_CONFIG[key])
 
 
 def _get_common_config():
@@ -106,11 +114,13 @@ def _get_common_config():
     File will be gather from $XDG_CONFIG_HOME/e-uaerc, which ususally is
     ~/.config/e-uaerc
     """
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
 
     parser = configparser.SafeConfigParser()
-
-    xdg_conf = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
-    conf_path = os.path.join(xdg_conf, 'e-uae.ini')
+    conf_path = get_common_config_path()
 
     try:
         parser.read(conf_path)
@@ -135,4 +145,73 @@ def _get_common_config():
 
 def get_arch_ext(archiver_name):
     """Return extension for the archiver"""
+    from e_uae_wrapper import file_archive
+
     return file_archive.Archivers.get_extension_by_name(archiver_name)
+
+
+def get_cache_dir(*subdirs):
+    """
+    Return (and create if needed) cache directory for the wrapper. It will be
+    placed in $XDG_CACHE_HOME/e-uae-wrapper, which usually is
+    ~/.cache/e-uae-wrapper
+    """
+    cache_dir = get_cache_path(*subdirs)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def get_cache_path(*subdirs):
+    """Return path to the cache directory, without creating it"""
+    xdg_cache = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg_cache, 'e-uae-wrapper', *subdirs)
+
+
+def new_hash():
+    """Return hash object used for checksumming files"""
+    try:
+        return hashlib.blake2b(digest_size=20)
+    except AttributeError:
+        return hashlib.sha1()
+
+
+def file_digest(fname):
+    """Return hex digest of the file contents"""
+    digest = new_hash()
+    with open(fname, 'rb') as fobj:
+        while True:
+            chunk = fobj.read(BUFSIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def lock_file(fname, shared=False):
+    """
+    Hold an advisory lock on provided file for the duration of the with block
+    """
+    with open(fname, 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield fobj
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+def get_int_option(config, key, default):
+    """
+    Return integer value of the option from config, or default if option is
+    not set or is not valid integer
+    """
+    val = config.get(key)
+    if val is None:
+        return default
+    try:
+        return int(val)
+    except ValueError:
+        logging.warning("Option `%s' should be an integer, got `%s'. Using "
+                        "`%s' instead.", key, val, default)
+        return default
@@ -9,8 +9,11 @@ import logging
 import os
 import sys
 
+from e_uae_wrapper import conf_cache
+from e_uae_wrapper import metrics
 from e_uae_wrapper import utils
 from e_uae_wrapper import WRAPPER_KEY
+from e_uae_wrapper import __version__
 
 
 def setup_logger(args):
@@ -32,35 +35,63 @@ def setup_logger(args):
                         format="%(asctime)s %(levelname)s: %(message)s")
 
 
-def parse_args():
+def parse_args(argv=None):
     """
     Look out for config file and for config options which would be blindly
-    passed to e-uae.
+    passed to e-uae. Arguments are taken from argv if provided, sys.argv
+    otherwise.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('config', help='Configuration file for e-uae.')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s ' + __version__)
+    parser.add_argument('-n', '--dry-run', help='Only check configuration, '
+                        'and print it as it would be passed to e-uae. No '
+                        'archives are touched, and emulator is not run.',
+                        action='store_true')
     parser.add_argument('-v', '--verbose', help='Be verbose. Adding more "v" '
                         'will increase verbosity', action="count",
                         default=None)
     parser.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" will'
                         ' decrease verbosity', action="count", default=None)
+    parser.add_argument('--profile', help='Print time and resources used by '
+                        'each phase.', action='store_true')
+    parser.add_argument('--metrics', metavar='FILE', help='Append time and '
+                        'resources used by each phase to the file as JSON '
+                        'lines.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     setup_logger(args)
     logging.debug("args: %s", args)
 
     return args
 
 
-def run():
-    """run wrapper module"""
+def run_config(conf_file, dry_run=False):
+    """
+    Run wrapper module for provided configuration file, or only check it if
+    dry_run is set to True. Return exit code:
+        0 - success
+        2 - configuration issues
+        3 - wrapper module doesn't exists
+        4 - wrapper module failed
+    """
+    metrics.set_context(config=os.path.abspath(conf_file))
+    with metrics.measure('total'):
+        return _run_config(conf_file, dry_run)
 
-    args = parse_args()
-    configuration = utils.load_conf(args.config)
+
+def _run_config(conf_file, dry_run=False):
+    """Run wrapper module for provided configuration file"""
+    with metrics.measure('load_conf'):
+        configuration = conf_cache.load(conf_file)
+        compiled = configuration is not None
+        if not compiled:
+            configuration = utils.load_conf(conf_file)
 
     if not configuration:
         logging.error('Error: Configuration file have syntax issues')
-        sys.exit(2)
+        return 2
 
     wrapper_module = configuration.get(WRAPPER_KEY, 'plain')
 
@@ -70,9 +101,16 @@ def run():
     except ImportError:
         logging.error("Error: provided wrapper module: `%s' doesn't "
                       "exists.", wrapper_module)
-        sys.exit(3)
+        return 3
+
+    runner = wrapper.Wrapper(os.path.abspath(conf_file), configuration)
+    if dry_run:
+        return 0 if runner.dry_run() else 2
 
-    runner = wrapper.Wrapper(os.path.abspath(args.config), configuration)
+    if not compiled:
+        if not runner.compile_config():
+            return 2
+        conf_cache.save(conf_file, runner.config)
 
     try:
         exit_code = runner.run()
@@ -80,7 +118,18 @@ def run():
         runner.clean()
 
     if not exit_code:
-        sys.exit(4)
+        return 4
+    return 0
+
+
+def run():
+    """run wrapper module"""
+
+    args = parse_args()
+    metrics.enable(args.metrics, args.profile)
+    exit_code = run_config(args.config, args.dry_run)
+    if exit_code:
+        sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import os
+import socket
+
+from e_uae_wrapper import client
+
+
+def test_socket_path_fallback(tmp_path, monkeypatch):
+    monkeypatch.delenv('E_UAE_WRAPPER_SOCKET', raising=False)
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    path = client.get_socket_path()
+    assert os.path.dirname(path) == str(tmp_path /
+                                        ('e-uae-wrapper-%d' % os.getuid()))
+
+    assert client.make_socket_dir(path)
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+
+
+def test_shared_socket_dir_refused(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(str(shared), 0o1777)
+    assert not client.make_socket_dir(str(shared / 'daemon.sock'))
+
+
+def test_connect_checks_peer(tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    assert client.connect(path) is None
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        sock = client.connect(path)
+        assert sock is not None
+        sock.close()
+    finally:
+        server.close()
+
+
+def test_connect_other_user(tmp_path, monkeypatch):
+    path = str(tmp_path / 'daemon.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    monkeypatch.setattr(client, '_get_peer_uid', lambda sock: os.getuid() + 1)
+    try:
+        assert client.connect(path) is None
+    finally:
+        server.close()
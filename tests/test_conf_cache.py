@@ -0,0 +1,81 @@
+import collections
+import os
+import time
+
+import pytest
+
+from e_uae_wrapper import conf_cache
+
+
+CONFIG = collections.OrderedDict([('wrapper', 'archive'),
+                                  ('wrapper_archive', '/some/path')])
+
+
+@pytest.fixture
+def conf(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.chdir(work)
+    conf_file = work / 'game.conf'
+    conf_file.write_text(u'[config]\nwrapper = archive\n')
+    return conf_file
+
+
+def _cache_files(cache_dir):
+    return sorted(os.listdir(str(cache_dir / 'e-uae-wrapper' / 'conf')))
+
+
+def test_load_saved(conf):
+    assert conf_cache.load('game.conf') is None
+    conf_cache.save('game.conf', CONFIG)
+    assert conf_cache.load('game.conf') == CONFIG
+
+
+def test_changed_config(conf):
+    conf_cache.save('game.conf', CONFIG)
+    conf.write_text(u'[config]\nwrapper = plain\n# changed\n')
+    assert conf_cache.load('game.conf') is None
+
+
+def test_changed_common_config(conf, tmp_path):
+    conf_cache.save('game.conf', CONFIG)
+    (tmp_path / 'config').mkdir()
+    (tmp_path / 'config' / 'e-uae.ini').write_text(u'[config]\n')
+    assert conf_cache.load('game.conf') is None
+
+
+def test_other_directory(conf, tmp_path, monkeypatch):
+    conf_cache.save(str(conf), CONFIG)
+    other = tmp_path / 'other'
+    other.mkdir()
+    monkeypatch.chdir(other)
+    assert conf_cache.load(str(conf)) is None
+    monkeypatch.chdir(conf.parent)
+    assert conf_cache.load(str(conf)) == CONFIG
+
+
+def test_prune(conf, tmp_path, cache_dir):
+    other = tmp_path / 'other.conf'
+    other.write_text(u'[config]\n')
+    conf_cache.save(str(other), CONFIG)
+    conf_cache.save('game.conf', CONFIG)
+    assert len(_cache_files(cache_dir)) == 2
+
+    # removed config file gets its entry pruned
+    other.unlink()
+    leftover = cache_dir / 'e-uae-wrapper' / 'conf' / 'x.json.123'
+    leftover.write_text(u'')
+    old = time.time() - conf_cache.TMP_MAX_AGE - 10
+    os.utime(str(leftover), (old, old))
+    conf_cache.save('game.conf', CONFIG)
+    assert len(_cache_files(cache_dir)) == 1
+    assert conf_cache.load('game.conf') == CONFIG
+
+
+def test_prune_broken(conf, cache_dir):
+    conf_cache.save('game.conf', CONFIG)
+    broken = cache_dir / 'e-uae-wrapper' / 'conf' / 'broken.json'
+    broken.write_text(u'{')
+    conf_cache.save('game.conf', CONFIG)
+    assert not broken.exists()
@@ -0,0 +1,213 @@
+import os
+import shutil
+import tarfile
+import tempfile
+
+import pytest
+
+from e_uae_wrapper import archive
+from e_uae_wrapper import delta
+from e_uae_wrapper import manifest
+from e_uae_wrapper import persist
+
+
+OPTIONS = {'backend': 'native', 'threads': 1, 'level': None, 'verify': True}
+
+
+def _write(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as fobj:
+        fobj.write(data)
+
+
+def _make_base(tmp_path):
+    tree = tmp_path / 'base'
+    _write(str(tree / 'DH0' / 'S' / 'Startup-Sequence'), 'boot\n')
+    _write(str(tree / 'DH1' / 'a' / 'b' / 'file'), 'file\n')
+    _write(str(tree / 'DH1' / 'other'), 'other\n')
+    return str(tree)
+
+
+def _copy(tree, dest):
+    shutil.copytree(tree, dest, symlinks=True)
+    return dest
+
+
+def test_get_changes(tmp_path):
+    tree = _make_base(tmp_path)
+    base = manifest.Manifest(tree, True)
+    shutil.rmtree(os.path.join(tree, 'DH1', 'a'))
+    os.mkdir(os.path.join(tree, 'DH1', 'empty'))
+    _write(os.path.join(tree, 'DH2', 'new'), 'new\n')
+    os.chmod(os.path.join(tree, 'DH0'), 0o700)
+
+    stored, removed, modes = delta.get_changes(base,
+                                               manifest.Manifest(tree, True))
+
+    # only top-most removed directory, only empty new directory
+    assert removed == ['DH1/a']
+    # non-empty directories are created by their contents, with modes set
+    # afterwards
+    assert stored == ['DH1/empty', 'DH2/new']
+    assert [x[0] for x in modes] == ['DH0', 'DH1/empty', 'DH2']
+    assert modes[0][1] == 0o700
+
+
+def test_save_restore(tmp_path):
+    tree = _make_base(tmp_path)
+    session = _copy(tree, str(tmp_path / 'session'))
+    base = manifest.Manifest(session, True)
+    shutil.rmtree(os.path.join(session, 'DH1', 'a'))
+    _write(os.path.join(session, 'DH0', 'S', 'Startup-Sequence'), 'mod\n')
+    _write(os.path.join(session, 'DH2', 'deep', 'new'), 'new\n')
+    os.mkdir(os.path.join(session, 'DH1', 'empty'))
+    os.chmod(os.path.join(session, 'DH0'), 0o700)
+    expected = manifest.Manifest(session, True)
+
+    save_path = str(tmp_path / 'save.tar')
+    assert delta.save(session, base, save_path, '', OPTIONS)
+    assert not os.path.exists(os.path.join(session, delta.WHITEOUT))
+
+    restored = _copy(tree, str(tmp_path / 'restored'))
+    assert delta.restore(save_path, restored, OPTIONS)
+    assert manifest.Manifest(restored, True) == expected
+
+
+def test_save_without_changes_removes_archive(tmp_path):
+    tree = _make_base(tmp_path)
+    save_path = str(tmp_path / 'save.tar')
+    _write(save_path, 'old')
+    assert delta.save(tree, manifest.Manifest(tree), save_path, '', OPTIONS)
+    assert not os.path.exists(save_path)
+
+
+@pytest.mark.parametrize('entry', ['../outside/victim', '{abs}',
+                                   'link/victim', '.'])
+def test_restore_unsafe_whiteout(tmp_path, entry):
+    victim_dir = tmp_path / 'outside'
+    _write(str(victim_dir / 'victim'), 'victim')
+    tree = tmp_path / 'tree'
+    _write(str(tree / 'file'), 'file')
+    os.symlink(str(victim_dir), str(tree / 'link'))
+    entry = entry.format(abs=str(victim_dir / 'victim'))
+
+    layer = tmp_path / 'layer'
+    _write(str(layer / delta.WHITEOUT), entry + '\n')
+    save_path = str(tmp_path / 'save.tar')
+    with tarfile.open(save_path, 'w') as tar:
+        tar.add(str(layer / delta.WHITEOUT), delta.WHITEOUT)
+
+    assert delta.restore(save_path, str(tree), OPTIONS)
+    assert (victim_dir / 'victim').exists()
+    assert (tree / 'file').exists()
+
+
+def test_layer_paths(tmp_path):
+    arch = str(tmp_path / 'game.tar.gz')
+    assert delta.get_layers(arch) == []
+    assert delta.get_next_layer_path(arch) == \
+        str(tmp_path / 'game.layer-001.tar.gz')
+    for number in (2, 10, 1):
+        _write(delta.get_layer_path(arch, number), '')
+    _write(str(tmp_path / 'other.layer-005.tar.gz'), '')
+    assert [os.path.basename(x) for x in delta.get_layers(arch)] == \
+        ['game.layer-001.tar.gz', 'game.layer-002.tar.gz',
+         'game.layer-010.tar.gz']
+    assert delta.get_next_layer_path(arch) == \
+        str(tmp_path / 'game.layer-011.tar.gz')
+
+
+class Session(object):
+    """Run archive wrapper without the emulator"""
+
+    def __init__(self, conf_file, config):
+        self.conf_file = conf_file
+        self.config = config
+
+    def __call__(self, change):
+        wrapper = archive.Wrapper(self.conf_file, dict(self.config))
+        wrapper.dir = tempfile.mkdtemp(dir=os.path.dirname(self.conf_file))
+        try:
+            assert wrapper._extract()
+            change(wrapper.dir)
+            assert wrapper._make_archive()
+        finally:
+            if wrapper.dir:
+                shutil.rmtree(wrapper.dir)
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    tree = _make_base(tmp_path)
+    with tarfile.open(str(tmp_path / 'game.tar'), 'w') as tar:
+        for name in sorted(os.listdir(tree)):
+            tar.add(os.path.join(tree, name), name)
+
+    submitted = []
+
+    def submit(tree, arch_filepath, title, archive_options, use_store,
+               use_index, obsolete):
+        # compaction, done synchronously
+        submitted.append(obsolete)
+        result = persist.make_archive(tree, arch_filepath, title,
+                                      archive_options, use_store, use_index,
+                                      obsolete=obsolete)
+        shutil.rmtree(tree)
+        return result
+    monkeypatch.setattr(persist, 'submit', submit)
+
+    config = {'wrapper': 'archive', 'wrapper_archive': 'game.tar',
+              'wrapper_persist_data': '1', 'wrapper_persist_layers': '1',
+              'wrapper_layers_max': '2', 'wrapper_layers_max_size': '1000'}
+    result = Session(str(tmp_path / 'game.uaerc'), config)
+    result.submitted = submitted
+    result.arch = str(tmp_path / 'game.tar')
+    return result
+
+
+def test_layers_and_compaction(session):
+    base_size = os.path.getsize(session.arch)
+
+    def step1(tree):
+        _write(os.path.join(tree, 'DH0', 'game.uss'), 'state1\n')
+
+    def step2(tree):
+        shutil.rmtree(os.path.join(tree, 'DH1', 'a'))
+
+    def step3(tree):
+        _write(os.path.join(tree, 'DH0', 'game.uss'), 'state3\n')
+        os.mkdir(os.path.join(tree, 'DH1', 'empty'))
+
+    def check2(tree):
+        assert not os.path.exists(os.path.join(tree, 'DH1', 'a'))
+        with open(os.path.join(tree, 'DH0', 'game.uss')) as fobj:
+            assert fobj.read() == 'state1\n'
+
+    def check3(tree):
+        assert os.path.isdir(os.path.join(tree, 'DH1', 'empty'))
+        assert not os.path.exists(os.path.join(tree, 'DH1', 'a'))
+        assert os.path.exists(os.path.join(tree, 'DH1', 'other'))
+        with open(os.path.join(tree, 'DH0', 'game.uss')) as fobj:
+            assert fobj.read() == 'state3\n'
+
+    session(step1)
+    session(step2)
+    assert len(delta.get_layers(session.arch)) == 2
+    # base archive is untouched by the layers
+    assert os.path.getsize(session.arch) == base_size
+    session(check2)
+    assert len(delta.get_layers(session.arch)) == 2
+
+    session(step3)
+    # third layer exceeded the limit, all of them were folded into the base
+    assert len(session.submitted) == 1
+    assert len(session.submitted[0]) == 3
+    assert delta.get_layers(session.arch) == []
+    session(check3)
+
+
+def test_no_layer_without_changes(session):
+    session(lambda tree: None)
+    assert delta.get_layers(session.arch) == []
@@ -0,0 +1,148 @@
+import json
+import os
+import stat
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from e_uae_wrapper import file_archive
+from e_uae_wrapper import metrics
+
+
+def _make_tree(root):
+    os.makedirs(os.path.join(root, 'DH0', 'S'))
+    os.makedirs(os.path.join(root, 'DH1', 'empty'))
+    with open(os.path.join(root, 'DH0', 'S', 'Startup-Sequence'), 'w') as fobj:
+        fobj.write('boot\n')
+    with open(os.path.join(root, 'DH1', 'data'), 'wb') as fobj:
+        fobj.write(os.urandom(100000))
+    os.chmod(os.path.join(root, 'DH1', 'data'), 0o600)
+    os.symlink('S/Startup-Sequence', os.path.join(root, 'DH0', 'link'))
+
+
+def _listing(root):
+    result = {}
+    for dirname, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(dirname, name)
+            rel_path = os.path.relpath(path, root)
+            if os.path.islink(path):
+                result[rel_path] = ('l', os.readlink(path))
+            elif os.path.isdir(path):
+                result[rel_path] = ('d',)
+            else:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+                with open(path, 'rb') as fobj:
+                    result[rel_path] = ('f', mode, fobj.read())
+    return result
+
+
+@pytest.mark.parametrize('ext', ['tar', 'tar.gz', 'tar.bz2', 'tar.xz',
+                                 'zip'])
+def test_round_trip(tmp_path, monkeypatch, ext):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    dst.mkdir()
+    _make_tree(str(src))
+    arch = str(tmp_path / ('arch.' + ext))
+
+    archiver = file_archive.get_archiver(arch)
+    assert archiver.ARCH in ('tarfile', 'zipfile')
+    monkeypatch.chdir(src)
+    assert archiver.create(arch)
+    monkeypatch.chdir(dst)
+    assert file_archive.get_archiver(arch).extract(arch)
+
+    assert _listing(str(dst)) == _listing(str(src))
+
+
+def _add_symlink(zobj, name, target):
+    info = zipfile.ZipInfo(name)
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zobj.writestr(info, target)
+
+
+def test_zip_write_through_symlink(tmp_path, monkeypatch):
+    victim = tmp_path / 'victim'
+    victim.mkdir()
+    arch = str(tmp_path / 'evil.zip')
+    with zipfile.ZipFile(arch, 'w') as zobj:
+        _add_symlink(zobj, 'link', str(victim))
+        zobj.writestr('link/pwned.txt', 'pwned')
+        zobj.writestr('link/', '')
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    monkeypatch.chdir(tree)
+
+    file_archive.NativeZipArchive().extract(arch)
+
+    assert os.listdir(str(victim)) == []
+    assert not os.path.islink(str(tree / 'link'))
+
+
+@pytest.mark.parametrize('target', ['/etc', '../outside', 'a/../../outside'])
+def test_zip_unsafe_symlink(tmp_path, monkeypatch, target):
+    arch = str(tmp_path / 'evil.zip')
+    with zipfile.ZipFile(arch, 'w') as zobj:
+        _add_symlink(zobj, 'link', target)
+        _add_symlink(zobj, 'sub/ok', '../file')
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    monkeypatch.chdir(tree)
+
+    assert file_archive.NativeZipArchive().extract(arch)
+
+    assert not os.path.lexists(str(tree / 'link'))
+    assert os.readlink(str(tree / 'sub' / 'ok')) == '../file'
+
+
+@pytest.mark.parametrize('name', ['../outside', '/abs', 'a/../../outside'])
+def test_zip_unsafe_name(tmp_path, monkeypatch, name):
+    arch = str(tmp_path / 'evil.zip')
+    with zipfile.ZipFile(arch, 'w') as zobj:
+        zobj.writestr(name, 'data')
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    monkeypatch.chdir(tree)
+
+    assert file_archive.NativeZipArchive().extract(arch)
+
+    assert not (tmp_path / 'outside').exists()
+    assert not os.path.exists('/abs')
+
+
+def test_tar_unsafe_name(tmp_path, monkeypatch):
+    arch = str(tmp_path / 'evil.tar')
+    outside = tmp_path / 'outside'
+    outside.write_text(u'data')
+    tarfile.open(arch, 'w').add(str(outside), '../outside2')
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    monkeypatch.chdir(tree)
+
+    file_archive.NativeTarArchive().extract(arch)
+
+    assert not (tmp_path / 'outside2').exists()
+
+
+def test_call_records_own_usage(tmp_path, monkeypatch):
+    records = tmp_path / 'metrics.jsonl'
+    monkeypatch.setitem(metrics._STATE, 'output', open(str(records), 'a'))
+    code = ("import sys; data = bytearray(64 * 1024 * 1024); "
+            "sys.exit(3)")
+    assert file_archive._call([sys.executable, '-c', code]) == 3
+    assert file_archive._call([sys.executable, '-c', 'pass']) == 0
+    metrics._STATE['output'].close()
+
+    big, small = [json.loads(x) for x in records.read_text().splitlines()]
+    assert big['phase'] == 'archiver'
+    assert big['peak_rss_kb'] >= 64 * 1024
+    assert small['peak_rss_kb'] < big['peak_rss_kb']
+    assert 'cpu_user' in small and 'cpu_system' in small
+
+
+def test_call_killed():
+    cmd = [sys.executable, '-c', 'import os; os.kill(os.getpid(), 9)']
+    assert file_archive._call(cmd) == -9
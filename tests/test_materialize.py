@@ -0,0 +1,46 @@
+import os
+import stat
+
+from e_uae_wrapper import materialize
+
+
+def _make_tree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'ro' / 'sub').mkdir(parents=True)
+    (src / 'ro' / 'f').write_bytes(b'data')
+    (src / 'ro' / 'sub' / 'g').write_bytes(b'more')
+    os.chmod(str(src / 'ro' / 'sub'), 0o555)
+    os.chmod(str(src / 'ro'), 0o555)
+    dst = tmp_path / 'dst'
+    dst.mkdir()
+    return src, dst
+
+
+def _make_writable(*paths):
+    for path in paths:
+        for root, dirs, _ in os.walk(str(path)):
+            os.chmod(root, 0o755)
+
+
+def test_populate_readonly_dir(tmp_path, monkeypatch):
+    src, dst = _make_tree(tmp_path)
+    copystat = materialize.shutil.copystat
+    filled = []
+
+    def check_copystat(src_path, dst_path):
+        # directory is complete, when it gets its read only mode
+        if os.path.isdir(dst_path):
+            filled.append(sorted(os.listdir(dst_path)) ==
+                          sorted(os.listdir(src_path)))
+        copystat(src_path, dst_path)
+
+    monkeypatch.setattr(materialize.shutil, 'copystat', check_copystat)
+    try:
+        materialize.Materializer().populate(str(src), str(dst))
+        assert filled == [True, True]
+        assert (dst / 'ro' / 'f').read_bytes() == b'data'
+        assert (dst / 'ro' / 'sub' / 'g').read_bytes() == b'more'
+        assert stat.S_IMODE(os.stat(str(dst / 'ro')).st_mode) == 0o555
+        assert stat.S_IMODE(os.stat(str(dst / 'ro' / 'sub')).st_mode) == 0o555
+    finally:
+        _make_writable(src, dst)
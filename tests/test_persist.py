@@ -0,0 +1,54 @@
+import os
+
+from e_uae_wrapper import archive
+from e_uae_wrapper import persist
+
+
+def _make_tree(tmp_path):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'file').write_bytes(b'data')
+    games = tmp_path / 'games'
+    games.mkdir()
+    return str(tree), str(games / 'game.tar')
+
+
+def test_make_archive(tmp_path):
+    tree, arch = _make_tree(tmp_path)
+    assert persist.make_archive(tree, arch, use_index=False)
+    assert os.listdir(os.path.dirname(arch)) == ['game.tar']
+
+
+def test_make_archive_replace_fails(tmp_path, monkeypatch):
+    tree, arch = _make_tree(tmp_path)
+
+    def rename(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(persist.os, 'rename', rename)
+    assert not persist.make_archive(tree, arch, use_index=False)
+    assert os.listdir(os.path.dirname(arch)) == []
+
+
+def test_make_archive_create_fails(tmp_path):
+    tree, arch = _make_tree(tmp_path)
+    assert not persist.make_archive(tree, arch, use_index=False,
+                                    files=['missing'])
+    assert os.listdir(os.path.dirname(arch)) == []
+
+
+def test_wait_before_reading_index(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(persist, 'wait', lambda path: calls.append('wait'))
+    wrapper = archive.Wrapper(str(tmp_path / 'game.uaerc'),
+                              {'wrapper': 'archive',
+                               'wrapper_archive': 'game.tar'})
+
+    def make_tmp_dir():
+        wrapper._get_index()
+        calls.append('index')
+        return False
+
+    monkeypatch.setattr(wrapper, '_make_tmp_dir', make_tmp_dir)
+    assert not wrapper.run()
+    assert calls == ['wait', 'index']
@@ -0,0 +1,46 @@
+import tarfile
+
+from e_uae_wrapper import sidecar
+from e_uae_wrapper import utils
+
+
+def _make_archive(tmp_path):
+    tree = tmp_path / 'tree'
+    (tree / 'DH0').mkdir(parents=True)
+    (tree / 'DH0' / 'file').write_bytes(b'data')
+    arch = str(tmp_path / 'a.tar')
+    with tarfile.open(arch, 'w') as tar:
+        tar.add(str(tree / 'DH0'), 'DH0')
+    return arch, str(tree)
+
+
+def test_build_does_not_read_files(tmp_path, monkeypatch):
+    arch, tree = _make_archive(tmp_path)
+
+    def fail(path):
+        raise AssertionError("%s was read" % path)
+    monkeypatch.setattr(utils, 'file_digest', fail)
+
+    index = sidecar.build(arch, tree)
+    entry = index.entries['DH0/file']
+    assert (entry[0], entry[2], entry[3]) == ('f', 4, None)
+    assert index.seekable
+
+
+def test_build_with_digests(tmp_path):
+    arch, tree = _make_archive(tmp_path)
+    index = sidecar.build(arch, tree, {'DH0/file': 'abc'})
+    index.save()
+
+    loaded = sidecar.load(arch)
+    assert loaded.entries['DH0/file'][3] == 'abc'
+    assert loaded.size == 4
+    assert loaded.contains('DH0')
+
+
+def test_outdated_index(tmp_path):
+    arch, tree = _make_archive(tmp_path)
+    sidecar.build(arch, tree).save()
+    with open(arch, 'ab') as fobj:
+        fobj.write(b'\0' * 512)
+    assert sidecar.load(arch) is None
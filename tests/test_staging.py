@@ -0,0 +1,83 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from e_uae_wrapper import staging
+
+
+DATA = b'\0' * (1024 * 1024)
+
+
+def _make_tar(path, mode):
+    info = tarfile.TarInfo('disk.hdf')
+    info.size = len(DATA)
+    with tarfile.open(path, mode) as tar:
+        tar.addfile(info, io.BytesIO(DATA))
+
+
+def test_estimate_size_zip(tmp_path):
+    path = str(tmp_path / 'a.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zobj:
+        zobj.writestr('disk.hdf', DATA)
+    assert staging.estimate_size(path) == len(DATA)
+
+
+def test_estimate_size_gzip(tmp_path):
+    path = str(tmp_path / 'a.tar.gz')
+    _make_tar(path, 'w:gz')
+    size = staging.estimate_size(path)
+    assert len(DATA) < size < len(DATA) + 10240
+    assert size > os.path.getsize(path)
+
+
+def test_estimate_size_tar(tmp_path):
+    path = str(tmp_path / 'a.tar')
+    _make_tar(path, 'w')
+    assert staging.estimate_size(path) == os.path.getsize(path)
+
+
+def test_estimate_size_unknown(tmp_path):
+    path = str(tmp_path / 'a.tar.bz2')
+    _make_tar(path, 'w:bz2')
+    # no guessing out of the tiny compressed size
+    assert staging.estimate_size(path) is None
+
+
+@pytest.fixture
+def tmpfs(tmp_path, monkeypatch):
+    path = tmp_path / 'shm'
+    path.mkdir()
+    monkeypatch.setattr(staging, 'TMPFS_DIRS', [str(path)])
+    monkeypatch.setattr(staging, 'get_mem_available',
+                        lambda: staging.RAM_RESERVE + 10 * staging.MIB)
+    return str(path)
+
+
+def test_select_dir_tmpfs(tmp_path, tmpfs):
+    disk = str(tmp_path)
+    assert staging.select_dir(staging.MIB, disk) == tmpfs
+
+
+def test_select_dir_too_big_for_tmpfs(tmp_path, tmpfs):
+    disk = str(tmp_path)
+    assert staging.select_dir(20 * staging.MIB, disk) == disk
+
+
+def test_select_dir_unknown_size(tmp_path, tmpfs):
+    disk = str(tmp_path)
+    assert staging.select_dir(None, disk) == disk
+
+
+def test_select_dir_no_space(tmp_path, tmpfs, monkeypatch):
+    monkeypatch.setattr(staging, 'get_free_space', lambda path: 0)
+    assert staging.select_dir(20 * staging.MIB, str(tmp_path)) is None
+
+
+def test_estimate_size_no_cache_dir(tmp_path, cache_dir):
+    path = str(tmp_path / 'a.tar')
+    _make_tar(path, 'w')
+    assert staging.estimate_size(path) >= len(DATA)
+    assert not (cache_dir / 'e-uae-wrapper' / 'trees').exists()
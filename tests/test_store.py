@@ -0,0 +1,87 @@
+import os
+import time
+
+import pytest
+
+from e_uae_wrapper import store
+from e_uae_wrapper import utils
+
+
+@pytest.fixture
+def session(tmp_path):
+    """Archive and the session tree populated out of the store"""
+    src = tmp_path / 'src'
+    (src / 'S').mkdir(parents=True)
+    (src / 'S' / 'Startup-Sequence').write_bytes(b'boot\n')
+    (src / 'save').write_bytes(b'level 1')
+    arch = tmp_path / 'game.tar'
+    curdir = os.getcwd()
+    os.chdir(str(src))
+    try:
+        assert utils.create_archive(str(arch))
+    finally:
+        os.chdir(curdir)
+
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    assert store.Store().extract(str(arch), str(tree))
+    return arch, tree
+
+
+def _count_digests(monkeypatch):
+    hashed = []
+    file_digest = utils.file_digest
+
+    def counting_digest(path):
+        hashed.append(os.path.basename(path))
+        return file_digest(path)
+
+    monkeypatch.setattr(utils, 'file_digest', counting_digest)
+    return hashed
+
+
+def test_add_tree_hashes_changed_only(session, monkeypatch):
+    arch, tree = session
+    (tree / 'save').write_bytes(b'level 2')
+    hashed = _count_digests(monkeypatch)
+
+    store.Store().add_tree(str(tree), str(arch))
+    assert hashed == ['save']
+
+
+def test_gc_is_periodic(session, monkeypatch):
+    arch, tree = session
+    gc_calls = []
+    monkeypatch.setattr(store.Store, 'gc',
+                        lambda self: gc_calls.append(True))
+
+    (tree / 'save').write_bytes(b'level 2')
+    store.Store().add_tree(str(tree), str(arch))
+    assert len(gc_calls) == 1
+
+    (tree / 'save').write_bytes(b'level 3')
+    store.Store().add_tree(str(tree), str(arch))
+    assert len(gc_calls) == 1
+
+    stamp = os.path.join(store.Store().store_dir, store.GC_STAMP)
+    old = time.time() - store.GC_INTERVAL - 10
+    os.utime(stamp, (old, old))
+    store.Store().add_tree(str(tree), str(arch))
+    assert len(gc_calls) == 2
+
+
+def test_gc_removes_unreferenced(session):
+    arch, tree = session
+    (tree / 'save').write_bytes(b'level 2')
+    obj_store = store.Store()
+    # gc was just run
+    open(os.path.join(obj_store.store_dir, store.GC_STAMP), 'w').close()
+    obj_store.add_tree(str(tree), str(arch))
+    objects = [x for _, _, files in os.walk(obj_store.objects_dir)
+               for x in files]
+    assert len(objects) == 3
+
+    obj_store.gc()
+    objects = [x for _, _, files in os.walk(obj_store.objects_dir)
+               for x in files]
+    assert len(objects) == 2
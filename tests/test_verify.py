@@ -0,0 +1,95 @@
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from e_uae_wrapper import file_archive
+
+
+def _tar_data():
+    fobj = io.BytesIO()
+    with tarfile.open(fileobj=fobj, mode='w') as tar:
+        info = tarfile.TarInfo('file')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b'data'))
+    return fobj.getvalue()
+
+
+@pytest.mark.parametrize('ext', ['tar', 'tar.gz', 'tar.bz2'])
+def test_verify_empty_tree(tmp_path, monkeypatch, ext):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    monkeypatch.chdir(tree)
+    arch = str(tmp_path / ('empty.' + ext))
+
+    archiver = file_archive.get_archiver(arch, verify=True)
+    assert archiver.create(arch)
+    assert archiver.check(arch)
+    assert archiver.digest is not None
+    # read back from scratch as well
+    assert file_archive.get_archiver(arch).check(arch)
+
+
+def test_verify_tree(tmp_path, monkeypatch):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'file').write_bytes(os.urandom(300000))
+    monkeypatch.chdir(tree)
+    arch = str(tmp_path / 'a.tar.gz')
+
+    archiver = file_archive.get_archiver(arch, verify=True)
+    assert archiver.create(arch)
+    assert archiver.verified is True
+
+
+def test_verifier_mismatch(tmp_path):
+    fname = str(tmp_path / 'a.tar')
+    with open(fname, 'wb') as fobj:
+        verifier = file_archive._Verifier(fname)
+        fobj.write(_tar_data())
+    verifier.expected = 'wrong'
+    assert verifier.finish() is False
+
+
+def test_verifier_not_tar(tmp_path):
+    fname = str(tmp_path / 'a.tar')
+    with open(fname, 'wb') as fobj:
+        verifier = file_archive._Verifier(fname)
+        fobj.write(b'garbage' * 100)
+    verifier.expected = 'whatever'
+    assert verifier.finish() is False
+    assert isinstance(verifier.error, ValueError)
+
+
+def test_verifier_truncated_compressed(tmp_path):
+    fname = str(tmp_path / 'a.tar.gz')
+    data = gzip.compress(_tar_data())
+    with open(fname, 'wb') as fobj:
+        verifier = file_archive._Verifier(fname)
+        fobj.write(data[:len(data) // 2])
+    verifier.expected = 'whatever'
+    assert verifier.finish() is False
+    assert verifier.error is not None
+
+
+def test_check_broken_archive(tmp_path):
+    fname = str(tmp_path / 'a.tar.gz')
+    data = gzip.compress(_tar_data())
+    with open(fname, 'wb') as fobj:
+        fobj.write(data[:-10] + b'\xff' * 10)
+    assert not file_archive.NativeTarGzipArchive().check(fname)
+
+
+def test_create_failure_stops_verifier(tmp_path, monkeypatch):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'file').write_bytes(b'data')
+    monkeypatch.chdir(tree)
+    arch = str(tmp_path / 'a.tar')
+
+    archiver = file_archive.NativeTarArchive(verify=True)
+    # missing file makes creation fail half way
+    assert not archiver.create(arch, ['file', 'missing'])
+    assert archiver.verified is None